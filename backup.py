@@ -1,14 +1,21 @@
+from collections import OrderedDict
 import ctypes
 from datetime import datetime, timezone, timedelta
+import delta
+import engine
 import os
 from pathlib import Path
-from PyQt5.QtCore import Qt, QFileInfo
+import profiling
+from PyQt5.QtCore import QAbstractTableModel, QEvent, QFileInfo, QModelIndex, QRect, Qt, QThread, pyqtSignal
 from PyQt5.QtGui import QCursor, QFont, QFontMetrics, QIcon
-from PyQt5.QtWidgets import QAbstractScrollArea, QApplication, QCheckBox, QDesktopWidget, QFileDialog, QFileIconProvider, QFrame, QHBoxLayout, QHeaderView, QLabel, QLineEdit, QPushButton, QProgressBar, QStyle, QTableWidget, QTableWidgetItem, QToolTip, QVBoxLayout, QWidget
-import shutil
+from PyQt5.QtWidgets import QAbstractItemView, QAbstractScrollArea, QApplication, QCheckBox, QDesktopWidget, QFileDialog, QFileIconProvider, QFrame, QHBoxLayout, QHeaderView, QLabel, QLineEdit, QMessageBox, QPushButton, QProgressBar, QStyle, QStyledItemDelegate, QStyleOptionButton, QTableView, QToolTip, QVBoxLayout, QWidget
+from results import COPY, COPY_TO_BACKUP, COPY_TO_SOURCE, KEEP, KEEP_BACKUP, KEEP_SOURCE, RENAME
 import sys
+import time
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
+progress_interval = 0.1 # minimum seconds between progress updates sent to the UI
+icon_cache_size = 256 # file extensions whose icon is kept in memory
 
 
 
@@ -54,6 +61,175 @@ class CustomHeaderView(QHeaderView):
             self.resizeSection(6, self.width_l)
 
 
+class IconCache:
+    '''
+    System icons shared by all tables: one icon for folders and one per file extension, in a bounded LRU cache.
+    The file system is only queried the first time an extension is seen.
+    '''
+
+    def __init__(self, size=icon_cache_size):
+        self.size = size
+        self.provider = QFileIconProvider()
+        self.folder_icon = self.provider.icon(QFileIconProvider.Folder)
+        self.icons = OrderedDict()
+
+
+    def icon(self, path, folder=False):
+        if folder:
+            return self.folder_icon
+
+        extension = os.path.splitext(path)[1].lower()
+        icon = self.icons.get(extension)
+        if icon is not None:
+            self.icons.move_to_end(extension)
+            return icon
+
+        icon = self.provider.icon(QFileInfo(str(path)))
+        self.icons[extension] = icon
+        if len(self.icons) > self.size:
+            self.icons.popitem(last=False)
+        return icon
+
+
+
+class PathsTableModel(QAbstractTableModel):
+    '''
+    Table model over a PathTable of the comparison results: relative path in the first column, checkboxes in the others.
+    Checkbox states are the decision bits of the table and everything else is computed only for the rows being drawn.
+    '''
+
+    def __init__(self, column_count, checkbox_bits, icon_cache, folders=False):
+        super().__init__()
+        self.column_count = column_count
+        self.checkbox_bits = checkbox_bits # {column: decision bit}
+        self.checkbox_columns = list(checkbox_bits)
+        self.table = None
+        self.icon_cache = icon_cache
+        self.folders = folders
+
+
+    def set_table(self, table):
+        '''
+        Show a new table of paths
+        '''
+
+        self.beginResetModel()
+        self.table = table
+        self.endResetModel()
+
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() or self.table is None else len(self.table)
+
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.column_count
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        row, col = index.row(), index.column()
+        if col == 0:
+            if role in (Qt.DisplayRole, Qt.ToolTipRole):
+                return self.table.relative_path(row)
+            if role == Qt.DecorationRole:
+                return self.icon_cache.icon(self.table.path(row), self.folders)
+        elif col in self.checkbox_bits and role == Qt.CheckStateRole:
+            return Qt.Checked if self.table.decisions[row] & self.checkbox_bits[col] else Qt.Unchecked
+        return None
+
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or index.column() not in self.checkbox_bits:
+            return False
+        self.table.set_checked(index.row(), self.checkbox_bits[index.column()], value == Qt.Checked)
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+
+    def flags(self, index):
+        if index.column() in self.checkbox_bits:
+            return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+        return Qt.ItemIsEnabled
+
+
+
+class DatesTableModel(PathsTableModel):
+    '''
+    Table model over the files with different dates modified, including the dates (most recent in bold)
+    '''
+
+    def __init__(self, icon_cache):
+        super().__init__(7, {1: KEEP_SOURCE, 2: COPY_TO_BACKUP, 4: KEEP_BACKUP, 5: COPY_TO_SOURCE}, icon_cache)
+        self.bold_font = QFont()
+        self.bold_font.setBold(True)
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        row, col = index.row(), index.column()
+        if col in (3, 6):
+            date_edited1, date_edited2 = self.table.dates1[row], self.table.dates2[row]
+            date_edited = date_edited1 if col == 3 else date_edited2
+            if role == Qt.DisplayRole:
+                return datetime.fromtimestamp(date_edited, timezone(timedelta(hours=1))).strftime("%d/%m/%Y %H:%M")
+            if role == Qt.FontRole and self.table.content[row] and date_edited == max(date_edited1, date_edited2) and date_edited1 != date_edited2:
+                return self.bold_font
+            return None
+        if col == 0 and role == Qt.ToolTipRole and not self.table.content[row]:
+            return 'Same contents, only the date modified differs'
+        return super().data(index, role)
+
+
+
+class RenamesTableModel(PathsTableModel):
+    '''
+    Table model over the files and folders renamed or moved in the source, showing their path in the backup and in the source
+    '''
+
+    def __init__(self, icon_cache):
+        super().__init__(2, {1: RENAME}, icon_cache)
+
+
+    def data(self, index, role=Qt.DisplayRole):
+        row, col = index.row(), index.column()
+        if col == 0:
+            if role in (Qt.DisplayRole, Qt.ToolTipRole):
+                return f'{self.table.old_paths.relative_path(row)}  \u2192  {self.table.relative_path(row)}'
+            if role == Qt.DecorationRole:
+                return self.icon_cache.icon(self.table.path(row), bool(self.table.folder[row]))
+        return super().data(index, role)
+
+
+
+class CheckBoxDelegate(QStyledItemDelegate):
+    '''
+    Draw the check state of a cell as a centered checkbox and toggle it on click
+    '''
+
+    def checkbox_rect(self, option):
+        style = QApplication.style()
+        indicator = style.subElementRect(QStyle.SE_CheckBoxIndicator, QStyleOptionButton(), None)
+        rect = QRect(0, 0, indicator.width(), indicator.height())
+        rect.moveCenter(option.rect.center())
+        return rect
+
+
+    def paint(self, painter, option, index):
+        checkbox = QStyleOptionButton()
+        checkbox.rect = self.checkbox_rect(option)
+        checkbox.state = QStyle.State_Enabled | (QStyle.State_On if index.data(Qt.CheckStateRole) == Qt.Checked else QStyle.State_Off)
+        QApplication.style().drawControl(QStyle.CE_CheckBox, checkbox, painter)
+
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() in (QEvent.MouseButtonPress, QEvent.MouseButtonDblClick):
+            return self.checkbox_rect(option).contains(event.pos())
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton and self.checkbox_rect(option).contains(event.pos()):
+            checked = index.data(Qt.CheckStateRole) == Qt.Checked
+            return model.setData(index, Qt.Unchecked if checked else Qt.Checked, Qt.CheckStateRole)
+        return False
+
+
+
 class BackupApp(QWidget):
 
     def __init__(self, app):
@@ -95,15 +271,26 @@ class BackupApp(QWidget):
         backup_browse.clicked.connect(self.get_backup_location)
 
         # Create Analyze button
-        analyze_button = QPushButton('Analyze')
-        analyze_button.clicked.connect(self.analyze)
+        self.analyze_button = QPushButton('Analyze')
+        self.analyze_button.clicked.connect(self.analyze)
+
+        # Create checkbox for incremental analysis
+        self.incremental_checkbox = QCheckBox('Incremental')
+        self.incremental_checkbox.setToolTip('Skip listing folders that have not changed since the last analysis\n(files edited in place are only detected by a full analysis)')
+
+        # Create checkbox for content verification
+        self.verify_checkbox = QCheckBox('Verify content')
+        self.verify_checkbox.setToolTip('Compare the contents of files with different dates modified\nand only list the ones whose contents differ')
+
+        # Create icon cache shared by all tables
+        self.icon_cache = IconCache()
 
         # Create label to show which folder is being analyzed
         self.analyzing_label = QLabel(' ')
 
-        # Create QTableWidgets for folder selection after analysis (folders only in source)
-        self.folders_in_source_table = QTableWidget()
-        self.folders_in_source_table.setColumnCount(3)
+        # Create tables for folder selection after analysis (folders only in source)
+        self.folders_in_source_table = QTableView()
+        self.folders_in_source_table.setModel(PathsTableModel(3, {1: KEEP, 2: COPY}, self.icon_cache, folders=True))
         self.folders_in_source_table.setHorizontalHeader(CustomHeaderView(
             {0: 'Folders only in source directory'}, 
             {1: f'{script_dir}/icons/keep_in_source.png', 2: f'{script_dir}/icons/move_to_backup.png'}, 
@@ -111,9 +298,9 @@ class BackupApp(QWidget):
             self.scrollbar_width))
         self.style_table(self.folders_in_source_table)     
         
-        # Create QTableWidgets for folder selection after analysis (folders only in backup)
-        self.folders_in_backup_table = QTableWidget()
-        self.folders_in_backup_table.setColumnCount(3)
+        # Create tables for folder selection after analysis (folders only in backup)
+        self.folders_in_backup_table = QTableView()
+        self.folders_in_backup_table.setModel(PathsTableModel(3, {1: KEEP, 2: COPY}, self.icon_cache, folders=True))
         self.folders_in_backup_table.setHorizontalHeader(CustomHeaderView(
             {0: 'Folders only in backup directory'}, 
             {1: f'{script_dir}/icons/keep_in_backup.png', 2: f'{script_dir}/icons/move_to_source.png'}, 
@@ -121,9 +308,9 @@ class BackupApp(QWidget):
             self.scrollbar_width))
         self.style_table(self.folders_in_backup_table)
 
-        # Create QTableWidgets for file selection after analysis (files only in source)
-        self.files_in_source_table = QTableWidget()
-        self.files_in_source_table.setColumnCount(3)
+        # Create tables for file selection after analysis (files only in source)
+        self.files_in_source_table = QTableView()
+        self.files_in_source_table.setModel(PathsTableModel(3, {1: KEEP, 2: COPY}, self.icon_cache))
         self.files_in_source_table.setHorizontalHeader(CustomHeaderView(
             {0: 'Files only in source directory'}, 
             {1: f'{script_dir}/icons/keep_in_source.png', 2: f'{script_dir}/icons/move_to_backup.png'}, 
@@ -131,9 +318,9 @@ class BackupApp(QWidget):
             self.scrollbar_width))
         self.style_table(self.files_in_source_table)     
 
-        # Create QTableWidgets for file selection after analysis (file only in backup)
-        self.files_in_backup_table = QTableWidget()
-        self.files_in_backup_table.setColumnCount(3)
+        # Create tables for file selection after analysis (file only in backup)
+        self.files_in_backup_table = QTableView()
+        self.files_in_backup_table.setModel(PathsTableModel(3, {1: KEEP, 2: COPY}, self.icon_cache))
         self.files_in_backup_table.setHorizontalHeader(CustomHeaderView(
             {0: 'Files only in backup directory'}, 
             {1: f'{script_dir}/icons/keep_in_backup.png', 2: f'{script_dir}/icons/move_to_source.png'}, 
@@ -141,9 +328,9 @@ class BackupApp(QWidget):
             self.scrollbar_width))
         self.style_table(self.files_in_backup_table)
 
-        # Create QListWidget for files with different dates modified
-        self.files_dates_table = QTableWidget()
-        self.files_dates_table.setColumnCount(7)
+        # Create table for files with different dates modified
+        self.files_dates_table = QTableView()
+        self.files_dates_table.setModel(DatesTableModel(self.icon_cache))
         self.files_dates_table.setHorizontalHeader(CustomHeaderView(
             {0: 'Files with different dates modified', 3: 'Last modified in source', 6: 'Last modified in backup'}, 
             {1: f'{script_dir}/icons/keep_in_source.png', 2: f'{script_dir}/icons/move_to_backup.png', 4: f'{script_dir}/icons/keep_in_backup.png', 5: f'{script_dir}/icons/move_to_source.png'}, 
@@ -151,6 +338,16 @@ class BackupApp(QWidget):
             self.scrollbar_width, self.date_width))
         self.style_table(self.files_dates_table)
 
+        # Create table for files and folders renamed or moved in the source
+        self.renames_table = QTableView()
+        self.renames_table.setModel(RenamesTableModel(self.icon_cache))
+        self.renames_table.setHorizontalHeader(CustomHeaderView(
+            {0: 'Renamed or moved in source (path in backup \u2192 path in source)'},
+            {1: f'{script_dir}/icons/move_to_backup.png'},
+            {1: 'Rename in backup (otherwise copied again, and the old path is kept)'},
+            self.scrollbar_width))
+        self.style_table(self.renames_table)
+
         # Create Backup button
         self.backup_button = QPushButton('Backup')
         self.backup_button.clicked.connect(self.backup)
@@ -163,11 +360,24 @@ class BackupApp(QWidget):
         self.backup_button.setMouseTracking(True)
         self.backup_button.enterEvent = show_popup
 
+        # Create checkbox for delta transfer of large modified files
+        self.delta_checkbox = QCheckBox('Delta copy')
+        self.delta_checkbox.setToolTip(f'Update files of {delta.delta_threshold // 2**20} MB or more in place when they replace an older version,\n'
+                                       'only rewriting the parts that changed')
+
         # Create progress bar
         self.progress_bar = QProgressBar()
         self.progress_bar.setValue(0)
         self.progress_bar.setMaximum(100)
 
+        # Create Cancel button for the running analysis or backup
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel)
+        self.cancel_button.setEnabled(False)
+        self.worker = None
+        self.profile = None
+        self.analyzed = False
+
 
         # Arrange widgets using layouts
         #  global container
@@ -194,7 +404,11 @@ class BackupApp(QWidget):
         #  container for vbox_browse and analyze button
         hbox_analyze = QHBoxLayout()
         hbox_analyze.addLayout(vbox_browse)
-        hbox_analyze.addWidget(analyze_button)
+        vbox_analyze = QVBoxLayout()
+        vbox_analyze.addWidget(self.analyze_button)
+        vbox_analyze.addWidget(self.incremental_checkbox)
+        vbox_analyze.addWidget(self.verify_checkbox)
+        hbox_analyze.addLayout(vbox_analyze)
         vbox.addLayout(hbox_analyze)
 
         #  analyzing label
@@ -218,15 +432,27 @@ class BackupApp(QWidget):
         hbox_files_lists.setContentsMargins(0, 0, 0, self.scrollbar_width)
         vbox.addLayout(hbox_files_lists)
 
+        #  renamed files and folders
+        hbox_renames = QVBoxLayout()
+        hbox_renames.addWidget(self.renames_table)
+        hbox_renames.setContentsMargins(0, 0, 0, self.scrollbar_width)
+        vbox.addLayout(hbox_renames)
+
         #  files with different dates
         hbox_list_files_date = QVBoxLayout()
         hbox_list_files_date.addWidget(self.files_dates_table)
         hbox_list_files_date.setContentsMargins(0, 0, 0, self.scrollbar_width)
         vbox.addLayout(hbox_list_files_date)
 
-        #  backup button and progress bar
-        vbox.addWidget(self.backup_button)
-        vbox.addWidget(self.progress_bar)
+        #  backup button, delta checkbox, progress bar and cancel button
+        hbox_backup_button = QHBoxLayout()
+        hbox_backup_button.addWidget(self.backup_button, 1)
+        hbox_backup_button.addWidget(self.delta_checkbox)
+        vbox.addLayout(hbox_backup_button)
+        hbox_progress = QHBoxLayout()
+        hbox_progress.addWidget(self.progress_bar)
+        hbox_progress.addWidget(self.cancel_button)
+        vbox.addLayout(hbox_progress)
 
         #  complete layout
         self.setLayout(vbox)
@@ -248,24 +474,30 @@ class BackupApp(QWidget):
         '''
 
         table.setSizeAdjustPolicy(QAbstractScrollArea.AdjustToContents)
-        table.setRowCount(1)
         
         # Set table header color
         header = table.horizontalHeader()
         stylesheet = "::section{Background-color:rgb(240,240,240); border:0}"
         header.setStyleSheet(stylesheet)
 
-        # Make headers fit the contents
+        # Make headers fit the contents, with rows of fixed height so only visible rows are ever measured
         header.setSectionResizeMode(QHeaderView.ResizeToContents)
-        table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        table.setWordWrap(False)
+        table.setTextElideMode(Qt.ElideMiddle)
+
+        # Draw checkboxes centered in their columns
+        checkbox_delegate = CheckBoxDelegate(table)
+        for col in table.model().checkbox_columns:
+            table.setItemDelegateForColumn(col, checkbox_delegate)
         
         # Make vertical scrollbar always visible
         table.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
 
         # Make cells and headers behave like labels (not clickable, focusable, etc.)
         table.setFocusPolicy(Qt.NoFocus)
-        table.setEditTriggers(QTableWidget.NoEditTriggers)
-        table.setSelectionMode(QTableWidget.NoSelection)
+        table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        table.setSelectionMode(QAbstractItemView.NoSelection)
         table.horizontalHeader().setSectionsClickable(False)
         table.verticalHeader().setSectionsClickable(False)
 
@@ -286,6 +518,7 @@ class BackupApp(QWidget):
         if directory:
             self.dir_line_edit.setText(directory)
             self.backup_button.setEnabled(False)
+            self.analyzed = False
 
 
     def get_backup_location(self):
@@ -297,398 +530,279 @@ class BackupApp(QWidget):
         if backup_location:
             self.backup_line_edit.setText(backup_location)
             self.backup_button.setEnabled(False)
-
-
-    # Lists of paths for user decision
-    unique_files_dir = []
-    unique_files_backup = []
-    unique_folders_dir = []
-    unique_folders_backup = []
-    different_dates = []
+            self.analyzed = False
 
 
     def analyze(self):
         '''
-        Compare source and backup directory to find differences
+        Compare source and backup directory to find differences (in a background worker)
         '''
 
-        # Reset progress bar to 0
-        self.progress_bar.setValue(0)
-        QApplication.processEvents()
-
         # Get paths
         directory = self.dir_line_edit.text()
         backup = self.backup_line_edit.text()
         if not (directory and backup):
             return
-        
-        self.directory_path = Path(directory)
-        self.backup_path = Path(backup)
 
-        # Clear contents of paths lists
-        for file_list in [self.unique_files_dir, self.unique_files_backup, self.different_dates, self.unique_folders_dir, self.unique_folders_backup]:
-            file_list.clear()
-        
-        # Compare the two directories
-        self.compare(self.directory_path, self.backup_path)
+        # Reset progress bar to 0
+        self.progress_bar.setValue(0)
 
-        # Reset analyzing label
-        self.analyzing_label.setText('  ')
-        QApplication.processEvents()
+        # Offer to finish an interrupted backup first, as a new backup would discard its journal
+        pending = engine.pending_backup(Path(backup))
+        if pending is not None:
+            answer = QMessageBox.question(self, 'Interrupted backup', f'A backup from {pending["source"]} to {pending["backup"]} was interrupted.\n'
+                                          'Resume it now? Otherwise it is discarded at the next backup.')
+            if answer == QMessageBox.Yes:
+                self.start_worker(ResumeWorker(Path(backup)), self.backup_finished)
+                return
 
-        # Update QListWidgets
-        self.update_paths_tables()
-        
-        # Enable backup button
-        self.backup_button.setEnabled(True)
+        # Compare the two directories, profiling the analysis until its results are shown
+        incremental = self.incremental_checkbox.isChecked()
+        verify_content = self.verify_checkbox.isChecked()
+        self.profile = profiling.start('analyze', {'source': directory, 'backup': backup, 'workers': engine.scan_workers,
+                                                   'incremental': incremental, 'verify_content': verify_content})
+        self.start_worker(AnalyzeWorker(Path(directory), Path(backup), incremental, verify_content), self.analysis_finished)
 
-    
-    def compare(self, path1, path2):
+
+    def analysis_finished(self):
         '''
-        Recursively compare two directories
+        Show the comparison results once the analyze worker is done
         '''
 
-        # Show which folder is being analyzed
-        self.analyzing_label.setText('Analyzing ' + str(path1.relative_to(self.directory_path)))
-        QApplication.processEvents()
+        results = self.worker.results
+        backup_path = self.worker.backup_path
+        self.worker = None
 
-        # Get files in both paths
-        files1 = {file.name: file for file in path1.glob('*') if file.is_file()}
-        files2 = {file.name: file for file in path2.glob('*') if file.is_file()}
+        # Reset analyzing label and progress bar
+        self.analyzing_label.setText('  ')
+        self.progress_bar.setValue(0)
 
-        # Files in path1 but not in path2
-        unique_files1 = [files1[file_name] for file_name in files1 if file_name not in files2]
-        self.unique_files_dir.extend(unique_files1)
+        if results is not None:
+            self.directory_path = results.directory_path
+            self.backup_path = results.backup_path
+            self.analyzed = True
 
-        # Files in path2 but not in path1
-        unique_files2 = [files2[file_name] for file_name in files2 if file_name not in files1]
-        self.unique_files_backup.extend(unique_files2)
+            # Paths for user decision
+            self.results = results
 
-        # Files in both paths with different date edited
-        for file_name, file_path1 in files1.items():
-            if file_name in files2:
-                file_path2 = files2[file_name]
+            # Update tables
+            with profiling.span('render'):
+                self.update_paths_tables()
 
-                date_edited1 = int(os.path.getmtime(file_path1))
-                date_edited2 = int(os.path.getmtime(file_path2))
+        # Save the run report in the backup location
+        profiling.finish(self.profile, backup_path)
+        self.profile = None
 
-                if date_edited1 != date_edited2:
-                    self.different_dates.append((file_path1, file_path2, date_edited1, date_edited2))
+        # Enable backup button (once an analysis has completed)
+        self.set_running(False)
 
-        # Get folders in both paths
-        folders1 = {folder.name: folder for folder in path1.iterdir() if folder.is_dir()}
-        folders2 = {folder.name: folder for folder in path2.iterdir() if folder.is_dir()}
+    
+    def update_paths_tables(self):
+        '''
+        Show paths for user decision in the UI
+        '''
 
-        # Folders in path1 but not in path2
-        unique_folders1 = [folders1[folder_name] for folder_name in folders1 if folder_name not in folders2]
-        self.unique_folders_dir.extend(unique_folders1)
+        self.folders_in_source_table.model().set_table(self.results.unique_folders_dir)
+        self.folders_in_backup_table.model().set_table(self.results.unique_folders_backup)
+        self.files_in_source_table.model().set_table(self.results.unique_files_dir)
+        self.files_in_backup_table.model().set_table(self.results.unique_files_backup)
+        self.files_dates_table.model().set_table(self.results.different_dates)
+        self.renames_table.model().set_table(self.results.renames)
+    
+    
+    def backup(self):
+        '''
+        Perform copy of selected items and delete unselected items in a background worker
+        '''
 
-        # Folders in path2 but not in path1
-        unique_folders2 = [folders2[folder_name] for folder_name in folders2 if folder_name not in folders1]
-        self.unique_folders_backup.extend(unique_folders2)
+        # Decisions are read from the results while the tables are disabled
+        self.progress_bar.setValue(0)
+        delta_threshold = delta.delta_threshold if self.delta_checkbox.isChecked() else None
+        self.start_worker(BackupWorker(self.results, delta_threshold), self.backup_finished)
 
-        # Common folders (recursively compare)
-        common_folders = [(folders1[folder_name], folders2[folder_name]) for folder_name in folders1 if folder_name in folders2]
-        for folder1, folder2 in common_folders:
-            self.compare(folder1, folder2)
 
-    
-    def update_paths_tables(self):
+    def backup_finished(self):
         '''
-        Show paths for user decision in the UI
+        Restore the UI after the backup worker is done
         '''
 
-        # Update folders only in source directory table
-        self.folders_in_source_table.setRowCount(len(self.unique_folders_dir))
-        for i, folder in enumerate(self.unique_folders_dir):
-            self.create_table_item(i, folder, self.directory_path, self.folders_in_source_table, checked=True)
+        stats = self.worker.stats
+        self.worker = None
+        self.set_running(False)
+        if stats is not None:
+            saved = f', {stats["bytes_saved"] / 1e6:.1f} MB saved by delta copy' if stats['bytes_saved'] else ''
+            snapshot = f', snapshot {stats["snapshot"]["generation"]} taken' if stats.get('snapshot') else ''
+            self.analyzing_label.setText(f'Copied {stats["bytes"] / 1e6:.1f} MB in {stats["seconds"]:.1f} s '
+                                         f'({stats["bytes_per_second"] / 1e6:.1f} MB/s){saved}, {stats["failed"]} failed items{snapshot}')
 
-        # Update folders only in backup directory table
-        self.folders_in_backup_table.setRowCount(len(self.unique_folders_backup))
-        for i, folder in enumerate(self.unique_folders_backup):
-            self.create_table_item(i, folder, self.backup_path, self.folders_in_backup_table)
-        
-        # Update files only in source directory table
-        self.files_in_source_table.setRowCount(len(self.unique_files_dir))
-        for i, file in enumerate(self.unique_files_dir):
-            self.create_table_item(i, file, self.directory_path, self.files_in_source_table, checked=True)
 
-        # Update files only in backup directory table
-        self.files_in_backup_table.setRowCount(len(self.unique_files_backup))
-        for i, file in enumerate(self.unique_files_backup):
-            self.create_table_item(i, file, self.backup_path, self.files_in_backup_table)
+    def update_progress(self, percentage, message):
+        '''
+        Update progress bar and status label (connected to the progress signal of the workers)
+        '''
 
-        # Update files with different dates list
-        self.files_dates_table.setRowCount(len(self.different_dates))
-        for i, file in enumerate(self.different_dates):
-            self.create_table_item_date(i, file[0], self.directory_path, file[2], file[3])
+        self.progress_bar.setValue(percentage)
+        if message:
+            self.analyzing_label.setText(message)
 
 
-    def create_table_item(self, row, file_path, base_path, table, checked=False):
+    def start_worker(self, worker, on_finished):
         '''
-        Create basic path table item for the UI, including icon, relative path and checkbox
+        Run a background worker, disabling the controls that would start another one
         '''
 
-        # System icon for the file
-        fileInfo = QFileInfo(str(file_path))
-        iconProvider = QFileIconProvider()
-        icon = iconProvider.icon(fileInfo)
+        self.worker = worker
+        worker.progress.connect(self.update_progress)
+        worker.error.connect(self.show_error)
+        worker.finished.connect(on_finished)
+        self.set_running(True)
+        worker.start()
 
-        # Relative path with zero-width space character after each letter (for word breaking purposes)
-        relative_path_str = ''.join([c + '\u200B' for c in str(file_path.relative_to(base_path))])
-        table.setItem(row, 0, QTableWidgetItem(icon, relative_path_str))
 
-        # Checkboxes
-        table.setCellWidget(row, 1, self.centered_checkbox(True))
-        table.setCellWidget(row, 2, self.centered_checkbox(checked))
+    def show_error(self, message):
+        '''
+        Report the error that stopped a worker (connected to the error signal of the workers), whose finished handler then restores the controls
+        '''
 
+        QMessageBox.warning(self, 'Error', message)
 
-    def centered_checkbox(self, checked=True):
+
+    def set_running(self, running):
         '''
-        Centered checkbox widget
+        Enable or disable the controls while a worker is running
         '''
-        widget = QWidget()
-        layout = QHBoxLayout(widget)
-        layout.setAlignment(Qt.AlignCenter)
-        layout.setContentsMargins(0, 0, 0, 0)
-        checkbox = QCheckBox()
-        checkbox.setChecked(checked)
-        layout.addWidget(checkbox)
-        return widget
-    
 
-    def create_table_item_date(self, row, file_path, base_path, date_edited1, date_edited2):
+        self.analyze_button.setEnabled(not running)
+        self.backup_button.setEnabled(not running and self.analyzed)
+        self.cancel_button.setEnabled(running)
+        for table in [self.folders_in_source_table, self.folders_in_backup_table, self.files_in_source_table, self.files_in_backup_table, self.files_dates_table,
+                      self.renames_table]:
+            table.setEnabled(not running)
+
+
+    def cancel(self):
         '''
-        Create path table item to compare dates modified
+        Ask the running worker to stop
         '''
 
-        # System icon for the file
-        fileInfo = QFileInfo(str(file_path))
-        iconProvider = QFileIconProvider()
-        icon = iconProvider.icon(fileInfo)
+        if self.worker is not None:
+            self.worker.cancel()
 
-        # Relative path with zero-width space character after each letter (for word breaking purposes)
-        relative_path_str = ''.join([c + '\u200B' for c in str(file_path.relative_to(base_path))])
-        self.files_dates_table.setItem(row, 0, QTableWidgetItem(icon, relative_path_str))
 
-        # Check the checkbox corresponding to the most recent date
-        checked = date_edited1 > date_edited2
+    def closeEvent(self, event):
+        '''
+        Stop the running worker before closing the window
+        '''
 
-        # Checkboxes
-        self.files_dates_table.setCellWidget(row, 1, self.centered_checkbox(checked))
-        self.files_dates_table.setCellWidget(row, 2, self.centered_checkbox(checked))
-        self.files_dates_table.setCellWidget(row, 4, self.centered_checkbox(not checked))
-        self.files_dates_table.setCellWidget(row, 5, self.centered_checkbox(not checked))
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+        super().closeEvent(event)
 
-        # Dates (most recent in bold)
-        date_dt1 = datetime.fromtimestamp(date_edited1, timezone(timedelta(hours=1)))
-        self.files_dates_table.setItem(row, 3, QTableWidgetItem(date_dt1.strftime("%d/%m/%Y %H:%M")))
-        font1 = QFont()
-        font1.setBold(checked)
-        self.files_dates_table.item(row, 3).setFont(font1)
 
-        date_dt2 = datetime.fromtimestamp(date_edited2, timezone(timedelta(hours=1)))
-        self.files_dates_table.setItem(row, 6, QTableWidgetItem(date_dt2.strftime("%d/%m/%Y %H:%M")))
-        font2 = QFont()
-        font2.setBold(not checked)
-        self.files_dates_table.item(row, 6).setFont(font2)
-    
-    
-    def backup(self):
+
+class Worker(QThread):
+    '''
+    Base class for background operations, reporting throttled progress through a queued signal.
+    Subclasses implement work(); any error it raises is reported through the error signal instead of reaching Qt
+    '''
+
+    progress = pyqtSignal(int, str) # percentage, message
+    error = pyqtSignal(str) # message
+
+    def __init__(self):
+        super().__init__()
+        self.last_report = 0
+
+
+    def run(self):
+        try:
+            self.work()
+        except Exception as error: # an exception escaping a QThread aborts the whole application
+            self.error.emit(str(error) or type(error).__name__)
+
+
+    def work(self):
+        raise NotImplementedError
+
+
+    def report(self, fraction, message='', force=False):
         '''
-        Perform copy of selected items and delete unselected items
-        '''
-
-        # Initialize item counter for progress bar
-        total_items = len(self.unique_folders_dir) + len(self.unique_folders_backup) + len(self.unique_files_dir) + len(self.unique_files_backup) + len(self.different_dates)
-        processed_items = 0
-
-        # Folders in source directory only
-        #  checked = [keep in source, copy to backup]
-        for i, folder in enumerate(self.unique_folders_dir):
-            checked = [self.folders_in_source_table.cellWidget(i, col).findChild(QCheckBox).isChecked() for col in [1, 2]]
-            try:
-                if checked[1]:
-                    relative_path = folder.relative_to(self.directory_path) # copy folder to backup
-                    destination_path = self.backup_path / relative_path
-                    shutil.copytree(folder, destination_path)
-                if not checked[0]:
-                    shutil.rmtree(folder) # remove folder from source
-            except PermissionError:
-                print(f'Permission error on {str(folder)}')
-            processed_items += 1
-            self.update_progress(processed_items, total_items)  
-
-        # Folders in backup directory only
-        #  checked = [keep in backup, copy to source]
-        for i, folder in enumerate(self.unique_folders_backup):
-            checked = [self.folders_in_backup_table.cellWidget(i, col).findChild(QCheckBox).isChecked() for col in [1, 2]]
-            try:
-                if checked[1]:
-                    relative_path = folder.relative_to(self.backup_path) # copy folder to source
-                    destination_path = self.directory_path / relative_path
-                    shutil.copytree(folder, destination_path)
-                if not checked[0]:
-                    shutil.rmtree(folder)
-            except PermissionError:
-                print(f'Permission error on {str(folder)}')
-            processed_items += 1
-            self.update_progress(processed_items, total_items) 
-        
-        # Files in source directory only
-        #  checked = [keep in source, copy to backup]
-        for i, file in enumerate(self.unique_files_dir):
-            checked = [self.files_in_source_table.cellWidget(i, col).findChild(QCheckBox).isChecked() for col in [1, 2]]
-            try:
-                if checked[1]:
-                    relative_path = file.relative_to(self.directory_path) # copy file to backup
-                    destination_path = self.backup_path / relative_path.parent
-                    shutil.copy2(file, destination_path) 
-                if not checked[0]:
-                    os.remove(file) # remove file from source
-            except PermissionError:
-                print(f'Permission error on {str(file)}')
-            processed_items += 1
-            self.update_progress(processed_items, total_items)    
-
-        # Files in backup directory only
-        #  checked = [keep in backup, copy to source]
-        for i, file in enumerate(self.unique_files_backup):
-            checked = [self.files_in_backup_table.cellWidget(i, col).findChild(QCheckBox).isChecked() for col in [1, 2]]
-            try:
-                if checked[1]:
-                    relative_path = file.relative_to(self.backup_path) # copy file to source
-                    destination_path = self.directory_path / relative_path.parent
-                    shutil.copy2(file, destination_path)
-                if not checked[0]:
-                    os.remove(file) # remove file from backup
-            except PermissionError:
-                print(f'Permission error on {str(file)}')
-            processed_items += 1
-            self.update_progress(processed_items, total_items) 
-
-        # Files with different dates edited
-        #  checked = [keep in source, copy to backup, keep in backup, copy to source]
-        for i, file in enumerate(self.different_dates):
-            path1, path2, date1, date2 = file
-            checked = [self.files_dates_table.cellWidget(i, col).findChild(QCheckBox).isChecked() for col in [1, 2, 4, 5]]
-
-            try:
-                if [checked[0], checked[1], checked[3]] == [False, False, False]:
-                    os.remove(path1)
-                    if not checked[2]: 
-                        os.remove(path2)
-                elif checked == [True, False, False, False]:
-                    os.remove(path2)
-                elif [checked[0], checked[1], checked[3]] == [False, False, True]:
-                    os.remove(path1)
-                    directory1, filename1 = os.path.split(path1)
-                    directory2, filename2 = os.path.split(path2)
-                    new_path2 = os.path.join(directory1, filename2)
-                    shutil.copy2(path2, new_path2)
-                    if not checked[2]:
-                        os.remove(path2)
-                elif checked[1:] == [True, False, False]:
-                    os.remove(path2)
-                    directory1, filename1 = os.path.split(path1)
-                    directory2, filename2 = os.path.split(path2)
-                    new_path1 = os.path.join(directory2, filename1)
-                    shutil.copy2(path1, new_path1)
-                    if not checked[0]:
-                        os.remove(path1)
-                elif checked[1:] == [True, True, False]:
-                    date_dt1 = datetime.fromtimestamp(date1, timezone(timedelta(hours=1)))
-                    date_suffix1 = date_dt1.strftime("%Y-%m-%d_%H-%M")
-                    directory1, filename1 = os.path.split(path1)
-                    new_filename1 = f"{os.path.splitext(filename1)[0]}_{date_suffix1}{os.path.splitext(filename1)[1]}"
-                    date_dt2 = datetime.fromtimestamp(date2, timezone(timedelta(hours=1)))
-                    date_suffix2 = date_dt2.strftime("%Y-%m-%d_%H-%M")
-                    directory2, filename2 = os.path.split(path2)
-                    new_filename2 = f"{os.path.splitext(filename2)[0]}_{date_suffix2}{os.path.splitext(filename2)[1]}"
-                    new_path1 = os.path.join(directory2, new_filename1)
-                    new_path2 = os.path.join(directory2, new_filename2)
-                    os.rename(path2, new_path2)
-                    shutil.copy2(path1, new_path1)
-                    if not checked[0]:
-                        os.remove(path1)
-                elif [checked[0], checked[1], checked[3]] == [True, False, True]:
-                    date_dt1 = datetime.fromtimestamp(date1, timezone(timedelta(hours=1)))
-                    date_suffix1 = date_dt1.strftime("%Y-%m-%d_%H-%M")
-                    directory1, filename1 = os.path.split(path1)
-                    new_filename1 = f"{os.path.splitext(filename1)[0]}_{date_suffix1}{os.path.splitext(filename1)[1]}"
-                    date_dt2 = datetime.fromtimestamp(date2, timezone(timedelta(hours=1)))
-                    date_suffix2 = date_dt2.strftime("%Y-%m-%d_%H-%M")
-                    directory2, filename2 = os.path.split(path2)
-                    new_filename2 = f"{os.path.splitext(filename2)[0]}_{date_suffix2}{os.path.splitext(filename2)[1]}"
-                    new_path1 = os.path.join(directory1, new_filename1)
-                    new_path2 = os.path.join(directory1, new_filename2)
-                    os.rename(path1, new_path1)
-                    shutil.copy2(path2, new_path2)
-                    if not checked[2]:
-                        os.remove(path2)
-                elif [checked[0], checked[1], checked[3]] == [True, True, True]:
-                    date_dt1 = datetime.fromtimestamp(date1, timezone(timedelta(hours=1)))
-                    date_suffix1 = date_dt1.strftime("%Y-%m-%d_%H-%M")
-                    directory1, filename1 = os.path.split(path1)
-                    new_filename1 = f"{os.path.splitext(filename1)[0]}_{date_suffix1}{os.path.splitext(filename1)[1]}"
-                    date_dt2 = datetime.fromtimestamp(date2, timezone(timedelta(hours=1)))
-                    date_suffix2 = date_dt2.strftime("%Y-%m-%d_%H-%M")
-                    directory2, filename2 = os.path.split(path2)
-                    new_filename2 = f"{os.path.splitext(filename2)[0]}_{date_suffix2}{os.path.splitext(filename2)[1]}"
-                    new_path1_dir = os.path.join(directory1, new_filename1)
-                    new_path2_dir = os.path.join(directory1, new_filename2)
-                    os.rename(path1, new_path1_dir)
-                    shutil.copy2(path2, new_path2_dir)
-                    if checked[2]:
-                        new_path1_bk = os.path.join(directory2, new_filename1)
-                        new_path2_bk = os.path.join(directory2, new_filename2)
-                        shutil.copy2(new_path1_dir, new_path1_bk)
-                        os.rename(path2, new_path2_bk)
-                    else:
-                        shutil.copy2(new_path1_dir, path2)
-                elif checked == [False, True, False, True]:
-                    temp_path = path1.with_name('temp')
-                    shutil.move(path1, temp_path)
-                    shutil.move(path2, path1)
-                    shutil.move(temp_path, path2)
-                elif checked == [False, True, True, True]:
-                    date_dt1 = datetime.fromtimestamp(date1, timezone(timedelta(hours=1)))
-                    date_suffix1 = date_dt1.strftime("%Y-%m-%d_%H-%M")
-                    directory1, filename1 = os.path.split(path1)
-                    new_filename1 = f"{os.path.splitext(filename1)[0]}_{date_suffix1}{os.path.splitext(filename1)[1]}"
-                    date_dt2 = datetime.fromtimestamp(date2, timezone(timedelta(hours=1)))
-                    date_suffix2 = date_dt2.strftime("%Y-%m-%d_%H-%M")
-                    directory2, filename2 = os.path.split(path2)
-                    new_filename2 = f"{os.path.splitext(filename2)[0]}_{date_suffix2}{os.path.splitext(filename2)[1]}"
-                    new_path1_bk = os.path.join(directory2, new_filename1)
-                    new_path2_dir = os.path.join(directory1, filename2)
-                    new_path2_bk = os.path.join(directory2, new_filename2)
-                    shutil.copy2(path1, new_path1_bk)
-                    os.remove(path1)
-                    shutil.copy2(path2, new_path2_dir)
-                    os.rename(path2, new_path2_bk)
-            except PermissionError:
-                print(f'Permission error on {str(path1)}')
-
-            processed_items += 1
-            self.update_progress(processed_items, total_items) 
-
-
-    def update_progress(self, processed, total):
-        '''
-        Update progress bar
-        '''
-
-        progress_percentage = int((processed / total) * 100)
-        self.progress_bar.setValue(progress_percentage)
-        QApplication.processEvents()
+        Emit progress, at most once every progress_interval seconds unless forced
+        '''
+
+        now = time.monotonic()
+        if force or now - self.last_report >= progress_interval:
+            self.last_report = now
+            self.progress.emit(int(fraction * 100), message)
+
+
+    def cancel(self):
+        self.requestInterruption()
+
+
+
+class AnalyzeWorker(Worker):
+    '''
+    Compare source and backup directory in the background
+    '''
+
+    def __init__(self, directory_path, backup_path, incremental=False, verify_content=False):
+        super().__init__()
+        self.directory_path = directory_path
+        self.backup_path = backup_path
+        self.incremental = incremental
+        self.verify_content = verify_content
+        self.results = None
+
+
+    def work(self):
+        self.results = engine.analyze(self.directory_path, self.backup_path, engine.scan_workers, self.incremental, self.verify_content, 
+                                      self.report, self.isInterruptionRequested)
+
+
+
+class BackupWorker(Worker):
+    '''
+    Apply the user decisions to the source and backup directories in the background
+    '''
+
+    def __init__(self, results, delta_threshold=None):
+        super().__init__()
+        self.results = results
+        self.delta_threshold = delta_threshold
+        self.stats = None
+
+
+    def work(self):
+        self.stats = engine.apply(self.results, self.report, self.isInterruptionRequested, delta_threshold=self.delta_threshold)
+        self.report(1, force=True)
+
+
+
+class ResumeWorker(Worker):
+    '''
+    Finish an interrupted backup from its journal in the background
+    '''
+
+    def __init__(self, backup_path):
+        super().__init__()
+        self.backup_path = backup_path
+        self.stats = None
+
+
+    def work(self):
+        self.stats = engine.resume(self.backup_path, self.report, self.isInterruptionRequested)
+        self.report(1, force=True)
+
 
 
 
 
 if __name__ == '__main__':
-    myappid = u'mycompany.myproduct.subproduct.version' # arbitrary string to make the app icon correctly show in the taskbar
-    ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
+    if sys.platform == 'win32':
+        myappid = u'mycompany.myproduct.subproduct.version' # arbitrary string to make the app icon correctly show in the taskbar
+        ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID(myappid)
 
     app = QApplication(sys.argv)
     app.setWindowIcon(QIcon('icons/keep_in_source.png'))
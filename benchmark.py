@@ -0,0 +1,268 @@
+import argparse
+import engine
+import json
+import os
+from pathlib import Path
+import plan
+import platform
+import profiling
+import random
+from results import ComparisonResults
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# Synthetic source and backup trees: number of files, folder depth and fan-out, file sizes (log-normal around the median, capped)
+# and share of the files and folders differing between the two sides
+SCENARIOS = {
+    'small': {'files': 2000, 'depth': 3, 'fanout': 4, 'median_size': 4 * 1024, 'max_size': 1024 * 1024, 'divergence': 0.1},
+    'many-files': {'files': 20000, 'depth': 4, 'fanout': 6, 'median_size': 1024, 'max_size': 64 * 1024, 'divergence': 0.05},
+    'large-files': {'files': 16, 'depth': 1, 'fanout': 2, 'median_size': 8 * 1024 * 1024, 'max_size': 32 * 1024 * 1024, 'divergence': 0.5},
+}
+BENCHMARKS = ['compare', 'compare_incremental', 'results', 'backup']
+# Scenario parameters that can be set from the command line, with their type and description
+PARAMETERS = {
+    'files': (int, 'number of files'),
+    'depth': (int, 'folder depth'),
+    'fanout': (int, 'subfolders per folder'),
+    'median_size': (int, 'median file size in bytes'),
+    'max_size': (int, 'largest file size in bytes'),
+    'divergence': (float, 'share of the files and folders differing between the two sides, from 0 to 1'),
+}
+
+size_sigma = 1.5 # spread of the file sizes around the median (log-normal sigma)
+block_size = 1024 * 1024 # random data shared by all generated files, written from a random offset
+tolerance = 0.25 # relative slowdown over a baseline reported as a regression
+min_regression_seconds = 0.05 # slowdowns smaller than this are noise whatever their ratio
+check_repeats = 5 # fewest runs of each benchmark compared by --check
+results_rows = 10 # rows added to the results tables per file of the scenario
+rows_per_folder = 100
+
+
+
+def write_file(path, size, block, rng, mtime):
+    '''
+    Write size bytes taken from the random block, with the given date modified (in seconds)
+    '''
+
+    with open(path, 'wb') as file:
+        while size > 0:
+            offset = rng.randrange(len(block))
+            chunk = block[offset:offset + size]
+            file.write(chunk)
+            size -= len(chunk)
+    os.utime(path, (mtime, mtime))
+
+
+def generate_tree(root, files, depth, fanout, median_size, max_size, rng, block):
+    '''
+    Create a tree of folders fanout wide and depth deep, with files spread over all the folders.
+    Return the relative paths of the files and of the leaf folders
+    '''
+
+    folders = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [f'{parent}/d{i}' if parent else f'd{i}' for parent in level for i in range(fanout)]
+        folders += level
+    for folder in folders:
+        (root / folder).mkdir(parents=True, exist_ok=True)
+    now = int(time.time())
+    paths = []
+    for i in range(files):
+        folder = rng.choice(folders)
+        relative = f'{folder}/f{i}.bin' if folder else f'f{i}.bin'
+        size = min(int(rng.lognormvariate(0, size_sigma) * median_size), max_size)
+        write_file(root / relative, size, block, rng, now - rng.randrange(365 * 86400))
+        paths.append(relative)
+    return paths, level if depth else []
+
+
+def generate_pair(path, scenario, seed=0):
+    '''
+    Create a source tree and a backup of it under path, then make the two sides diverge:
+    some files are edited in the source, some only exist on one side, and some leaf folders are missing from the backup.
+    Return (source, backup, number of differences of each kind)
+    '''
+
+    rng = random.Random(seed)
+    block = rng.randbytes(block_size)
+    source = Path(path) / 'source'
+    backup = Path(path) / 'backup'
+    files, leaves = generate_tree(source, scenario['files'], scenario['depth'], scenario['fanout'], scenario['median_size'],
+                                  scenario['max_size'], rng, block)
+    shutil.copytree(source, backup)
+
+    divergence = scenario['divergence']
+    changes = {'edited': 0, 'source_only': 0, 'backup_only': 0, 'folders_source_only': 0}
+    now = int(time.time())
+    for relative in files:
+        if rng.random() >= divergence:
+            continue
+        change = rng.choice(['edited', 'source_only', 'backup_only'])
+        if change == 'edited':
+            size = min(int(rng.lognormvariate(0, size_sigma) * scenario['median_size']), scenario['max_size'])
+            write_file(source / relative, size, block, rng, now)
+        elif change == 'source_only':
+            (backup / relative).unlink()
+        else:
+            (source / relative).unlink()
+        changes[change] += 1
+    for relative in leaves:
+        if rng.random() < divergence:
+            shutil.rmtree(backup / relative)
+            changes['folders_source_only'] += 1
+    return source, backup, changes
+
+
+def measure(function, *args):
+    '''
+    Time a call with the counters of the run (see profiling), returning (seconds, counters, result)
+    '''
+
+    profile = profiling.start('benchmark')
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    finally:
+        seconds = time.perf_counter() - start
+        profiling.stop(profile)
+    return seconds, dict(profile.counters) if profile is not None else {}, result
+
+
+def bench_compare(source, backup, work):
+    return measure(engine.analyze, source, backup)
+
+
+def bench_compare_incremental(source, backup, work):
+    engine.analyze(source, backup) # records the folder listings in the index
+    return measure(engine.analyze, source, backup, engine.scan_workers, True)
+
+
+def fill_results(results, rows):
+    for i in range(rows):
+        results.unique_files_dir.append(f'folder{i // rows_per_folder}', f'file{i}.bin', i)
+    return sum(1 for _ in results.unique_files_dir) + sum(1 for _ in plan.build_plan(results))
+
+
+def bench_results(source, backup, work):
+    rows = sum(1 for _ in source.rglob('*')) * results_rows
+    return measure(fill_results, ComparisonResults(source, backup), rows)
+
+
+def bench_backup(source, backup, work):
+    # Apply the default decisions to a fresh copy of the trees, so every repeat copies the same data
+    work = Path(work)
+    shutil.rmtree(work, ignore_errors=True)
+    shutil.copytree(source, work / 'source')
+    shutil.copytree(backup, work / 'backup')
+    results = engine.analyze(work / 'source', work / 'backup')
+    seconds, counters, stats = measure(engine.apply, results)
+    counters.update(files=stats['files'], bytes=stats['bytes'], failed=stats['failed'])
+    return seconds, counters, stats
+
+
+def run(scenarios, benchmarks=BENCHMARKS, repeats=3, seed=0, work_dir=None, overrides=None):
+    '''
+    Generate the tree pair of each scenario and time each benchmark on it, keeping the median of the repeats.
+    overrides replaces some parameters (see PARAMETERS) of every scenario.
+    Return the report: for each scenario, its parameters, the differences generated and, for each benchmark, its seconds and counters
+    '''
+
+    report = {'python': platform.python_version(), 'platform': sys.platform, 'seed': seed, 'repeats': repeats, 'scenarios': {}}
+    if work_dir is not None:
+        Path(work_dir).mkdir(parents=True, exist_ok=True)
+    for name in scenarios:
+        scenario = {**SCENARIOS[name], **(overrides or {})}
+        with tempfile.TemporaryDirectory(prefix='smartbackup-benchmark-', dir=work_dir) as folder:
+            source, backup, changes = generate_pair(Path(folder) / 'pair', scenario, seed)
+            entry = report['scenarios'][name] = {'parameters': scenario, 'changes': changes, 'benchmarks': {}}
+            for benchmark in benchmarks:
+                function = globals()['bench_' + benchmark]
+                timings = []
+                for _ in range(repeats):
+                    seconds, counters, _ = function(source, backup, Path(folder) / 'work')
+                    timings.append(seconds)
+                entry['benchmarks'][benchmark] = {'seconds': round(statistics.median(timings), 6), 'min_seconds': round(min(timings), 6),
+                                                  'timings': [round(seconds, 6) for seconds in timings],
+                                                  'counters': dict(sorted(counters.items()))}
+                print(f'{name} {benchmark}: {statistics.median(timings):.3f} s', file=sys.stderr)
+    return report
+
+
+def median_seconds(result):
+    return statistics.median(result['timings']) if result.get('timings') else result['seconds']
+
+
+def regressions(report, baseline, tolerance=tolerance, min_seconds=min_regression_seconds):
+    '''
+    Compare a report with a baseline report, returning a message for each benchmark whose median over the repeats became slower
+    than the tolerance allows by min_seconds or more, and for each counter (syscalls, bytes, items) that grew.
+    Scenarios generated with other parameters than in the baseline are skipped
+    '''
+
+    messages = []
+    for name, scenario in report['scenarios'].items():
+        base_scenario = baseline['scenarios'].get(name)
+        if base_scenario is None:
+            continue
+        if base_scenario['parameters'] != scenario['parameters']:
+            print(f'{name}: parameters differ from the baseline, not compared', file=sys.stderr)
+            continue
+        for benchmark, result in scenario['benchmarks'].items():
+            base = base_scenario['benchmarks'].get(benchmark)
+            if base is None:
+                continue
+            seconds, base_seconds = median_seconds(result), median_seconds(base)
+            if seconds > base_seconds * (1 + tolerance) and seconds - base_seconds >= min_seconds:
+                messages.append(f'{name} {benchmark}: {seconds:.3f} s instead of {base_seconds:.3f} s ({seconds / base_seconds - 1:+.0%})')
+            for counter, value in result['counters'].items():
+                base_value = base['counters'].get(counter)
+                if base_value is not None and value > base_value:
+                    messages.append(f'{name} {benchmark}: {counter} {value} instead of {base_value}')
+    return messages
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py', description='Time the comparison engine, the results tables and the copy executor '
+                                     'on generated source and backup trees.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('--benchmark', action='append', choices=BENCHMARKS, help='benchmark to run, can be repeated (default: all)')
+    for parameter, (kind, description) in PARAMETERS.items():
+        parser.add_argument('--' + parameter.replace('_', '-'), type=kind, help=f'{description}, overriding the scenarios run')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of each benchmark, the median is kept '
+                        f'(default: %(default)s, at least {check_repeats} with --check)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated trees (default: %(default)s)')
+    parser.add_argument('--work-dir', type=Path, help='folder where the trees are generated (default: the temporary folder)')
+    parser.add_argument('--save', type=Path, help='save the report as a baseline in this file')
+    parser.add_argument('--check', type=Path, help='compare with a baseline saved by --save and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=tolerance, help='relative slowdown allowed by --check (default: %(default)s)')
+    parser.add_argument('--min-delta', type=float, default=min_regression_seconds,
+                        help='seconds a benchmark must lose before --check reports it (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    overrides = {parameter: getattr(args, parameter) for parameter in PARAMETERS if getattr(args, parameter) is not None}
+    repeats = max(args.repeats, check_repeats) if args.check is not None else args.repeats
+    report = run(args.scenario or list(SCENARIOS), args.benchmark or BENCHMARKS, repeats, args.seed, args.work_dir, overrides)
+    json.dump(report, sys.stdout, indent=1)
+    print()
+    if args.save is not None:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=1)
+    if args.check is not None:
+        with open(args.check, encoding='utf-8') as file:
+            baseline = json.load(file)
+        messages = regressions(report, baseline, args.tolerance, args.min_delta)
+        for message in messages:
+            print(f'Regression: {message}', file=sys.stderr)
+        return 1 if messages else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+import argparse
+import compressor
+import contextlib
+import delta
+import engine
+import executor
+import json
+from pathlib import Path
+import plan
+import profiling
+from results import COPY, COPY_TO_BACKUP, COPY_TO_SOURCE, KEEP, KEEP_BACKUP, KEEP_SOURCE, RENAME
+import rules
+import snapshots
+from store import Store
+import sys
+import time
+import watch
+
+# Result tables in the order they are applied, with the JSON names of their decision bits
+TABLES = [
+    ('unique_folders_dir', {'keep': KEEP, 'copy': COPY}),
+    ('unique_folders_backup', {'keep': KEEP, 'copy': COPY}),
+    ('unique_files_dir', {'keep': KEEP, 'copy': COPY}),
+    ('unique_files_backup', {'keep': KEEP, 'copy': COPY}),
+    ('renames', {'rename': RENAME}),
+    ('different_dates', {'keep_source': KEEP_SOURCE, 'copy_to_backup': COPY_TO_BACKUP, 'keep_backup': KEEP_BACKUP, 'copy_to_source': COPY_TO_SOURCE})]
+
+
+
+def item_json(table, i, bits=None):
+    '''
+    JSON object for one item of a result table, optionally with its decisions
+    '''
+
+    item = {'path': table.relative_path(i)}
+    if hasattr(table, 'dates1'):
+        item.update(date_source=table.dates1[i], date_backup=table.dates2[i], content_differs=bool(table.content[i]))
+    if hasattr(table, 'old_paths'):
+        item.update(backup_path=table.old_paths.relative_path(i), folder=bool(table.folder[i]))
+    if bits is not None:
+        item.update((name, bool(table.decisions[i] & bit)) for name, bit in bits.items())
+    return item
+
+
+def dump_results(results, file, decisions=False):
+    '''
+    Write the results as one JSON object, item by item so large results are never held twice in memory
+    '''
+
+    file.write('{"source": %s, "backup": %s' % (json.dumps(str(results.directory_path)), json.dumps(str(results.backup_path))))
+    for name, bits in TABLES:
+        table = getattr(results, name)
+        file.write(f', "{name}": [')
+        for i in range(len(table)):
+            if i:
+                file.write(', ')
+            file.write(json.dumps(item_json(table, i, bits if decisions else None)))
+        file.write(']')
+    file.write('}\n')
+
+
+def log_copy(path, backend, size):
+    print(f'{backend}\t{size}\t{str(path)}', file=sys.stderr)
+
+
+def warn_pending(backup_path):
+    if engine.pending_backup(backup_path) is not None:
+        print(f'Discarding the journal of an interrupted backup into {str(backup_path)} (see the resume command)', file=sys.stderr)
+
+
+def print_progress(fraction, message=''):
+    print(f'\r{fraction * 100:5.1f}%  {message}\033[K', end='', file=sys.stderr, flush=True)
+
+
+def add_progress_arguments(subparser):
+    subparser.add_argument('--progress', action='store_true', help='show the progress, rates and time left on standard error')
+    subparser.add_argument('--progress-log', type=Path, help='write progress snapshots to this file as JSON lines')
+
+
+def add_exclude_argument(subparser):
+    subparser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                           help=f'skip paths matching this gitignore pattern, added to the rules of the {rules.IGNORE_NAME} files (can be repeated)')
+
+
+def add_profile_arguments(subparser):
+    subparser.add_argument('--profile', action='store_true', help='also record the run with cProfile, next to its report in the backup location')
+    subparser.add_argument('--trace', action='store_true', help='also record the phases of the run as a Chrome trace (chrome://tracing, Perfetto)')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='cli.py', description='Compare and synchronize a directory with its backup, without the GUI.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, help in [('analyze', 'list the differences between the two directories'),
+                          ('plan', 'write the operations that apply the default decisions, one JSON object per line'),
+                          ('apply', 'analyze and apply the default decisions, or replay a saved plan')]:
+        subparser = subparsers.add_parser(command, help=help)
+        optional = '?' if command == 'apply' else None # a saved plan already names both directories, these override them
+        subparser.add_argument('source', type=Path, nargs=optional, help='directory to backup')
+        subparser.add_argument('backup', type=Path, nargs=optional, help='backup location')
+        subparser.add_argument('--workers', type=int, default=engine.scan_workers, help='folders listed in parallel (default: %(default)s)')
+        subparser.add_argument('--incremental', action='store_true', help='skip folders unchanged since the last analysis')
+        subparser.add_argument('--verify-content', action='store_true', help='compare file contents, not only dates modified')
+        add_exclude_argument(subparser)
+        subparser.add_argument('--no-renames', action='store_true', help='do not look for files and folders renamed or moved in the source')
+        if command == 'analyze':
+            subparser.add_argument('--decisions', action='store_true', help='include the default decisions for each difference')
+        else:
+            subparser.add_argument('--delta', action='store_true', help=f'update files of {delta.delta_threshold // 2**20} MiB or more in place, '
+                                                                          'only rewriting the blocks that changed')
+        if command == 'plan':
+            subparser.add_argument('-o', '--output', type=Path, help='plan file to write (default: standard output)')
+        elif command == 'apply':
+            subparser.add_argument('--plan', type=Path, help='plan file written by the plan command, applied without a new analysis')
+            subparser.add_argument('--dry-run', action='store_true', help='only report the operations and bytes to copy')
+            subparser.add_argument('--copy-workers', type=int, default=executor.copy_workers, help='items copied in parallel (default: %(default)s)')
+            subparser.add_argument('--verbose', action='store_true', help='print each file copied with the copy backend used to standard error')
+            add_progress_arguments(subparser)
+        add_profile_arguments(subparser)
+    subparser = subparsers.add_parser('resume', help='finish a backup that was interrupted, from its journal in the backup location')
+    subparser.add_argument('backup', type=Path, help='backup location')
+    subparser.add_argument('--copy-workers', type=int, default=executor.copy_workers, help='items copied in parallel (default: %(default)s)')
+    subparser.add_argument('--verbose', action='store_true', help='print each file copied with the copy backend used to standard error')
+    add_progress_arguments(subparser)
+    add_profile_arguments(subparser)
+    subparser = subparsers.add_parser('init-store', help='start a deduplicating store in an empty backup location, used by every later command')
+    subparser.add_argument('backup', type=Path, help='backup location')
+    subparser = subparsers.add_parser('snapshot', help='take a generation of the backup now, and after each backup from then on')
+    subparser.add_argument('backup', type=Path, help='backup location')
+    subparser.add_argument('--keep-last', type=int, metavar='N', help=f'keep the N most recent generations (default: {snapshots.retention["last"]})')
+    for period, unit in [('daily', 'day'), ('weekly', 'week'), ('monthly', 'month')]:
+        subparser.add_argument(f'--keep-{period}', type=int, metavar='N', help=f'also keep the last generation of each {unit} '
+                                                                               f'for the N most recent {unit}s (default: {snapshots.retention[period]})')
+    subparser.add_argument('--min-interval', type=float, metavar='SECONDS', help='seconds between two snapshots taken after a backup '
+                                                                                 f'(default: {snapshots.retention["min_interval"]:g})')
+    subparser.add_argument('--list', action='store_true', help='only list the generations and the retention policy')
+    subparser.add_argument('--disable', action='store_true', help='stop taking snapshots after each backup, keeping the generations')
+    subparser = subparsers.add_parser('compress', help='compress the files copied to the backup from now on')
+    subparser.add_argument('backup', type=Path, help='backup location')
+    subparser.add_argument('--codec', choices=['gzip', 'zstd'], help='compression format (default: zstd when the zstandard package is installed, '
+                                                                    'otherwise gzip)')
+    subparser.add_argument('--level', type=int, help='compression level (default: '
+                                                     f'{", ".join(f"{codec} {level}" for codec, level in compressor.default_levels.items())})')
+    subparser.add_argument('--skip', action='append', default=[], metavar='EXTENSION', help='also copy files with this extension '
+                                                                                            'as they are (repeatable, added to the formats already compressed)')
+    subparser.add_argument('--show', action='store_true', help='only show the compression settings')
+    subparser.add_argument('--disable', action='store_true', help='copy files as they are from now on, files already compressed are still read back')
+    subparser = subparsers.add_parser('restore', help='write the files of a store to a folder')
+    subparser.add_argument('backup', type=Path, help='backup location holding a store')
+    subparser.add_argument('target', type=Path, help='folder to write the files to')
+    subparser.add_argument('--path', default='', help='folder or file of the backup tree to restore, relative to its root (default: everything)')
+    add_exclude_argument(subparser)
+    add_progress_arguments(subparser)
+    add_profile_arguments(subparser)
+    subparser = subparsers.add_parser('watch', help='keep the backup in sync, comparing only the folders that change (until interrupted)')
+    subparser.add_argument('source', type=Path, help='directory to backup')
+    subparser.add_argument('backup', type=Path, help='backup location')
+    subparser.add_argument('--verify-content', action='store_true', help='compare file contents, not only dates modified')
+    add_exclude_argument(subparser)
+    subparser.add_argument('--delta', action='store_true', help=f'update files of {delta.delta_threshold // 2**20} MiB or more in place, '
+                                                                  'only rewriting the blocks that changed')
+    subparser.add_argument('--copy-workers', type=int, default=executor.copy_workers, help='items copied in parallel (default: %(default)s)')
+    subparser.add_argument('--debounce', type=float, default=watch.debounce, help='seconds without changes before they are synchronized '
+                                                                                  '(default: %(default)s)')
+    subparser.add_argument('--poll', action='store_true', help='find changes by listing the source periodically instead of using inotify')
+    subparser.add_argument('--verbose', action='store_true', help='print each file copied with the copy backend used to standard error')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'watch':
+        return run_watch(args)
+    if args.command == 'init-store':
+        return run_init_store(args)
+    if args.command == 'snapshot':
+        return run_snapshot(args)
+    if args.command == 'compress':
+        return run_compress(args)
+    progress_log = getattr(args, 'progress_log', None)
+
+    # The whole command is profiled as one run, reported in the backup location
+    options = {name: str(value) if isinstance(value, Path) else value for name, value in vars(args).items()}
+    profile = profiling.start(args.command, options, args.profile or None, args.trace or None)
+    with open(progress_log, 'w', encoding='utf-8') if progress_log else contextlib.nullcontext() as progress_log:
+        try:
+            return run(args, print_progress if getattr(args, 'progress', False) else engine.ignore_progress, progress_log)
+        finally:
+            if getattr(args, 'progress', False):
+                print(file=sys.stderr)
+            if args.backup is not None and args.backup.is_dir():
+                profiling.finish(profile, args.backup)
+
+
+def run_watch(args):
+    for path in [args.source, args.backup]:
+        if not path.is_dir():
+            print(f'Not a directory: {str(path)}', file=sys.stderr)
+            return 2
+
+    # One line of statistics per synchronization, each run also saving its reports in the backup location
+    def print_stats(stats):
+        json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'), **stats}, sys.stdout)
+        print(flush=True)
+
+    try:
+        watch.watch(args.source, args.backup, print_stats, verify_content=args.verify_content, workers=args.copy_workers,
+                    log=log_copy if args.verbose else None, delta_threshold=delta.delta_threshold if args.delta else None, polling=args.poll,
+                    debounce=args.debounce, exclude=args.exclude)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def run_init_store(args):
+    # The store is then compared and applied like a plain backup by every other command
+    if not args.backup.is_dir():
+        print(f'Not a directory: {str(args.backup)}', file=sys.stderr)
+        return 2
+    try:
+        Store.create(args.backup).close()
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 2
+    return 0
+
+
+def run_snapshot(args):
+    if not args.backup.is_dir():
+        print(f'Not a directory: {str(args.backup)}', file=sys.stderr)
+        return 2
+    output = {'backup': str(args.backup)}
+    if args.disable:
+        snapshots.disable(args.backup)
+    elif not args.list:
+        try:
+            snapshots.enable(args.backup, last=args.keep_last, daily=args.keep_daily, weekly=args.keep_weekly, monthly=args.keep_monthly,
+                             min_interval=args.min_interval)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 2
+        output.update(snapshots.snapshot(args.backup) or {})
+    output.update(enabled=snapshots.enabled(args.backup), retention=snapshots.read_policy(args.backup), generations=snapshots.generations(args.backup))
+    json.dump(output, sys.stdout)
+    print()
+    return 0
+
+
+def run_compress(args):
+    if not args.backup.is_dir():
+        print(f'Not a directory: {str(args.backup)}', file=sys.stderr)
+        return 2
+    if args.disable:
+        compressor.disable(args.backup)
+    elif not args.show:
+        try:
+            compressor.enable(args.backup, args.codec, args.level, args.skip)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return 2
+    json.dump({'backup': str(args.backup), 'settings': compressor.read_settings(args.backup), 'codecs': compressor.codecs()}, sys.stdout)
+    print()
+    return 0
+
+
+def run(args, progress, progress_log):
+    start = time.monotonic()
+    log = log_copy if getattr(args, 'verbose', False) else None
+
+    # Interrupted backup: finish applying its journaled plan
+    if args.command == 'resume':
+        header = engine.pending_backup(args.backup)
+        if header is None:
+            print(f'No interrupted backup in {str(args.backup)}', file=sys.stderr)
+            return 2
+        stats = engine.resume(args.backup, progress, workers=args.copy_workers, log=log, progress_log=progress_log)
+        json.dump({'source': header['source'], 'backup': header['backup'], **stats}, sys.stdout)
+        print()
+        return 0
+
+    # Files of a store written back to a folder
+    if args.command == 'restore':
+        if not Store.exists(args.backup):
+            print(f'No store in {str(args.backup)}', file=sys.stderr)
+            return 2
+        try:
+            stats = engine.restore(args.backup, args.target, args.path.strip('/'), progress, args.exclude)
+        except FileNotFoundError:
+            print(f'Not in the store: {args.path}', file=sys.stderr)
+            return 2
+        json.dump({'backup': str(args.backup), 'target': str(args.target), 'path': args.path, **stats}, sys.stdout)
+        print()
+        return 0
+
+    # Saved plan: nothing is scanned, and the directories come from its header unless given on the command line
+    if args.command == 'apply' and args.plan is not None:
+        if not args.plan.is_file():
+            print(f'Not a file: {str(args.plan)}', file=sys.stderr)
+            return 2
+        try:
+            with open(args.plan, encoding='utf-8') as file:
+                header, operations = plan.read_plan(file)
+                source = args.source or Path(header['source'])
+                backup = args.backup = args.backup or Path(header['backup'])
+                exclude = header.get('exclude', []) + args.exclude
+                if args.dry_run:
+                    summary = engine.dry_run(operations, source, backup, exclude)
+                    summary['seconds'] = round(time.monotonic() - start, 3)
+                else:
+                    warn_pending(backup)
+                    summary = engine.execute_plan(operations, source, backup, header['items'], progress, workers=args.copy_workers, log=log,
+                                                  progress_log=progress_log, exclude=exclude)
+        except ValueError as error: # invalid plan, rejected before anything is applied
+            print(f'Cannot apply {str(args.plan)}: {error}', file=sys.stderr)
+            return 2
+        json.dump({'source': str(source), 'backup': str(backup), **summary}, sys.stdout)
+        print()
+        return 0
+
+    for path in [args.source, args.backup]:
+        if path is None or not path.is_dir():
+            print(f'Not a directory: {str(path)}', file=sys.stderr)
+            return 2
+
+    results = engine.analyze(args.source, args.backup, args.workers, args.incremental, args.verify_content, exclude=args.exclude,
+                             find_renames=not args.no_renames)
+    delta_threshold = delta.delta_threshold if args.command != 'analyze' and args.delta else None
+    if args.command == 'analyze':
+        with profiling.span('output'):
+            dump_results(results, sys.stdout, decisions=args.decisions)
+    elif args.command == 'plan':
+        operations = plan.build_plan(results, delta_threshold)
+        with profiling.span('output'):
+            if args.output is None:
+                plan.write_plan(operations, sys.stdout, args.source, args.backup, len(results), results.exclude)
+            else:
+                with open(args.output, 'w', encoding='utf-8') as file:
+                    plan.write_plan(operations, file, args.source, args.backup, len(results), results.exclude)
+    elif args.dry_run:
+        summary = engine.dry_run(plan.build_plan(results, delta_threshold), args.source, args.backup, results.exclude)
+        json.dump({'source': str(args.source), 'backup': str(args.backup), **summary, 'seconds': round(time.monotonic() - start, 3)}, sys.stdout)
+        print()
+    else:
+        warn_pending(args.backup)
+        stats = engine.apply(results, progress, workers=args.copy_workers, log=log, delta_threshold=delta_threshold, progress_log=progress_log)
+        stats['seconds'] = round(time.monotonic() - start, 3) # including the analysis
+        json.dump({'source': str(args.source), 'backup': str(args.backup), **stats}, sys.stdout)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,354 @@
+import contextlib
+import copying
+import hashlib
+import json
+import os
+from pathlib import Path
+import profiling
+from scanner import METADATA_PREFIX, scan_directory
+import shutil
+import sqlite3
+from store import Store
+import struct
+import threading
+import zlib
+try:
+    import zstandard
+except ImportError: # optional, gzip is always available
+    zstandard = None
+
+SETTINGS_NAME = METADATA_PREFIX + '-compression.json' # compression settings of a backup location, compressing new copies while present
+METADATA_NAME = METADATA_PREFIX + '-compression.sqlite' # what the header of each file of the backup says, while it is unchanged
+chunk_size = 1024 * 1024 # bytes read at once when compressing or decompressing
+default_levels = {'gzip': 6, 'zstd': 3}
+
+# Start of the header of a compressed file, followed by its original size (8 bytes) and digest (20 bytes):
+# a gzip extra field with the subfield SB, or a zstd skippable frame starting with SMBK, both ignored by zcat and zstdcat
+PREFIXES = {'gzip': b'\x1f\x8b\x08\x04\0\0\0\0\0\xff' + struct.pack('<H', 32) + b'SB' + struct.pack('<H', 28),
+            'zstd': struct.pack('<II', 0x184D2A50, 32) + b'SMBK'}
+HEADER_SIZE = max(len(prefix) for prefix in PREFIXES.values()) + 28
+
+# Extensions of formats that are already compressed, copied as they are
+SKIP = ['7z', 'aac', 'apk', 'avi', 'br', 'bz2', 'docx', 'epub', 'flac', 'gif', 'gz', 'heic', 'jar', 'jpeg', 'jpg', 'lz4', 'm4a', 'm4v', 'mkv',
+        'mov', 'mp3', 'mp4', 'odp', 'ods', 'odt', 'ogg', 'opus', 'pdf', 'png', 'pptx', 'rar', 'tgz', 'webm', 'webp', 'xlsx', 'xz', 'zip', 'zst']
+
+
+
+def codecs():
+    '''
+    Codecs available on this system
+    '''
+
+    return ['gzip', 'zstd'] if zstandard is not None else ['gzip']
+
+
+def compressor(codec, level):
+    '''
+    Streaming compressor of a codec, with compress(bytes) and flush() methods (raw deflate for gzip, whose header is written apart)
+    '''
+
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+
+def flush_block(codec, stream):
+    '''
+    Compressed data of everything given to a compressor so far, without ending the stream
+    '''
+
+    return stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK if codec == 'zstd' else zlib.Z_SYNC_FLUSH)
+
+
+def decompressor(codec):
+    if codec not in codecs():
+        raise ValueError(f'Cannot decompress {codec} files (zstd needs the zstandard package)')
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31) # 31: gzip container, whose extra field is skipped
+
+
+def identify(path):
+    '''
+    (codec, original size, digest) read from the header of a file written by Compression.write, or None for any other file
+    '''
+
+    with open(path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+    for codec, prefix in PREFIXES.items():
+        if header.startswith(prefix) and len(header) >= len(prefix) + 28:
+            return codec, struct.unpack_from('<Q', header, len(prefix))[0], header[len(prefix) + 8:len(prefix) + 28]
+    return None
+
+
+def split(relative):
+    parent, _, name = relative.rpartition('/')
+    return parent, name
+
+
+class Compression:
+    '''
+    Compression of the files copied to a backup location, as they are copied: each file is read once, compressed as a stream
+    and written under its own name, with the date modified of its source. Formats in the skip list, and files whose first chunk
+    does not get smaller, are copied as they are.
+    A compressed file identifies itself: its header holds the codec, original size and digest, so it is always decompressed when read back,
+    wherever the backup was copied and whatever touched it. The metadata table keeps what the header of each file says by relative path,
+    valid while its size and date modified are unchanged, so listings only open the files that changed, and comparisons use the original
+    sizes and digests without ever decompressing a file. Files copied from the backup are decompressed on the way.
+    '''
+
+    def __init__(self, backup_path):
+        self.backup_path = Path(backup_path)
+        self.settings = read_settings(self.backup_path)
+        self.skip = {extension.lower().lstrip('.') for extension in self.settings.get('skip', SKIP)} if self.settings else set()
+        self.connection = sqlite3.connect(self.backup_path / METADATA_NAME, check_same_thread=False) # shared by threads under self.lock
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS entries (parent TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, codec TEXT,
+                                                                           original_size INTEGER, digest BLOB, PRIMARY KEY (parent, name)) WITHOUT ROWID''')
+
+
+    @classmethod
+    def open(cls, backup_path):
+        '''
+        Compression of a backup location, or None if it never had compression enabled
+        '''
+
+        return cls(backup_path) if used(backup_path) else None
+
+
+    @property
+    def enabled(self):
+        '''
+        Whether new copies are compressed (files compressed earlier are still read once compression is disabled)
+        '''
+
+        return self.settings is not None
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+    def relative(self, path):
+        return os.path.relpath(path, self.backup_path).replace(os.sep, '/')
+
+
+    def record(self, relative, stat, found):
+        '''
+        Keep what the header of a file says (see identify), None for a file stored as it is
+        '''
+
+        codec, original_size, digest = found or (None, None, None)
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (*split(relative), stat.st_size, stat.st_mtime_ns, codec, original_size, digest))
+
+
+    def lookup(self, path, stat=None):
+        '''
+        (codec, original size, digest) of a compressed file of the backup, or None if it is stored as it is.
+        The header of the file is read when the metadata table has nothing valid for it
+        '''
+
+        stat = stat or os.stat(path)
+        relative = self.relative(path)
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime_ns, codec, original_size, digest FROM entries WHERE parent = ? AND name = ?',
+                                          split(relative)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return None if row[2] is None else row[2:]
+        found = identify(path)
+        self.record(relative, stat, found)
+        return found
+
+
+    def listing(self, path, rules=None, relative=''):
+        '''
+        List a folder of the backup like scanner.scan_directory, with the original sizes of the compressed files.
+        relative is the path of the folder below the backup root. The files the metadata table has nothing valid for are identified
+        and recorded, and the rows of files no longer there are dropped
+        '''
+
+        stats = {}
+        listing = scan_directory(path, rules, relative, stats)
+        with self.lock:
+            rows = {row[0]: row[1:] for row in self.connection.execute('SELECT name, size, mtime_ns, codec, original_size FROM entries WHERE parent = ?',
+                                                                       (relative,))}
+        changed = []
+        for name, stat in stats.items():
+            row = rows.get(name)
+            if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+                original_size = row[3]
+            else:
+                try:
+                    found = identify(path / name)
+                except OSError:
+                    continue
+                changed.append((relative, name, stat.st_size, stat.st_mtime_ns, *(found or (None, None, None))))
+                original_size = found[1] if found else None
+            if original_size is not None:
+                listing[name] = listing[name]._replace(size=original_size)
+        stale = [(relative, name) for name in rows if name not in stats]
+        if changed or stale:
+            with self.lock, self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)', changed)
+                self.connection.executemany('DELETE FROM entries WHERE parent = ? AND name = ?', stale)
+            profiling.count('compression_headers', len(changed))
+        return listing
+
+
+    def compressible(self, path):
+        return self.enabled and Path(path).suffix.lower().lstrip('.') not in self.skip
+
+
+    def write(self, src, dst, progress=None):
+        '''
+        Copy a file into the backup, compressed unless its format is in the skip list or its first chunk does not get smaller
+        (nor the whole file). progress(bytes) is called with the bytes read. Return (backend, size, bytes written)
+        '''
+
+        if not self.compressible(src):
+            return self.write_plain(src, dst, progress)
+        codec = self.settings['codec']
+        prefix = PREFIXES[codec]
+        dst = Path(dst)
+        partial = dst.with_name(copying.PARTIAL_PREFIX + dst.name)
+        stream = compressor(codec, self.settings['level'])
+        digest = hashlib.blake2b(digest_size=20) # same digest as hashing.hash_file, computed on the way
+        crc = 0
+        size = 0
+        try:
+            with open(src, 'rb', buffering=0) as file_src, open(partial, 'wb') as file_dst:
+                written = file_dst.write(prefix + bytes(28)) # original size and digest are filled in once known
+                while True:
+                    chunk = file_src.read(chunk_size)
+                    if not chunk:
+                        break
+                    data = stream.compress(chunk)
+                    if not size:
+                        data += flush_block(codec, stream)
+                        if len(data) >= len(chunk): # incompressible, copied as it is
+                            break
+                    digest.update(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    written += file_dst.write(data)
+                    if progress is not None:
+                        progress(len(chunk))
+                if size:
+                    written += file_dst.write(stream.flush())
+                    if codec == 'gzip':
+                        written += file_dst.write(struct.pack('<II', crc, size & 0xffffffff))
+                    file_dst.seek(len(prefix))
+                    file_dst.write(struct.pack('<Q', size) + digest.digest())
+            if written >= size:
+                os.remove(partial)
+                return self.write_plain(src, dst, None if size else progress) # progress was already reported for the bytes compressed
+            shutil.copystat(src, partial)
+            os.replace(partial, dst)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            raise
+        self.record(self.relative(dst), os.stat(dst), (codec, size, digest.digest()))
+        profiling.count('compressed_files')
+        profiling.count('compressed_bytes', written)
+        return codec, size, written
+
+
+    def write_plain(self, src, dst, progress=None):
+        backend = copying.copy_file(src, dst, progress)
+        stat = os.stat(dst)
+        self.record(self.relative(dst), stat, None)
+        return backend, stat.st_size, stat.st_size
+
+
+    def read(self, src, dst, progress=None):
+        '''
+        Copy a file out of the backup, decompressed if it was compressed. progress(bytes) is called with the bytes written.
+        Return (backend, size, bytes written). Raise ValueError if its codec is not available
+        '''
+
+        stat = os.stat(src)
+        found = self.lookup(src, stat)
+        if found is None:
+            backend = copying.copy_file(src, dst, progress)
+            return backend, stat.st_size, stat.st_size
+        codec, size = found[:2]
+        stream = decompressor(codec)
+        dst = Path(dst)
+        partial = dst.with_name(copying.PARTIAL_PREFIX + dst.name)
+        try:
+            with open(src, 'rb', buffering=0) as file_src, open(partial, 'wb') as file_dst:
+                if codec == 'zstd':
+                    file_src.seek(len(PREFIXES[codec]) + 28) # skippable frame holding the header
+                while True:
+                    chunk = file_src.read(chunk_size)
+                    if not chunk:
+                        break
+                    data = stream.decompress(chunk)
+                    file_dst.write(data)
+                    if progress is not None:
+                        progress(len(data))
+            shutil.copystat(src, partial)
+            os.replace(partial, dst)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            raise
+        profiling.count('decompressed_files')
+        return 'decompress', size, size
+
+
+
+def used(backup_path):
+    '''
+    Check whether a backup location may hold compressed files: compression is enabled, or was once
+    '''
+
+    backup_path = Path(backup_path)
+    return (backup_path / SETTINGS_NAME).is_file() or (backup_path / METADATA_NAME).is_file()
+
+
+def read_settings(backup_path):
+    '''
+    Compression settings of a backup location (codec, level, skip list), or None if compression is disabled
+    '''
+
+    try:
+        with open(Path(backup_path) / SETTINGS_NAME, encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def enable(backup_path, codec=None, level=None, skip=()):
+    '''
+    Compress the files copied to backup_path from now on, with the given codec (zstd when available, otherwise gzip) and level
+    (the default of the codec if None), leaving out the formats of the skip list and the extra extensions of skip.
+    Return the settings. Raise ValueError if the codec is not available, or for a store, whose objects are stored as they are
+    '''
+
+    if Store.exists(backup_path):
+        raise ValueError(f'{str(backup_path)} holds a store, compression needs a plain backup')
+    codec = codec or codecs()[-1]
+    if codec not in codecs():
+        raise ValueError(f'Codec {codec} is not available (zstd needs the zstandard package)')
+    skip = sorted(set(SKIP) | {extension.lower().lstrip('.') for extension in skip})
+    settings = {'codec': codec, 'level': default_levels[codec] if level is None else level, 'skip': skip}
+    with open(Path(backup_path) / SETTINGS_NAME, 'w', encoding='utf-8') as file:
+        json.dump(settings, file, indent=1)
+    Compression(backup_path).close() # the metadata table is created at once, so compressed files are always read back
+    return settings
+
+
+def disable(backup_path):
+    '''
+    Copy files to backup_path as they are from now on, files already compressed stay compressed and are still read back
+    '''
+
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(Path(backup_path) / SETTINGS_NAME)
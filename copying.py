@@ -0,0 +1,136 @@
+import errno
+import os
+from pathlib import Path
+import shutil
+import sys
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+PARTIAL_PREFIX = '.smartbackup-partial-' # files being copied, renamed over their destination once complete
+FICLONE = 0x40049409 # Linux ioctl sharing the data blocks of two files on copy-on-write filesystems (btrfs, XFS)
+buffer_size = 4 * 1024 * 1024 # bytes per read and write when no kernel copy is available
+kernel_chunk_size = 16 * 1024 * 1024 # bytes per kernel copy call, so progress is reported while large files are copied
+file_sendfile = sys.platform.startswith('linux') # sendfile only writes to regular files on Linux
+
+# Errors meaning a kernel copy call is not supported for these two files, so the next backend is tried
+unsupported_errors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM, errno.ENOTTY}
+
+
+
+def reflink(fd_src, fd_dst):
+    '''
+    Share the source data blocks with the destination, nothing is copied until one of them is modified
+    '''
+
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fd_dst, FICLONE, fd_src)
+    except OSError as error:
+        if error.errno in unsupported_errors:
+            return False
+        raise
+    return True
+
+
+def kernel_copy(copy, fd_src, fd_dst, size, progress=None):
+    '''
+    Copy size bytes with a kernel call copy(fd_src, fd_dst, offset, count) returning the number of bytes copied.
+    Return False if the call is not supported before anything is copied
+    '''
+
+    offset = 0
+    while offset < size:
+        try:
+            copied = copy(fd_src, fd_dst, offset, min(size - offset, kernel_chunk_size))
+        except OSError as error:
+            if offset == 0 and error.errno in unsupported_errors:
+                return False
+            raise
+        if copied == 0:
+            if offset == 0:
+                return False # some filesystems (e.g. /proc) report no data through kernel copies
+            break # source truncated while copying
+        offset += copied
+        if progress is not None:
+            progress(copied)
+    return True
+
+
+def copy_file_range(fd_src, fd_dst, offset, count):
+    return os.copy_file_range(fd_src, fd_dst, count, offset, offset)
+
+
+def sendfile(fd_src, fd_dst, offset, count):
+    os.lseek(fd_dst, offset, os.SEEK_SET)
+    return os.sendfile(fd_dst, fd_src, offset, count)
+
+
+def buffered_copy(fd_src, fd_dst, progress=None):
+    '''
+    Copy through a large reusable buffer, for platforms and filesystems without kernel copies
+    '''
+
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd_src, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(fd_src, 'rb', buffering=0, closefd=False) as file_src, open(fd_dst, 'wb', buffering=0, closefd=False) as file_dst:
+        file_src.seek(0)
+        file_dst.seek(0)
+        while True:
+            read = file_src.readinto(buffer)
+            if not read:
+                break
+            written = 0
+            while written < read:
+                written += file_dst.write(view[written:read])
+            if progress is not None:
+                progress(read)
+
+
+def copy_data(fd_src, fd_dst, size, same_device, progress=None):
+    '''
+    Copy the contents of an open file with the cheapest available backend, returning its name:
+    reflink (same filesystem only), copy_file_range, sendfile or buffer.
+    progress(bytes) is called after each chunk copied
+    '''
+
+    if size == 0:
+        return 'empty'
+    if same_device and reflink(fd_src, fd_dst):
+        if progress is not None:
+            progress(size)
+        return 'reflink'
+    if hasattr(os, 'copy_file_range') and kernel_copy(copy_file_range, fd_src, fd_dst, size, progress):
+        return 'copy_file_range'
+    if file_sendfile and kernel_copy(sendfile, fd_src, fd_dst, size, progress):
+        return 'sendfile'
+    buffered_copy(fd_src, fd_dst, progress)
+    return 'buffer'
+
+
+def copy_file(src, dst, progress=None):
+    '''
+    Copy a file with its metadata like shutil.copy2, returning the backend used (progress is passed to copy_data).
+    The copy is written next to its destination and renamed over it once complete, so an interrupted copy never leaves a truncated file.
+    '''
+
+    dst = Path(dst)
+    partial = dst.with_name(PARTIAL_PREFIX + dst.name)
+    try:
+        with open(src, 'rb', buffering=0) as file_src, open(partial, 'wb', buffering=0) as file_dst:
+            stat_src = os.fstat(file_src.fileno())
+            same_device = stat_src.st_dev == os.fstat(file_dst.fileno()).st_dev
+            backend = copy_data(file_src.fileno(), file_dst.fileno(), stat_src.st_size, same_device, progress)
+        shutil.copystat(src, partial)
+        os.replace(partial, dst)
+    except BaseException:
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+    return backend
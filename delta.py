@@ -0,0 +1,47 @@
+import os
+import shutil
+
+delta_threshold = 64 * 1024 * 1024 # files at least this large are updated in place by delta transfer when it is enabled
+block_size = 64 * 1024 # bytes compared at once, and the smallest change rewritten
+
+
+
+def can_update(dst):
+    '''
+    Check whether a destination file can be patched in place: it must exist and not be shared through hard links
+    '''
+
+    try:
+        stat = os.stat(dst)
+    except OSError:
+        return False
+    return stat.st_nlink == 1
+
+
+def delta_copy(src, dst, progress=None):
+    '''
+    Update dst to the contents of src in place, comparing both files block by block and only writing the blocks that differ.
+    progress(bytes) is called after each block compared. Return the number of bytes written to dst
+    '''
+
+    written = 0
+    position = 0
+    with open(src, 'rb', buffering=0) as source, open(dst, 'r+b', buffering=0) as target:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(target.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            if target.read(len(block)) != block: # the last block of the source may be shorter
+                target.seek(position)
+                target.write(block)
+                written += len(block)
+            position += len(block)
+            target.seek(position)
+            if progress is not None:
+                progress(len(block))
+        target.truncate(position)
+    shutil.copystat(src, dst)
+    return written
@@ -0,0 +1,270 @@
+from compressor import Compression
+import contextlib
+import executor
+from hashing import HashCache
+from journal import Journal
+from pathlib import Path
+import plan
+import profiling
+from progress import ProgressTracker
+from renames import detect_renames
+import rules
+from scan_index import ScanIndex
+from scanner import Comparison
+import snapshots
+import sqlite3
+from store import Store
+import sys
+import time
+
+scan_workers = 8 # folders listed in parallel during analysis (1 = sequential scan)
+
+
+
+def never_cancelled():
+    return False
+
+
+def ignore_progress(fraction, message=''):
+    pass
+
+
+def clean_leftovers(paths, backup_path):
+    '''
+    Remove the partial copies left by interrupted runs, unless a run into backup_path is still pending (see resume).
+    Files moved aside by an interrupted swap hold one of the two versions swapped, so they are only reported
+    '''
+
+    if Journal(backup_path).exists():
+        return
+    removed = 0
+    for path in paths:
+        if path.name.startswith(plan.SWAP_PREFIX):
+            print(f'Left by an interrupted swap: {str(path)}', file=sys.stderr)
+            continue
+        with contextlib.suppress(OSError):
+            path.unlink()
+            removed += 1
+    profiling.count('leftovers_removed', removed)
+
+
+def analyze(directory_path, backup_path, workers=scan_workers, incremental=False, verify_content=False, progress=ignore_progress, cancelled=never_cancelled,
+            folders=None, exclude=(), find_renames=True):
+    '''
+    Compare source and backup directory to find differences, returning the ComparisonResults (None if cancelled).
+    progress(fraction, message) is called between folders and cancelled() is checked between folders.
+    With folders (relative paths present on both sides), only those folders are compared, not the whole trees (see scanner.Comparison).
+    Paths matching the rule files of the two directories or the exclude patterns are skipped (see rules.load).
+    With find_renames, files and folders found on each side under different paths with the same contents are listed as renames (see renames).
+    Temporary files of interrupted runs are left out at any depth, and partial copies are removed (see clean_leftovers).
+    A backup location holding a store is compared through its manifest (see store), and renames are not looked for.
+    Compressed files of the backup are compared by their original sizes and digests (see compressor).
+    A run report with the time spent in each phase is saved in the backup location (see profiling).
+    '''
+
+    profile = profiling.start('analyze', {'source': str(directory_path), 'backup': str(backup_path), 'workers': workers,
+                                          'incremental': incremental, 'verify_content': verify_content,
+                                          'folders': None if folders is None else len(folders), 'exclude': list(exclude), 'find_renames': find_renames})
+    exclusions = rules.load(directory_path, backup_path, exclude)
+
+    # The index is always refreshed, and only trusted for incremental analyses
+    try:
+        index = ScanIndex(directory_path, backup_path, reuse=incremental, rules_digest=exclusions.digest)
+    except sqlite3.Error:
+        print(f'Cannot open scan index in {str(backup_path)}', file=sys.stderr)
+        index = None
+
+    # Digests are cached in the backup location, so each file is hashed only once until it changes
+    hash_cache = None
+    if verify_content:
+        try:
+            hash_cache = HashCache(backup_path)
+        except sqlite3.Error:
+            print(f'Cannot open hash cache in {str(backup_path)}', file=sys.stderr)
+
+    # Compare the two directories folder by folder
+    store = Store.open(backup_path)
+    compression = Compression.open(backup_path)
+    comparison = Comparison(directory_path, backup_path, workers=workers, index=index, verify_content=verify_content, hash_cache=hash_cache,
+                            folders=folders, rules=exclusions, store=store, compression=compression)
+    try:
+        with profiling.span('scan'):
+            while not cancelled() and not comparison.run(max_steps=1):
+                progress(comparison.progress, 'Analyzing ' + str(comparison.current.relative_to(comparison.directory_path)))
+        if find_renames and store is None and not cancelled():
+            progress(1, 'Looking for renamed files and folders')
+            detect_renames(comparison.results, hash_cache, exclusions, compression)
+        clean_leftovers(comparison.leftovers, backup_path)
+    finally:
+        comparison.close()
+        if index is not None:
+            index.close()
+        if hash_cache is not None:
+            hash_cache.close()
+        if store is not None:
+            store.close()
+        if compression is not None:
+            compression.close()
+    results = comparison.results
+    profiling.record(cancelled=cancelled(), unique_files_dir=len(results.unique_files_dir), unique_files_backup=len(results.unique_files_backup),
+                     unique_folders_dir=len(results.unique_folders_dir), unique_folders_backup=len(results.unique_folders_backup),
+                     different_dates=len(results.different_dates), renames=len(results.renames))
+    profiling.finish(profile, backup_path)
+    return None if cancelled() else results
+
+
+def execute_plan(operations, directory_path, backup_path, total_items, progress=ignore_progress, cancelled=never_cancelled,
+                 workers=executor.copy_workers, log=None, progress_log=None, exclude=()):
+    '''
+    Apply a stream of plan operations through a journal in the backup location, returning the statistics of the run (see executor.execute).
+    The whole plan is written to the journal first, so a ValueError for an invalid operation (see plan.read_plan) is raised before anything changes.
+    Folder copies leave out what the exclude patterns match.
+    The journal is removed once every item has been attempted, and kept when the run is cancelled or interrupted so it can be resumed.
+    A run report is saved in the backup location (see profiling).
+    '''
+
+    profile = profiling.start('backup', {'source': str(directory_path), 'backup': str(backup_path), 'workers': workers})
+    journal = Journal(backup_path)
+    try:
+        with profiling.span('plan'):
+            journal.write_plan(operations, directory_path, backup_path, total_items, exclude)
+    except OSError:
+        print(f'Cannot write journal in {str(backup_path)}, nothing was changed', file=sys.stderr)
+        journal.remove()
+        stats = executor.execute([], directory_path, backup_path)
+    except ValueError: # invalid operation in a saved plan, found while it is copied to the journal before anything is applied
+        journal.remove()
+        if profile is not None:
+            profiling.stop(profile)
+        raise
+    else:
+        stats = run_journal(journal, progress, cancelled, workers, log, progress_log, resume=False)
+    profiling.finish(profile, backup_path)
+    return stats
+
+
+def run_journal(journal, progress=ignore_progress, cancelled=never_cancelled, workers=executor.copy_workers, log=None, progress_log=None, resume=True):
+    '''
+    Apply the plan of a journal, skipping the operations it records as completed when resuming.
+    The plan is read twice: once to measure the work left, so progress is weighted by bytes, then to apply it.
+    When snapshots are enabled for the backup location, a generation is taken once the plan is applied (see snapshots.snapshot_due).
+    '''
+
+    completed = journal.completed() if resume else None
+    store = Store.open(journal.header()['backup'])
+    compression = Compression.open(journal.header()['backup'])
+    try:
+        with open(journal.plan_path, encoding='utf-8') as file, profiling.span('summarize'):
+            header, operations = plan.read_plan(file)
+            exclusions = rules.RuleSet(header.get('exclude', ()))
+            summary = plan.summarize((operation for index, operation in enumerate(operations) if completed is None or index not in completed),
+                                     header['source'], header['backup'], exclusions, store)
+        other_operations = sum(count for op, count in summary['counts'].items() if op not in plan.COPYING) # deletes and renames
+        tracker = ProgressTracker(summary['bytes'], summary['files'] + other_operations, progress, progress_log)
+
+        with open(journal.plan_path, encoding='utf-8') as file:
+            header, operations = plan.read_plan(file)
+            journal.open()
+            try:
+                with profiling.span('execute'):
+                    stats = executor.execute(operations, header['source'], header['backup'], tracker, workers, cancelled, log, journal, completed,
+                                             exclusions, store, compression)
+            finally:
+                journal.close()
+    finally:
+        if store is not None:
+            store.close()
+        if compression is not None:
+            compression.close()
+    if not cancelled():
+        journal.remove()
+        if stats['items'] and snapshots.snapshot_due(header['backup']):
+            try:
+                stats['snapshot'] = snapshots.snapshot(header['backup'])
+            except OSError as error:
+                print(f'Cannot take a snapshot of {header["backup"]}: {error}', file=sys.stderr)
+    profiling.record(cancelled=cancelled(), resumed=resume, operations=summary['counts'], **stats)
+    return stats
+
+
+def dry_run(operations, directory_path, backup_path, exclude=()):
+    '''
+    Count the operations of a plan and the files and bytes they would copy, without changing anything (see plan.summarize)
+    '''
+
+    store = Store.open(backup_path)
+    try:
+        return plan.summarize(operations, directory_path, backup_path, rules.RuleSet(exclude), store)
+    finally:
+        if store is not None:
+            store.close()
+
+
+def restore(backup_path, target_path, relative='', progress=ignore_progress, exclude=()):
+    '''
+    Write a folder or file of the store in backup_path (the whole backup tree by default) to target_path, with the dates modified of the files.
+    Paths matching the rule file of the backup location or the exclude patterns are left out.
+    Return the statistics of the run: files and bytes written, and seconds
+    '''
+
+    store = Store.open(backup_path)
+    if store is None:
+        raise ValueError(f'No store in {str(backup_path)}')
+    if relative and store.entry(relative) is None:
+        store.close()
+        raise FileNotFoundError(2, 'Not in the store', relative)
+    profile = profiling.start('restore', {'backup': str(backup_path), 'target': str(target_path), 'path': relative, 'exclude': list(exclude)})
+    start = time.monotonic()
+    try:
+        with profiling.span('restore'):
+            exclusions = rules.RuleSet(rules.read_rules(Path(backup_path) / rules.IGNORE_NAME) + list(exclude))
+            total = store.folder_stats(relative, exclusions)[1]
+            tracker = ProgressTracker(total, 0, progress)
+            files = store.restore(relative, target_path, tracker.add_bytes, exclusions)
+    finally:
+        store.close()
+    stats = {'files': len(files), 'bytes': sum(size for _, _, size in files), 'seconds': round(time.monotonic() - start, 3)}
+    profiling.record(**stats)
+    profiling.finish(profile, backup_path)
+    return stats
+
+
+def pending_backup(backup_path):
+    '''
+    Header of the plan of an interrupted backup into backup_path (source, backup and number of items), or None
+    '''
+
+    journal = Journal(backup_path)
+    if not journal.exists():
+        return None
+    try:
+        return journal.header()
+    except (OSError, ValueError):
+        return None
+
+
+def resume(backup_path, progress=ignore_progress, cancelled=never_cancelled, workers=executor.copy_workers, log=None, progress_log=None):
+    '''
+    Finish an interrupted backup into backup_path from its journal, returning the statistics of the run (see executor.execute)
+    '''
+
+    profile = profiling.start('resume', {'backup': str(backup_path), 'workers': workers})
+    stats = run_journal(Journal(backup_path), progress, cancelled, workers, log, progress_log)
+    profiling.finish(profile, backup_path)
+    return stats
+
+
+def apply(results, progress=ignore_progress, cancelled=never_cancelled, workers=executor.copy_workers, log=None, delta_threshold=None,
+          progress_log=None):
+    '''
+    Perform copy of selected items and delete unselected items, following the decisions stored in the results.
+    Independent items are applied by a pool of workers; returns the statistics of the run (see executor.execute).
+    progress(fraction, message) is called as bytes are copied, with the current rates and time left in the message,
+    and cancelled() is checked before each item. Progress snapshots are also written as JSON lines to progress_log, if given.
+    log(path, backend, size) is called for each file copied.
+    Files of at least delta_threshold bytes replacing an older version are updated in place, only rewriting what changed.
+    The run is journaled and can be resumed after a crash (see resume).
+    '''
+
+    return execute_plan(plan.build_plan(results, delta_threshold), results.directory_path, results.backup_path, len(results),
+                        progress, cancelled, workers, log, progress_log, results.exclude)
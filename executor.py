@@ -0,0 +1,297 @@
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import copying
+import delta
+import os
+from pathlib import Path
+from plan import BACKUP, SOURCE
+from progress import ProgressTracker
+import shutil
+import sys
+import time
+
+copy_workers = 8 # items applied in parallel (1 = one item at a time)
+queued_per_worker = 4 # items submitted ahead of the workers, so a streamed plan is never loaded whole
+
+# Phases of a plan: items creating folders run first, items only removing things run last
+CREATE = 0
+UPDATE = 1
+REMOVE = 2
+
+
+
+def applied(operation, src, dst):
+    '''
+    Check whether an operation that may have been interrupted by a crash is already done
+    '''
+
+    if operation.op in ('delete', 'rmtree'):
+        return not os.path.lexists(src)
+    if operation.op in ('move', 'rename'):
+        return not os.path.lexists(src) and os.path.lexists(dst)
+    return False # copies are simply made again
+
+
+def perform(operation, roots, files, tracker, resume=False, rules=None, store=None, compression=None):
+    '''
+    Apply one operation to the file system, appending (destination, backend, size, bytes written) to files for each file copied
+    and counting its bytes and files in the ProgressTracker as they are done.
+    When resuming an interrupted run, operations already done are skipped and folder copies complete what is already there.
+    Folder copies leave out what the rules (a rules.RuleSet) exclude. With a store.Store, operations on the backup side go through it.
+    With a compressor.Compression, files are compressed on their way to the backup and decompressed on their way back
+    '''
+
+    src = roots[operation.src_side] / operation.src
+    dst = None if operation.dst_side is None else roots[operation.dst_side] / operation.dst
+    if store is not None and BACKUP in (operation.src_side, operation.dst_side):
+        if resume and store.applied(operation, roots):
+            tracker.add_bytes(operation.size or 0)
+            tracker.add_files()
+        else:
+            store.perform(operation, roots, files, tracker, rules)
+        return
+    if resume and applied(operation, src, dst):
+        tracker.add_bytes(operation.size or 0)
+        tracker.add_files()
+        return
+    if operation.op == 'delete':
+        src.unlink()
+        tracker.add_files()
+        return
+    if operation.op == 'rmtree':
+        shutil.rmtree(src)
+        tracker.add_files()
+        return
+
+    def copy_file(file_src, file_dst):
+        if compression is not None and operation.dst_side == BACKUP:
+            backend, size, written = compression.write(file_src, file_dst, tracker.add_bytes)
+        elif compression is not None and operation.src_side == BACKUP:
+            backend, size, written = compression.read(file_src, file_dst, tracker.add_bytes)
+        else:
+            backend = copying.copy_file(file_src, file_dst, tracker.add_bytes)
+            size = written = os.stat(file_dst).st_size
+        files.append((file_dst, backend, size, written))
+        tracker.add_files()
+
+    if operation.op == 'copy':
+        copy_file(src, dst)
+    elif operation.op == 'update':
+        if delta.can_update(dst) and compression is None: # compressed files are rewritten whole
+            written = delta.delta_copy(src, dst, tracker.add_bytes)
+            os.utime(dst.parent) # the folder changes as with a copy, so scan_index.ScanIndex lists it again
+            files.append((dst, 'delta', os.stat(dst).st_size, written))
+            tracker.add_files()
+        else: # hard linked files are replaced, so the other links keep the old version
+            copy_file(src, dst)
+    elif operation.op == 'copytree':
+        ignore = rules.ignore(roots[operation.src_side]) if rules else None
+        shutil.copytree(src, dst, ignore=ignore, copy_function=copy_file, dirs_exist_ok=resume)
+    elif operation.op == 'move' and operation.src_side == BACKUP and os.lstat(src).st_nlink > 1:
+        copy_file(src, dst) # shared with a snapshot, so the file must not be edited in place later on the source side
+        src.unlink()
+    elif operation.op == 'move' and operation.src_side != operation.dst_side and compression is not None:
+        copy_file(src, dst) # compressed or decompressed on the way, never moved as it is
+        src.unlink()
+    elif operation.op == 'move':
+        copied = len(files)
+        shutil.move(src, dst, copy_function=copy_file) # only copies when the two paths are on different filesystems
+        if len(files) == copied: # renamed
+            tracker.add_bytes(operation.size or 0)
+            tracker.add_files()
+    elif operation.op == 'rename':
+        src.rename(dst)
+        tracker.add_files()
+    else:
+        raise ValueError(f'Unknown operation {operation.op}')
+
+
+def perform_item(operations, roots, tracker, journal=None, completed=None, rules=None, store=None, compression=None):
+    '''
+    Apply the (index, operation) pairs of one item in order, stopping at the first failure (any error, so one bad item never stops the others).
+    Operations whose index is in completed are skipped, and each operation applied is recorded in the journal,
+    durably before the next operation of the item so a crash never replays an operation over the ones after it.
+    Return (files copied as (destination, backend, size, bytes written) tuples, whether every operation succeeded)
+    '''
+
+    files = []
+    last = operations[-1][0]
+    for index, operation in operations:
+        if completed is not None and index in completed:
+            continue
+        try:
+            perform(operation, roots, files, tracker, completed is not None, rules, store, compression)
+            if journal is not None:
+                journal.done(index, sync=index != last)
+        except Exception as error: # the item is reported and counted as failed, the run goes on
+            path = roots[operation.src_side] / operation.src if operation.src_side in roots else operation.src
+            print(f'Cannot {operation.op} {str(path)}: {getattr(error, "strerror", None) or error}', file=sys.stderr)
+            return files, False
+    return files, True
+
+
+def phase(operations):
+    '''
+    Phase of an item: folders must exist before anything is copied into them, and removals wait for all copies
+    '''
+
+    kinds = {operation.op for _, operation in operations}
+    if 'copytree' in kinds:
+        return CREATE
+    if kinds <= {'delete', 'rmtree'}:
+        return REMOVE
+    return UPDATE
+
+
+def group_items(operations):
+    '''
+    Group consecutive operations by item, as lists of (index in the plan, operation) pairs
+    '''
+
+    current = []
+    for index, operation in enumerate(operations):
+        if current and operation.item != current[0][1].item:
+            yield current
+            current = []
+        current.append((index, operation))
+    if current:
+        yield current
+
+
+class Execution:
+    '''
+    Application of a stream of plan operations with a pool of threads, one item per task.
+    Items of the same phase are independent and run concurrently; a phase only starts once the previous one is done,
+    and items that only remove files or folders are held back until every copy has finished.
+    A failed item is reported and skipped without stopping the others.
+    log(path, backend, size) is called for each file copied, with the copy backend used (see copying.copy_data).
+    With a journal, each operation is recorded once applied; completed holds the indexes of the operations applied
+    by an interrupted run, which is then resumed. Folder copies leave out what the rules exclude.
+    With a store.Store, the backup side is its manifest and objects rather than a copy of the source tree.
+    With a compressor.Compression, files copied to the backup are compressed and files copied from it decompressed.
+    '''
+
+    def __init__(self, directory_path, backup_path, tracker=None, workers=copy_workers, cancelled=None, log=None, journal=None, completed=None,
+                 rules=None, store=None, compression=None):
+        self.roots = {SOURCE: Path(directory_path), BACKUP: Path(backup_path)}
+        self.tracker = tracker or ProgressTracker(0, 0)
+        self.workers = workers
+        self.cancelled = cancelled
+        self.log = log
+        self.journal = journal
+        self.completed = completed
+        self.rules = rules
+        self.store = store
+        self.compression = compression
+        self.pool = None
+        self.running = set()
+        self.processed_items = 0
+        self.failed_items = 0
+        self.copied = 0
+        self.saved = 0
+        self.backends = Counter()
+        self.start = None
+
+
+    @property
+    def throughput(self):
+        '''
+        Bytes copied per second since the start
+        '''
+
+        elapsed = time.monotonic() - self.start
+        return self.copied / elapsed if elapsed > 0 else 0
+
+
+    def stats(self):
+        return {'items': self.processed_items, 'failed': self.failed_items, 'files': self.tracker.files, 'bytes': self.copied, 'bytes_saved': self.saved,
+                'seconds': round(time.monotonic() - self.start, 3), 'bytes_per_second': round(self.throughput), 'backends': dict(self.backends)}
+
+
+    def run(self, operations):
+        '''
+        Apply the operations and return the statistics of the run (see stats)
+        '''
+
+        self.start = time.monotonic()
+        removals = []
+        current_phase = None
+        try:
+            for item in group_items(operations):
+                if self.cancelled is not None and self.cancelled():
+                    break
+                item_phase = phase(item)
+                if item_phase == REMOVE:
+                    removals.append(item)
+                    continue
+                if item_phase != current_phase:
+                    self.wait_all()
+                    current_phase = item_phase
+                self.submit(item)
+            else:
+                self.wait_all()
+                for item in removals:
+                    if self.cancelled is not None and self.cancelled():
+                        break
+                    self.submit(item)
+            self.wait_all()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+        self.tracker.report(force=True)
+        return self.stats()
+
+
+    def submit(self, item):
+        '''
+        Apply an item, in the thread pool when there is more than one worker
+        '''
+
+        if self.workers <= 1:
+            self.finish(*perform_item(item, self.roots, self.tracker, self.journal, self.completed, self.rules, self.store,
+                                      self.compression))
+            return
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='copy')
+        while len(self.running) >= self.workers * queued_per_worker:
+            self.wait_some()
+        self.running.add(self.pool.submit(perform_item, item, self.roots, self.tracker, self.journal, self.completed, self.rules,
+                                          self.store, self.compression))
+
+
+    def wait_some(self):
+        done, self.running = wait(self.running, return_when=FIRST_COMPLETED)
+        for future in done:
+            self.finish(*future.result())
+
+
+    def wait_all(self):
+        while self.running:
+            self.wait_some()
+
+
+    def finish(self, files, succeeded):
+        '''
+        Account for a finished item (always called from the thread running the execution)
+        '''
+
+        self.processed_items += 1
+        self.failed_items += not succeeded
+        for path, backend, size, written in files:
+            self.copied += written
+            self.saved += size - written
+            self.backends[backend] += 1
+            if self.log is not None:
+                self.log(path, backend, size)
+
+
+def execute(operations, directory_path, backup_path, tracker=None, workers=copy_workers, cancelled=None, log=None, journal=None, completed=None,
+            rules=None, store=None, compression=None):
+    '''
+    Apply a stream of plan operations, returning the statistics of the run (items, failed, files, bytes written,
+    bytes_saved by delta updates, deduplication and compression, seconds, bytes_per_second, and the number of files copied with each backend).
+    Progress is reported through the ProgressTracker and cancelled() is checked before each item is started.
+    '''
+
+    return Execution(directory_path, backup_path, tracker, workers, cancelled, log, journal, completed, rules, store, compression).run(operations)
@@ -0,0 +1,106 @@
+import hashlib
+import os
+from pathlib import Path
+import profiling
+import sqlite3
+import threading
+
+HASHES_NAME = '.smartbackup-hashes.sqlite' # starts with scanner.METADATA_PREFIX, so it is never compared
+chunk_size = 1024 * 1024 # bytes read at once when hashing
+partial_size = 16 * 1024 # bytes hashed at the start and at the end of a file for the quick check
+
+
+
+def hash_file(path):
+    '''
+    BLAKE2 digest of a file's contents, read in chunks
+    '''
+
+    digest = hashlib.blake2b(digest_size=20)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+            profiling.count('hashed_bytes', read)
+    profiling.count('hashed_files')
+    return digest.digest()
+
+
+def partial_digest(path, size):
+    '''
+    BLAKE2 digest of the first and last partial_size bytes of a file (the whole file if it is small)
+    '''
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb', buffering=0) as file:
+        digest.update(file.read(partial_size))
+        if size > partial_size:
+            file.seek(max(partial_size, size - partial_size))
+            digest.update(file.read(partial_size))
+    profiling.count('partial_hashes')
+    return digest.digest()
+
+
+class HashCache:
+    '''
+    Persistent cache of file digests, keyed by (device, inode) and valid while size and mtime_ns are unchanged.
+    Each file is hashed at most once until it is modified.
+    '''
+
+    def __init__(self, backup_path):
+        self.path = Path(backup_path) / HASHES_NAME
+        self.connection = sqlite3.connect(self.path, check_same_thread=False) # shared by threads under self.lock
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS hashes (device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, digest BLOB,
+                                                                          PRIMARY KEY (device, inode)) WITHOUT ROWID''')
+
+
+    def digest(self, path):
+        '''
+        Digest of a file, from the cache if the file has not changed since it was hashed
+        '''
+
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino)
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime_ns, digest FROM hashes WHERE device = ? AND inode = ?', key).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            profiling.count('hash_cache_hits')
+            return row[2]
+
+        digest = hash_file(path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', key + (stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+
+    def close(self):
+        '''
+        Save new digests and close the database
+        '''
+
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def content_differs(path1, size1, path2, size2, cache=None):
+    '''
+    Check whether two files have different contents, reading as little as possible:
+    sizes first, then the start and end of the files, and the full contents only if still inconclusive
+    '''
+
+    if size1 != size2:
+        return True
+    if partial_digest(path1, size1) != partial_digest(path2, size2):
+        return True
+    if size1 <= 2 * partial_size: # the partial digests covered the whole files
+        return False
+    if cache is not None:
+        return cache.digest(path1) != cache.digest(path2)
+    return hash_file(path1) != hash_file(path2)
@@ -0,0 +1,114 @@
+import os
+from pathlib import Path
+import plan
+from scanner import METADATA_PREFIX
+import shutil
+import threading
+import time
+
+JOURNAL_NAME = METADATA_PREFIX + '-journal'
+sync_interval = 1.0 # maximum seconds between flushes of the completed operations to disk
+
+
+
+class Journal:
+    '''
+    Write-ahead journal of a backup run, kept in a folder of the backup root until the run is over.
+    plan.jsonl holds the whole plan and is in place before anything is changed; done.log lists the index of each operation once it has completed.
+    After a crash, the run is resumed by applying the operations of the plan that are not in done.log.
+    '''
+
+    def __init__(self, backup_path):
+        self.path = Path(backup_path) / JOURNAL_NAME
+        self.plan_path = self.path / 'plan.jsonl'
+        self.done_path = self.path / 'done.log'
+        self.lock = threading.Lock()
+        self.fd = None
+        self.last_sync = 0
+
+
+    def exists(self):
+        return self.plan_path.is_file()
+
+
+    def header(self):
+        '''
+        Header of the journaled plan (source, backup and number of items)
+        '''
+
+        with open(self.plan_path, encoding='utf-8') as file:
+            return plan.read_plan(file)[0]
+
+
+    def write_plan(self, operations, directory_path, backup_path, items, exclude=()):
+        '''
+        Save the plan of a new run, replacing any previous journal.
+        The plan is written to a temporary file and renamed once synced, so a journal always holds a complete plan
+        '''
+
+        self.remove()
+        self.path.mkdir()
+        partial = self.path / 'plan.jsonl.partial'
+        with open(partial, 'w', encoding='utf-8') as file:
+            plan.write_plan(operations, file, directory_path, backup_path, items, exclude)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(partial, self.plan_path)
+        self.sync_folder()
+
+
+    def sync_folder(self):
+        '''
+        Make the files created in the journal folder durable (POSIX only, folders cannot be opened on Windows)
+        '''
+
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+    def completed(self):
+        '''
+        Indexes of the operations recorded as completed (a line cut short by a crash is ignored)
+        '''
+
+        try:
+            with open(self.done_path, 'rb') as file:
+                return {int(line) for line in file if line.endswith(b'\n')}
+        except FileNotFoundError:
+            return set()
+
+
+    def open(self):
+        self.fd = os.open(self.done_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        self.last_sync = time.monotonic()
+
+
+    def done(self, index, sync=False):
+        '''
+        Record an operation as completed (called from the copying threads).
+        Records are synced at most every sync_interval seconds, or at once with sync: an operation completed just before a crash
+        may be applied again, which operations allow as long as the operations after it in its item have not run yet
+        '''
+
+        with self.lock:
+            os.write(self.fd, b'%d\n' % index)
+            now = time.monotonic()
+            if sync or now - self.last_sync >= sync_interval:
+                os.fsync(self.fd)
+                self.last_sync = now
+
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.fd = None
+
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
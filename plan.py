@@ -0,0 +1,280 @@
+from collections import Counter, namedtuple
+from datetime import datetime, timezone, timedelta
+import json
+import os
+from pathlib import Path, PurePosixPath, PureWindowsPath
+from results import COPY, COPY_TO_BACKUP, COPY_TO_SOURCE, KEEP, KEEP_BACKUP, KEEP_SOURCE, RENAME
+
+PLAN_VERSION = 1
+SWAP_PREFIX = '.smartbackup-swap-' # files moved aside while swapping a file between the two sides
+
+# Sides of a synchronization, as written in plans
+SOURCE = 'source'
+BACKUP = 'backup'
+
+# File system operation (copy, update, copytree, move, rename, delete or rmtree), with paths relative to the root of their side.
+# update overwrites an older version of a file, only rewriting the parts that changed.
+# item numbers the analysis item the operation comes from, so an item whose first operation fails can be skipped as a whole.
+# size is the number of bytes copied (None for folders until measured, 0 for operations that copy nothing).
+Operation = namedtuple('Operation', ['item', 'op', 'src_side', 'src', 'dst_side', 'dst', 'size'])
+
+# Operations writing file contents (move only copies across filesystems, but is counted as a copy)
+COPYING = {'copy', 'update', 'copytree', 'move'}
+REMOVING = {'delete', 'rmtree'}
+OPERATIONS = COPYING | {'rename'} | REMOVING
+
+
+
+def dated_name(relative, date):
+    '''
+    Relative path with the date modified appended to the file name, e.g. folder/report_2024-01-31_18-05.txt
+    '''
+
+    folder, name = os.path.split(relative)
+    stem, extension = os.path.splitext(name)
+    suffix = datetime.fromtimestamp(date, timezone(timedelta(hours=1))).strftime("%Y-%m-%d_%H-%M")
+    return f'{folder}/{stem}_{suffix}{extension}' if folder else f'{stem}_{suffix}{extension}'
+
+
+def swap_name(relative):
+    '''
+    Temporary relative path used to swap a file between the two sides, next to the file itself
+    '''
+
+    folder, name = os.path.split(relative)
+    return f'{folder}/{SWAP_PREFIX}{name}' if folder else SWAP_PREFIX + name
+
+
+def build_plan(results, delta_threshold=None):
+    '''
+    Turn the analysis results and their decisions into the operations to perform, in order.
+    Operations are generated lazily, so even huge results are never held twice in memory.
+    With a delta_threshold, files at least that large overwriting an older version are updated in place (update operations)
+    rather than copied again.
+    '''
+
+    def overwrite(src_side, dst_side, relative, size):
+        op = 'copy' if delta_threshold is None or size < delta_threshold else 'update'
+        return Operation(item, op, src_side, relative, dst_side, relative, size)
+
+    item = 0
+
+    # Folders and files found on one side only
+    #  checked = [keep, copy to the other side]
+    for table, side, other, op, remove in [(results.unique_folders_dir, SOURCE, BACKUP, 'copytree', 'rmtree'),
+                                           (results.unique_folders_backup, BACKUP, SOURCE, 'copytree', 'rmtree'),
+                                           (results.unique_files_dir, SOURCE, BACKUP, 'copy', 'delete'),
+                                           (results.unique_files_backup, BACKUP, SOURCE, 'copy', 'delete')]:
+        folders = op == 'copytree'
+        for i in range(len(table)):
+            checked = table.checked(i, [KEEP, COPY])
+            relative = table.relative_path(i)
+            if checked[1]:
+                yield Operation(item, op, side, relative, other, relative, None if folders else table.sizes[i])
+            if not checked[0]:
+                yield Operation(item, remove, side, relative, None, None, 0)
+            item += 1
+
+    # Files and folders renamed or moved in the source
+    #  checked = [rename in backup], otherwise the new path is copied and the old one kept
+    renames = results.renames
+    for i in range(len(renames)):
+        relative = renames.relative_path(i)
+        if renames.checked(i, [RENAME])[0]:
+            yield Operation(item, 'rename', BACKUP, renames.old_paths.relative_path(i), BACKUP, relative, 0)
+        elif renames.folder[i]:
+            yield Operation(item, 'copytree', SOURCE, relative, BACKUP, relative, None)
+        else:
+            yield Operation(item, 'copy', SOURCE, relative, BACKUP, relative, renames.sizes[i])
+        item += 1
+
+    # Files with different dates edited
+    #  checked = [keep in source, copy to backup, keep in backup, copy to source]
+    dates = results.different_dates
+    for i in range(len(dates)):
+        checked = dates.checked(i, [KEEP_SOURCE, COPY_TO_BACKUP, KEEP_BACKUP, COPY_TO_SOURCE])
+        relative = dates.relative_path(i)
+        size1, size2 = dates.sizes[i], dates.sizes2[i]
+        new1 = dated_name(relative, dates.dates1[i])
+        new2 = dated_name(relative, dates.dates2[i])
+
+        if [checked[0], checked[1], checked[3]] == [False, False, False]:
+            yield Operation(item, 'delete', SOURCE, relative, None, None, 0)
+            if not checked[2]:
+                yield Operation(item, 'delete', BACKUP, relative, None, None, 0)
+        elif checked == [True, False, False, False]:
+            yield Operation(item, 'delete', BACKUP, relative, None, None, 0)
+        elif [checked[0], checked[1], checked[3]] == [False, False, True]:
+            yield overwrite(BACKUP, SOURCE, relative, size2)
+            if not checked[2]:
+                yield Operation(item, 'delete', BACKUP, relative, None, None, 0)
+        elif checked[1:] == [True, False, False]:
+            yield overwrite(SOURCE, BACKUP, relative, size1)
+            if not checked[0]:
+                yield Operation(item, 'delete', SOURCE, relative, None, None, 0)
+        elif checked[1:] == [True, True, False]:
+            yield Operation(item, 'rename', BACKUP, relative, BACKUP, new2, 0)
+            yield Operation(item, 'copy', SOURCE, relative, BACKUP, new1, size1)
+            if not checked[0]:
+                yield Operation(item, 'delete', SOURCE, relative, None, None, 0)
+        elif [checked[0], checked[1], checked[3]] == [True, False, True]:
+            yield Operation(item, 'rename', SOURCE, relative, SOURCE, new1, 0)
+            yield Operation(item, 'copy', BACKUP, relative, SOURCE, new2, size2)
+            if not checked[2]:
+                yield Operation(item, 'delete', BACKUP, relative, None, None, 0)
+        elif [checked[0], checked[1], checked[3]] == [True, True, True]:
+            yield Operation(item, 'rename', SOURCE, relative, SOURCE, new1, 0)
+            yield Operation(item, 'copy', BACKUP, relative, SOURCE, new2, size2)
+            if checked[2]:
+                yield Operation(item, 'copy', SOURCE, new1, BACKUP, new1, size1)
+                yield Operation(item, 'rename', BACKUP, relative, BACKUP, new2, 0)
+            else:
+                yield Operation(item, 'copy', SOURCE, new1, BACKUP, relative, size1)
+        elif checked == [False, True, False, True]:
+            temp = swap_name(relative)
+            yield Operation(item, 'move', SOURCE, relative, SOURCE, temp, 0)
+            yield Operation(item, 'move', BACKUP, relative, SOURCE, relative, size2)
+            yield Operation(item, 'move', SOURCE, temp, BACKUP, relative, size1)
+        elif checked == [False, True, True, True]:
+            yield Operation(item, 'copy', SOURCE, relative, BACKUP, new1, size1)
+            yield Operation(item, 'delete', SOURCE, relative, None, None, 0)
+            yield Operation(item, 'copy', BACKUP, relative, SOURCE, relative, size2)
+            yield Operation(item, 'rename', BACKUP, relative, BACKUP, new2, 0)
+        item += 1
+
+
+def write_plan(operations, file, directory_path, backup_path, items, exclude=()):
+    '''
+    Save a plan as JSON lines: a header with the absolute paths of the two directories and the exclusion rules followed by folder copies,
+    then one operation per line
+    '''
+
+    header = {'version': PLAN_VERSION, 'source': str(Path(directory_path).resolve()), 'backup': str(Path(backup_path).resolve()), 'items': items,
+              'exclude': list(exclude)}
+    file.write(json.dumps(header) + '\n')
+    for operation in operations:
+        file.write(json.dumps(operation._asdict()) + '\n')
+
+
+def safe_path(relative):
+    '''
+    Check whether a path of a plan stays below the root of its side: relative, not empty and without .. parts
+    '''
+
+    if not isinstance(relative, str) or not relative or PureWindowsPath(relative).drive:
+        return False
+    path = PurePosixPath(relative.replace('\\', '/'))
+    return not path.is_absolute() and '..' not in path.parts and path.parts != ()
+
+
+def counter(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def check_header(header):
+    '''
+    Check the header of a plan: a supported version, the two directories, the number of items and the exclusion patterns
+    (absent from plans written before they existed). Raise ValueError otherwise
+    '''
+
+    if not isinstance(header, dict):
+        raise ValueError('The first line of the plan is not a header')
+    if header.get('version') != PLAN_VERSION:
+        raise ValueError(f'Unsupported plan version {header.get("version")}')
+    for key in ['source', 'backup']:
+        if not isinstance(header.get(key), str) or not header[key]:
+            raise ValueError(f'The header of the plan has no {key} directory')
+    if not counter(header.get('items')):
+        raise ValueError('The header of the plan has no number of items')
+    exclude = header.get('exclude', [])
+    if not isinstance(exclude, list) or not all(isinstance(pattern, str) for pattern in exclude):
+        raise ValueError('The exclusion patterns of the plan must be a list of strings')
+
+
+def check_operation(operation):
+    '''
+    Check an operation read from a plan, which may have been edited or written elsewhere: a known operation, sides among source and backup
+    (no destination for removals) and paths that cannot leave the two directories. Raise ValueError otherwise
+    '''
+
+    if operation.op not in OPERATIONS:
+        raise ValueError(f'unknown operation {operation.op!r}')
+    if operation.src_side not in (SOURCE, BACKUP):
+        raise ValueError(f'unknown side {operation.src_side!r}')
+    if operation.dst_side not in ((None,) if operation.op in REMOVING else (SOURCE, BACKUP)):
+        raise ValueError(f'invalid destination side {operation.dst_side!r} for {operation.op}')
+    for path in [operation.src] if operation.op in REMOVING else [operation.src, operation.dst]:
+        if not safe_path(path):
+            raise ValueError(f'path {path!r} must be relative to the directory, without .. parts')
+    if not counter(operation.item) or not (operation.size is None or counter(operation.size)):
+        raise ValueError('item and size must be numbers, 0 or more')
+
+
+def parse_operation(number, line):
+    try:
+        operation = Operation(**json.loads(line))
+        check_operation(operation)
+    except (TypeError, ValueError) as error:
+        raise ValueError(f'Invalid operation on line {number} of the plan: {error}') from None
+    return operation
+
+
+def read_plan(file):
+    '''
+    Load a plan saved by write_plan, returning its header and a generator of its operations (read as they are consumed).
+    The header is checked at once (see check_header) and each operation as it is read (see check_operation),
+    raising ValueError for the first invalid one
+    '''
+
+    header = json.loads(file.readline())
+    check_header(header)
+    operations = (parse_operation(number, line) for number, line in enumerate(file, 2) if line.strip())
+    return header, operations
+
+
+def folder_stats(path, rules=None, relative=''):
+    '''
+    Number and total size of the files in a folder tree, leaving out what the rules exclude (relative is the path of the folder below their root)
+    '''
+
+    count = 0
+    size = 0
+    for folder, folders, files in os.walk(path):
+        if rules:
+            prefix = Path(relative, os.path.relpath(folder, path)).as_posix() + '/'
+            folders[:] = [name for name in folders if not rules.excluded(prefix + name, True)]
+            files = [name for name in files if not rules.excluded(prefix + name)]
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(folder, name)).st_size
+            except OSError:
+                continue
+            count += 1
+    return count, size
+
+
+def summarize(operations, directory_path, backup_path, rules=None, store=None):
+    '''
+    Dry run of a plan: count operations by kind and add up the files and bytes to copy, without touching any file.
+    Folder copies leave out what the rules exclude. With a store.Store, folders of the backup side are measured from its manifest
+    '''
+
+    roots = {SOURCE: Path(directory_path), BACKUP: Path(backup_path)}
+    counts = Counter()
+    files = 0
+    copied = 0
+    items = set()
+    for operation in operations:
+        counts[operation.op] += 1
+        items.add(operation.item)
+        if operation.size is None:
+            if store is not None and operation.src_side == BACKUP:
+                folder_files, folder_bytes = store.folder_stats(operation.src, rules)
+            else:
+                folder_files, folder_bytes = folder_stats(roots[operation.src_side] / operation.src, rules, operation.src)
+            files += folder_files
+            copied += folder_bytes
+        elif operation.op in COPYING:
+            files += 1
+            copied += operation.size
+    return {'operations': sum(counts.values()), 'items': len(items), 'files': files, 'bytes': copied, 'counts': dict(sorted(counts.items()))}
@@ -0,0 +1,201 @@
+from collections import Counter
+import contextlib
+import cProfile
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import threading
+import time
+
+REPORTS_NAME = '.smartbackup-reports' # folder of the backup root holding the run reports (starts with scanner.METADATA_PREFIX)
+kept_reports = 100 # most recent reports kept in the backup location
+
+# Profile of the run in progress, if any (a single analysis or backup runs at a time)
+current = None
+
+
+
+class RunProfile:
+    '''
+    Timings and counters of one analysis or backup run.
+    Spans add up the time spent in each named phase (across all threads) and counters add up syscalls, bytes and items.
+    Optionally the run is also recorded with cProfile (thread starting the run only) and as trace events, one per span,
+    in the Chrome trace format read by chrome://tracing and Perfetto.
+    '''
+
+    def __init__(self, kind, options=None, cprofile=False, trace=False):
+        self.kind = kind
+        self.options = options or {}
+        self.lock = threading.Lock()
+        self.spans = {} # {name: [seconds, count]}
+        self.counters = Counter()
+        self.stats = {}
+        self.events = [] if trace else None
+        self.started = datetime.now().astimezone()
+        self.start = time.perf_counter()
+        self.profiler = None
+        if cprofile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+
+    def add_span(self, name, start, end):
+        with self.lock:
+            span = self.spans.setdefault(name, [0.0, 0])
+            span[0] += end - start
+            span[1] += 1
+            if self.events is not None:
+                self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                    'ts': round((start - self.start) * 1e6), 'dur': round((end - start) * 1e6)})
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+
+    def report(self):
+        '''
+        Machine readable report of the run
+        '''
+
+        return {'kind': self.kind, 'started': self.started.isoformat(timespec='seconds'), 'seconds': round(time.perf_counter() - self.start, 6),
+                'python': platform.python_version(), 'platform': sys.platform, 'options': self.options,
+                'spans': {name: {'seconds': round(seconds, 6), 'count': count} for name, (seconds, count) in sorted(self.spans.items())},
+                'counters': dict(sorted(self.counters.items())), 'stats': self.stats}
+
+
+    def save(self, backup_path):
+        '''
+        Write the report (and the cProfile statistics and trace, if recorded) to the reports folder of the backup location.
+        Return the path of the report, or None if it cannot be written
+        '''
+
+        if self.profiler is not None:
+            self.profiler.disable()
+        folder = Path(backup_path) / REPORTS_NAME
+        name = f'{self.kind}-{self.started.strftime("%Y-%m-%d_%H-%M-%S")}-{self.started.microsecond // 1000:03d}'
+        try:
+            folder.mkdir(exist_ok=True)
+            path = folder / f'{name}.json'
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump(self.report(), file, indent=1)
+            if self.profiler is not None:
+                self.profiler.dump_stats(folder / f'{name}.prof')
+            if self.events is not None:
+                with open(folder / f'{name}.trace.json', 'w', encoding='utf-8') as file:
+                    json.dump({'traceEvents': self.events}, file)
+        except OSError:
+            print(f'Cannot write run report in {str(folder)}', file=sys.stderr)
+            return None
+        prune(folder)
+        return path
+
+
+def prune(folder):
+    '''
+    Remove the oldest reports beyond kept_reports
+    '''
+
+    reports = sorted(folder.glob('*.json'), key=lambda path: path.stat().st_mtime)
+    reports = [path for path in reports if not path.name.endswith('.trace.json')]
+    for path in reports[:-kept_reports]:
+        for related in [path, path.with_suffix('.prof'), path.with_name(path.stem + '.trace.json')]:
+            with contextlib.suppress(OSError):
+                related.unlink()
+
+
+class Span:
+    '''
+    Context manager timing a named phase of the current run
+    '''
+
+    __slots__ = ('name', 'profile', 'start')
+
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exception):
+        self.profile.add_span(self.name, self.start, time.perf_counter())
+
+
+def span(name):
+    '''
+    Time a block under a name: with profiling.span('scan'): ... (does nothing when no run is being profiled)
+    '''
+
+    profile = current
+    if profile is None:
+        return contextlib.nullcontext()
+    return Span(name, profile)
+
+
+def count(name, value=1):
+    '''
+    Add to a counter of the current run, if any
+    '''
+
+    profile = current
+    if profile is not None:
+        profile.count(name, value)
+
+
+def record(**stats):
+    '''
+    Add statistics to the report of the current run, if any
+    '''
+
+    profile = current
+    if profile is not None:
+        profile.stats.update(stats)
+
+
+def start(kind, options=None, cprofile=None, trace=None):
+    '''
+    Start profiling a run, unless one is already being profiled (its caller then saves it).
+    cprofile and trace default to the SMARTBACKUP_PROFILE and SMARTBACKUP_TRACE environment variables.
+    Return the new RunProfile, or None if a run was already being profiled
+    '''
+
+    global current
+    if current is not None:
+        return None
+    if cprofile is None:
+        cprofile = bool(os.environ.get('SMARTBACKUP_PROFILE'))
+    if trace is None:
+        trace = bool(os.environ.get('SMARTBACKUP_TRACE'))
+    current = RunProfile(kind, options, cprofile, trace)
+    return current
+
+
+def stop(profile):
+    '''
+    Stop collecting timings and counters for a run, without saving its report
+    '''
+
+    global current
+    if current is profile:
+        current = None
+    if profile.profiler is not None:
+        profile.profiler.disable()
+
+
+def finish(profile, backup_path):
+    '''
+    Stop profiling a run started with start and save its report in the backup location (nothing to do if profile is None)
+    '''
+
+    if profile is None:
+        return None
+    stop(profile)
+    return profile.save(backup_path)
@@ -0,0 +1,108 @@
+from collections import deque
+import json
+import threading
+import time
+
+file_weight = 256 * 1024 # work counted for each file or operation besides its bytes, as small files cost far more than their size
+report_interval = 0.2 # minimum seconds between progress reports
+rate_window = 5.0 # seconds of history used for the current rates
+
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class ProgressTracker:
+    '''
+    Progress of a backup run, weighted by bytes: each file counts for its size plus file_weight, so a large folder moves the bar
+    as it is copied rather than all at once. Fed from the copying threads with the bytes of each chunk and the files completed,
+    it computes the current MB/s, files/s and time left over the last rate_window seconds.
+    Reports go to progress(fraction, message), the same callback as before, and as JSON lines to an optional log file.
+    '''
+
+    def __init__(self, total_bytes, total_files, progress=None, log_file=None):
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.total_work = total_bytes + total_files * file_weight
+        self.progress = progress
+        self.log_file = log_file
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.files = 0
+        self.start = time.monotonic()
+        self.samples = deque([(self.start, 0, 0)]) # (time, bytes, files) over the last rate_window seconds
+        self.last_report = 0
+
+
+    def add_bytes(self, count):
+        '''
+        Count bytes processed (called from the copying threads, typically once per chunk)
+        '''
+
+        with self.lock:
+            self.bytes += count
+        self.report()
+
+
+    def add_files(self, count=1):
+        '''
+        Count files or operations completed
+        '''
+
+        with self.lock:
+            self.files += count
+        self.report()
+
+
+    @property
+    def fraction(self):
+        if self.total_work <= 0:
+            return 1
+        return min((self.bytes + self.files * file_weight) / self.total_work, 1)
+
+
+    def snapshot(self):
+        '''
+        Current state as a dictionary: done and total bytes and files, rates (per second) and estimated seconds left (None if unknown)
+        '''
+
+        now = time.monotonic()
+        with self.lock:
+            self.samples.append((now, self.bytes, self.files))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= rate_window:
+                self.samples.popleft()
+            start, start_bytes, start_files = self.samples[0]
+            elapsed = now - start
+            bytes_per_second = (self.bytes - start_bytes) / elapsed if elapsed > 0 else 0
+            files_per_second = (self.files - start_files) / elapsed if elapsed > 0 else 0
+            work_rate = bytes_per_second + files_per_second * file_weight
+            remaining = max(self.total_work - self.bytes - self.files * file_weight, 0)
+            return {'fraction': round(self.fraction, 4), 'bytes': self.bytes, 'total_bytes': self.total_bytes, 'files': self.files,
+                    'total_files': self.total_files, 'bytes_per_second': round(bytes_per_second), 'files_per_second': round(files_per_second, 1),
+                    'eta': round(remaining / work_rate, 1) if work_rate > 0 else None, 'elapsed': round(now - self.start, 3)}
+
+
+    def message(self, snapshot):
+        eta = '' if snapshot['eta'] is None else f', {format_duration(snapshot["eta"])} left'
+        return f'Copying at {snapshot["bytes_per_second"] / 1e6:.1f} MB/s, {snapshot["files_per_second"]:.0f} files/s{eta}'
+
+
+    def report(self, force=False):
+        '''
+        Send a snapshot to the progress callback and the log, at most once every report_interval seconds unless forced
+        '''
+
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_report < report_interval:
+                return
+            self.last_report = now
+        snapshot = self.snapshot()
+        if self.progress is not None:
+            self.progress(snapshot['fraction'], self.message(snapshot))
+        if self.log_file is not None:
+            with self.lock:
+                self.log_file.write(json.dumps(snapshot) + '\n')
+                self.log_file.flush()
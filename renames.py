@@ -0,0 +1,155 @@
+from collections import defaultdict
+from hashing import content_differs, hash_file
+import hashlib
+import os
+import profiling
+from scanner import FOLDER, scan_directory
+
+
+
+def file_mtime(path):
+    '''
+    Date modified of a file in seconds, or None if it cannot be read
+    '''
+
+    try:
+        return os.stat(path).st_mtime_ns // 1_000_000_000
+    except OSError:
+        return None
+
+
+def folder_signature(path, rules=None, relative='', list_folder=scan_directory):
+    '''
+    Number of files, total size and fingerprint of a folder tree: a digest of the relative path, size and date modified (in seconds)
+    of everything inside, so two folders with the same signature hold the same files under the same names.
+    list_folder lists each folder (see scanner.scan_directory)
+    '''
+
+    count = 0
+    size = 0
+    lines = []
+    stack = ['']
+    while stack:
+        inner = stack.pop()
+        listing = list_folder(path / inner if inner else path, rules, f'{relative}/{inner}'.strip('/'))
+        for name, entry in listing.items():
+            child = f'{inner}/{name}' if inner else name
+            if entry.kind == FOLDER:
+                stack.append(child)
+                lines.append(f'{child}/')
+            else:
+                count += 1
+                size += entry.size
+                lines.append(f'{child}\0{entry.size}\0{entry.mtime_ns // 1_000_000_000}')
+    digest = hashlib.blake2b('\n'.join(sorted(lines)).encode('utf-8', 'surrogateescape'), digest_size=20).digest()
+    return count, size, digest
+
+
+def match_files(results, hash_cache=None, compression=None):
+    '''
+    Pair files only in the source with files only in the backup having the same size, date modified and contents.
+    Backup files are bucketed by size, so only files of equal size are ever compared; dates are read for those only,
+    and contents are compared last (see hashing.content_differs), against the recorded digest for compressed backup files.
+    Empty files are never paired. Return the (source index, backup index) pairs
+    '''
+
+    source, backup = results.unique_files_dir, results.unique_files_backup
+    buckets = defaultdict(list)
+    for j in range(len(backup)):
+        if backup.sizes[j]:
+            buckets[backup.sizes[j]].append(j)
+    if not buckets:
+        return []
+
+    pairs = []
+    backup_mtimes = {}
+    for i in range(len(source)):
+        candidates = buckets.get(source.sizes[i])
+        if not candidates:
+            continue
+        path = source.path(i)
+        mtime = file_mtime(path)
+        for j in candidates:
+            if j not in backup_mtimes:
+                backup_mtimes[j] = file_mtime(backup.path(j))
+            if mtime is None or backup_mtimes[j] != mtime:
+                continue
+            try:
+                compressed = compression.lookup(backup.path(j)) if compression is not None else None
+                if compressed is not None:
+                    if (hash_cache.digest(path) if hash_cache is not None else hash_file(path)) != compressed[2]:
+                        continue
+                elif content_differs(path, source.sizes[i], backup.path(j), backup.sizes[j], hash_cache):
+                    continue
+            except OSError:
+                continue
+            pairs.append((i, j))
+            candidates.remove(j) # each backup file is paired once
+            break
+    return pairs
+
+
+def match_folders(results, rules=None, compression=None):
+    '''
+    Pair folders only in the source with folders only in the backup holding the same files (see folder_signature).
+    Folders are first bucketed by their number of entries, from a single listing, and only the folders whose number is found
+    on the other side are walked: backup folders first, stopping if none is left, then source folders. Their signatures are then
+    bucketed by number of files and total size before their fingerprints are compared. Empty folders are never paired.
+    Backup folders are listed with the original sizes of their compressed files.
+    Return the (source index, backup index, total size) triples
+    '''
+
+    source, backup = results.unique_folders_dir, results.unique_folders_backup
+    if not len(source) or not len(backup):
+        return []
+
+    def entries(table, i):
+        return len(scan_directory(table.path(i), rules, table.relative_path(i)))
+
+    source_entries = [entries(source, i) for i in range(len(source))]
+    candidates = set(source_entries) - {0}
+    buckets = defaultdict(list)
+    list_folder = compression.listing if compression is not None else scan_directory
+    for j in range(len(backup)):
+        if entries(backup, j) not in candidates:
+            continue
+        count, size, digest = folder_signature(backup.path(j), rules, backup.relative_path(j), list_folder)
+        if count:
+            buckets[count, size].append((j, digest))
+    if not buckets:
+        return []
+
+    pairs = []
+    for i in range(len(source)):
+        if source_entries[i] not in candidates:
+            continue
+        count, size, digest = folder_signature(source.path(i), rules, source.relative_path(i))
+        bucket = buckets.get((count, size), [])
+        for candidate in bucket:
+            if candidate[1] == digest:
+                pairs.append((i, candidate[0], size))
+                bucket.remove(candidate)
+                break
+    return pairs
+
+
+def split(relative):
+    folder, _, name = relative.rpartition('/')
+    return folder, name
+
+
+def detect_renames(results, hash_cache=None, rules=None, compression=None):
+    '''
+    Move the entries of the comparison results that were renamed or moved, folders and files, from the unique tables to results.renames.
+    Compressed files of the backup are matched by their original sizes and recorded digests (see compressor)
+    '''
+
+    with profiling.span('renames'):
+        for source, backup, pairs, is_folder in [
+                (results.unique_folders_dir, results.unique_folders_backup, match_folders(results, rules, compression), True),
+                (results.unique_files_dir, results.unique_files_backup, [(i, j, results.unique_files_dir.sizes[i]) for i, j in match_files(results, hash_cache, compression)], False)]:
+            for i, j, size in pairs:
+                results.renames.append(*split(source.relative_path(i)), *split(backup.relative_path(j)), size, is_folder)
+            source.remove(i for i, _, _ in pairs)
+            backup.remove(j for _, j, _ in pairs)
+            profiling.count('renamed_folders' if is_folder else 'renamed_files', len(pairs))
@@ -0,0 +1,220 @@
+from array import array
+import os
+from pathlib import Path
+
+# Decision bits for items found in one directory only
+KEEP = 1
+COPY = 2
+
+# Decision bits for files with different dates modified
+KEEP_SOURCE = 1
+COPY_TO_BACKUP = 2
+KEEP_BACKUP = 4
+COPY_TO_SOURCE = 8
+
+# Decision bit for entries found under another path in the backup (otherwise the new path is copied and the old one kept)
+RENAME = 1
+
+
+
+class PathTable:
+    '''
+    Compact list of paths under a root, with a decision bitmask for each path.
+    Parent folders are interned, names are packed back to back in one buffer and Path objects are only built on access.
+    '''
+
+    def __init__(self, root, default=0):
+        self.root = Path(root)
+        self.default = default
+        self.folders = [] # interned parent folders, relative to root ('' for the root itself)
+        self.folder_ids = {}
+        self.parents = array('I') # index in folders of each path's parent
+        self.names = bytearray() # file system encoded names
+        self.offsets = array('Q', [0]) # start of each name in names, followed by the end of the last one
+        self.sizes = array('Q') # file sizes in bytes (0 for folders)
+        self.decisions = bytearray()
+
+
+    def append(self, folder, name, size=0, decision=None):
+        '''
+        Add the path folder/name (folder relative to the root)
+        '''
+
+        folder_id = self.folder_ids.get(folder)
+        if folder_id is None:
+            folder_id = self.folder_ids[folder] = len(self.folders)
+            self.folders.append(folder)
+        self.parents.append(folder_id)
+        self.names += os.fsencode(name)
+        self.offsets.append(len(self.names))
+        self.sizes.append(size)
+        self.decisions.append(self.default if decision is None else decision)
+
+
+    def __len__(self):
+        return len(self.parents)
+
+
+    def __getitem__(self, i):
+        return self.path(i)
+
+
+    def __iter__(self):
+        return (self.path(i) for i in range(len(self)))
+
+
+    def name(self, i):
+        return os.fsdecode(bytes(self.names[self.offsets[i]:self.offsets[i + 1]]))
+
+
+    def relative_path(self, i):
+        '''
+        Path relative to the root, as a string with / separators
+        '''
+
+        folder = self.folders[self.parents[i]]
+        return f'{folder}/{self.name(i)}' if folder else self.name(i)
+
+
+    def path(self, i):
+        return self.root / self.relative_path(i)
+
+
+    def checked(self, i, bits):
+        '''
+        Decision of a path as a list of booleans, one per bit
+        '''
+
+        decision = self.decisions[i]
+        return [bool(decision & bit) for bit in bits]
+
+
+    def set_checked(self, i, bit, checked):
+        if checked:
+            self.decisions[i] |= bit
+        else:
+            self.decisions[i] &= ~bit
+
+
+    def remove(self, indexes):
+        '''
+        Remove the paths at the given indexes, rebuilding the packed columns
+        '''
+
+        indexes = set(indexes)
+        if not indexes:
+            return
+        parents, names, offsets, sizes, decisions = array('I'), bytearray(), array('Q', [0]), array('Q'), bytearray()
+        for i in range(len(self)):
+            if i in indexes:
+                continue
+            parents.append(self.parents[i])
+            names += self.names[self.offsets[i]:self.offsets[i + 1]]
+            offsets.append(len(names))
+            sizes.append(self.sizes[i])
+            decisions.append(self.decisions[i])
+        self.parents, self.names, self.offsets, self.sizes, self.decisions = parents, names, offsets, sizes, decisions
+
+
+
+class DatesTable(PathTable):
+    '''
+    Compact list of files present on both sides with different dates modified (in seconds),
+    flagged by whether their contents differ. Items are (source path, backup path, date1, date2, content_differs) tuples.
+    sizes holds the sizes in the source directory, sizes2 those in the backup directory.
+    '''
+
+    def __init__(self, root, other_root):
+        super().__init__(root)
+        self.other_root = Path(other_root)
+        self.dates1 = array('q')
+        self.dates2 = array('q')
+        self.sizes2 = array('Q')
+        self.content = bytearray()
+
+
+    def append(self, folder, name, date1, date2, content_differs=True, size1=0, size2=0, decision=None, mtime_ns1=None, mtime_ns2=None):
+        '''
+        Add a file, by default copying the most recent version to the other side, or keeping both if only the metadata differs
+        or neither is more recent. The dates modified in nanoseconds, if given, decide between versions saved within the same second
+        '''
+
+        if decision is None:
+            newer1, newer2 = (date1, date2) if mtime_ns1 is None or mtime_ns2 is None else (mtime_ns1, mtime_ns2)
+            if not content_differs or newer1 == newer2:
+                decision = KEEP_SOURCE | KEEP_BACKUP
+            elif newer1 > newer2:
+                decision = KEEP_SOURCE | COPY_TO_BACKUP
+            else:
+                decision = KEEP_BACKUP | COPY_TO_SOURCE
+        super().append(folder, name, size1, decision)
+        self.dates1.append(date1)
+        self.dates2.append(date2)
+        self.sizes2.append(size2)
+        self.content.append(content_differs)
+
+
+    def __getitem__(self, i):
+        relative_path = self.relative_path(i)
+        return (self.root / relative_path, self.other_root / relative_path, self.dates1[i], self.dates2[i], bool(self.content[i]))
+
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+
+class RenameTable(PathTable):
+    '''
+    Compact list of files and folders only found in the source at one path and only in the backup at another one,
+    with the same contents: they were renamed or moved, and the backup copy can be renamed instead of copying them again.
+    Paths are those in the source, old_paths holds the matching paths in the backup. Items are (source path, backup path) tuples.
+    '''
+
+    def __init__(self, root, other_root):
+        super().__init__(root, RENAME)
+        self.old_paths = PathTable(other_root)
+        self.folder = bytearray()
+
+
+    def append(self, folder, name, old_folder, old_name, size=0, is_folder=False, decision=None):
+        '''
+        Add an entry at folder/name in the source and old_folder/old_name in the backup, renamed by default
+        '''
+
+        super().append(folder, name, size, decision)
+        self.old_paths.append(old_folder, old_name, size)
+        self.folder.append(is_folder)
+
+
+    def __getitem__(self, i):
+        return (self.path(i), self.old_paths.path(i))
+
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+
+class ComparisonResults:
+    '''
+    Differences found between a source and a backup directory, with the user decisions for each of them.
+    By default everything is kept, and only what is in the source directory is copied to the backup.
+    exclude holds the exclusion rules the directories were compared with (see rules.RuleSet), which copies of whole folders also follow.
+    '''
+
+    def __init__(self, directory_path, backup_path, exclude=()):
+        self.directory_path = Path(directory_path)
+        self.backup_path = Path(backup_path)
+        self.exclude = list(exclude)
+        self.unique_files_dir = PathTable(directory_path, KEEP | COPY)
+        self.unique_files_backup = PathTable(backup_path, KEEP)
+        self.unique_folders_dir = PathTable(directory_path, KEEP | COPY)
+        self.unique_folders_backup = PathTable(backup_path, KEEP)
+        self.different_dates = DatesTable(directory_path, backup_path)
+        self.renames = RenameTable(directory_path, backup_path)
+
+
+    def __len__(self):
+        return (len(self.unique_files_dir) + len(self.unique_files_backup) + len(self.unique_folders_dir) + len(self.unique_folders_backup)
+                + len(self.different_dates) + len(self.renames))
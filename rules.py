@@ -0,0 +1,176 @@
+import hashlib
+from pathlib import Path
+import re
+from scanner import METADATA_PREFIX
+
+IGNORE_NAME = METADATA_PREFIX + '-ignore' # rule file read from the root of the source and of the backup directory
+SPECIAL = set('*?[\\') # characters making a pattern more than a plain name
+
+
+
+def translate(pattern):
+    '''
+    Regular expression matching the same relative paths as a gitignore glob:
+    * and ? match within a name, [...] matches a character class, **/ matches any number of folders and a final /** everything inside
+    '''
+
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i) and i + 2 == len(pattern) and i > 0 and pattern[i - 1] == '/':
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+            while pattern.startswith('*', i + 1):
+                i += 1
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and pattern.find(']', i + 2) >= 0:
+            end = pattern.find(']', i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^/' + body[1:]
+            regex += '[' + body.replace('\\', '\\\\') + ']'
+            i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+def parse(line):
+    '''
+    Parse one line of a rule file into (negate, folders only, pattern, anchored), or None for blank lines and comments
+    '''
+
+    line = line.rstrip('\r\n').rstrip(' ')
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    folders_only = line.endswith('/')
+    line = line.rstrip('/')
+    anchored = '/' in line # patterns with a slash are relative to the root, others match names at any depth
+    line = line.lstrip('/')
+    if not line:
+        return None
+    return negate, folders_only, line, anchored
+
+
+class RuleSet:
+    '''
+    Exclusion rules with the syntax of gitignore files: one glob per line, the last matching rule wins, ! re-includes what an earlier rule excluded,
+    a trailing / only matches folders and a pattern containing / is relative to the root. A folder that is excluded is never entered,
+    so nothing inside it can be included again.
+    Consecutive rules of the same kind are compiled together: plain names are looked up in a set, the other globs in one regular expression.
+    '''
+
+    def __init__(self, patterns=()):
+        self.patterns = list(patterns)
+        self.groups = [] # (negate, folders only, plain names, regular expression or None)
+        parts = []
+        for line in self.patterns:
+            rule = parse(line)
+            if rule is None:
+                continue
+            negate, folders_only, pattern, anchored = rule
+            if not self.groups or self.groups[-1][:2] != (negate, folders_only):
+                self.compile_group(parts)
+                self.groups.append((negate, folders_only, set(), None))
+                parts = []
+            if not anchored and not SPECIAL & set(pattern):
+                self.groups[-1][2].add(pattern)
+            else:
+                parts.append(translate(pattern) if anchored else '(?:.*/)?' + translate(pattern))
+        self.compile_group(parts)
+
+
+    def compile_group(self, parts):
+        if parts:
+            negate, folders_only, names, _ = self.groups[-1]
+            self.groups[-1] = (negate, folders_only, names, re.compile('|'.join(f'(?:{part})' for part in parts), re.DOTALL))
+
+
+    def __bool__(self):
+        return bool(self.groups)
+
+
+    @property
+    def digest(self):
+        '''
+        Fingerprint of the rules, telling whether listings filtered with them can be reused
+        '''
+
+        return hashlib.sha1('\n'.join(self.patterns).encode('utf-8')).hexdigest() if self else ''
+
+
+    def excluded(self, relative, folder=False):
+        '''
+        Check whether a path relative to the root (with / separators) is excluded, assuming its parent folders are not
+        '''
+
+        name = relative.rpartition('/')[2]
+        for negate, folders_only, names, regex in reversed(self.groups):
+            if folders_only and not folder:
+                continue
+            if name in names or (regex is not None and regex.fullmatch(relative)):
+                return not negate
+        return False
+
+
+    def excluded_path(self, relative, folder=True):
+        '''
+        Check whether a path or one of its parent folders is excluded
+        '''
+
+        parts = relative.split('/') if relative else []
+        for i in range(1, len(parts) + 1):
+            if self.excluded('/'.join(parts[:i]), folder or i < len(parts)):
+                return True
+        return False
+
+
+    def ignore(self, root):
+        '''
+        Function for shutil.copytree leaving out the excluded names, for a copy of a folder below root
+        '''
+
+        root = Path(root)
+
+        def ignored(folder, names):
+            relative = Path(folder).relative_to(root).as_posix()
+            prefix = '' if relative == '.' else relative + '/'
+            return {name for name in names if self.excluded(prefix + name, (Path(folder) / name).is_dir())}
+
+        return ignored
+
+
+def read_rules(path):
+    '''
+    Lines of a rule file, or no lines if there is none
+    '''
+
+    try:
+        with open(path, encoding='utf-8') as file:
+            return file.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def load(directory_path, backup_path, patterns=()):
+    '''
+    Rules of a source and backup pair: those of the rule files at the root of both directories, then the given patterns
+    '''
+
+    return RuleSet(read_rules(Path(directory_path) / IGNORE_NAME) + read_rules(Path(backup_path) / IGNORE_NAME) + list(patterns))
@@ -0,0 +1,92 @@
+from pathlib import Path
+from scanner import METADATA_PREFIX, Entry
+import sqlite3
+import threading
+
+INDEX_NAME = METADATA_PREFIX + '-index.sqlite'
+flush_size = 10000 # buffered entries written to the database at once
+
+
+
+class ScanIndex:
+    '''
+    On-disk record of the folder listings found by a comparison, stored in the backup root for each (source, backup) pair.
+    A folder whose modification time has not changed since it was recorded can be listed from the index instead of the disk.
+    Listings are recorded without the paths excluded by the rules, so they are not reused once the rules (rules_digest) change.
+    '''
+
+    def __init__(self, directory_path, backup_path, reuse=True, rules_digest=''):
+        self.reuse = reuse
+        self.path = Path(backup_path) / INDEX_NAME
+        self.connection = sqlite3.connect(self.path, check_same_thread=False) # used by the scanning threads under self.lock
+        self.lock = threading.Lock()
+        self.updates = []
+        self.buffered = 0
+
+        with self.lock, self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS pairs (id INTEGER PRIMARY KEY, source TEXT UNIQUE);
+                CREATE TABLE IF NOT EXISTS rules (pair INTEGER PRIMARY KEY, digest TEXT);
+                CREATE TABLE IF NOT EXISTS folders (pair INTEGER, side INTEGER, path TEXT, mtime_ns INTEGER, PRIMARY KEY (pair, side, path)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS entries (pair INTEGER, side INTEGER, folder TEXT, name TEXT, kind INTEGER, size INTEGER, mtime_ns INTEGER,
+                                                    PRIMARY KEY (pair, side, folder, name)) WITHOUT ROWID;
+            ''')
+            source = str(Path(directory_path).resolve())
+            self.connection.execute('INSERT OR IGNORE INTO pairs (source) VALUES (?)', (source,))
+            self.pair = self.connection.execute('SELECT id FROM pairs WHERE source = ?', (source,)).fetchone()[0]
+            row = self.connection.execute('SELECT digest FROM rules WHERE pair = ?', (self.pair,)).fetchone()
+            if (row[0] if row else '') != rules_digest:
+                self.reuse = False
+                self.connection.execute('INSERT OR REPLACE INTO rules VALUES (?, ?)', (self.pair, rules_digest))
+
+
+    def lookup(self, side, folder, mtime_ns):
+        '''
+        Recorded listing of a folder ({name: Entry}), or None if the folder changed or was never recorded
+        '''
+
+        if not self.reuse:
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT mtime_ns FROM folders WHERE pair = ? AND side = ? AND path = ?', (self.pair, side, folder)).fetchone()
+            if row is None or row[0] != mtime_ns:
+                return None
+            rows = self.connection.execute('SELECT name, kind, size, mtime_ns FROM entries WHERE pair = ? AND side = ? AND folder = ?', (self.pair, side, folder)).fetchall()
+        return {row[0]: Entry(*row) for row in rows}
+
+
+    def record(self, side, folder, mtime_ns, listing):
+        '''
+        Remember the listing of a folder, written to disk in batches
+        '''
+
+        with self.lock:
+            self.updates.append((side, folder, mtime_ns, list(listing.values())))
+            self.buffered += len(listing) + 1
+            if self.buffered >= flush_size:
+                self.flush()
+
+
+    def flush(self):
+        '''
+        Write buffered listings (called with self.lock held)
+        '''
+
+        with self.connection:
+            for side, folder, mtime_ns, entries in self.updates:
+                self.connection.execute('DELETE FROM entries WHERE pair = ? AND side = ? AND folder = ?', (self.pair, side, folder))
+                self.connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                            ((self.pair, side, folder) + tuple(entry) for entry in entries))
+                self.connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)', (self.pair, side, folder, mtime_ns))
+        self.updates.clear()
+        self.buffered = 0
+
+
+    def close(self):
+        '''
+        Write pending listings and close the database
+        '''
+
+        with self.lock:
+            self.flush()
+            self.connection.close()
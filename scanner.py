@@ -0,0 +1,338 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from copying import PARTIAL_PREFIX
+from hashing import content_differs, hash_file
+import os
+from pathlib import Path
+from plan import SWAP_PREFIX
+import profiling
+from results import ComparisonResults
+import sys
+
+# Kinds of directory entries
+FILE = 0
+FOLDER = 1
+
+# Sides of a comparison
+SOURCE = 0
+BACKUP = 1
+
+# Names in the backup root starting with this prefix hold SmartBackup's own data and are never compared
+METADATA_PREFIX = '.smartbackup'
+
+# Compact description of a directory entry (folders have size 0 and mtime_ns 0)
+Entry = namedtuple('Entry', ['name', 'kind', 'size', 'mtime_ns'])
+
+
+
+def scan_directory(path, rules=None, relative='', stats=None):
+    '''
+    List a directory with a single os.scandir pass, returning {name: Entry}.
+    Entries excluded by the rules (a rules.RuleSet, given the path relative to the root of the folder) are left out before they are stat'ed.
+    The stat results of the files are also stored in stats ({name: os.stat_result}), if given
+    '''
+
+    listing = {}
+    stat_calls = 0
+    excluded = 0
+    prefix = relative + '/' if relative else ''
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    # Entry type comes from the cached directory data, only files need a stat call
+                    folder = entry.is_dir()
+                    if rules and rules.excluded(prefix + entry.name, folder):
+                        excluded += 1
+                        continue
+                    if folder:
+                        listing[entry.name] = Entry(entry.name, FOLDER, 0, 0)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        stat_calls += 1
+                        listing[entry.name] = Entry(entry.name, FILE, stat.st_size, stat.st_mtime_ns)
+                        if stats is not None:
+                            stats[entry.name] = stat
+                except OSError: # entry vanished or cannot be inspected
+                    continue
+    except PermissionError:
+        print(f'Permission error on {str(path)}', file=sys.stderr)
+    except FileNotFoundError: # removed since its parent was listed
+        pass
+    profiling.count('scandir')
+    profiling.count('stat', stat_calls)
+    profiling.count('entries', len(listing))
+    if excluded:
+        profiling.count('excluded', excluded)
+    return listing
+
+
+def split_listing(listing):
+    '''
+    Split a directory listing into files and folders
+    '''
+
+    files = {}
+    folders = {}
+    for name, entry in listing.items():
+        if entry.kind == FILE:
+            files[name] = entry
+        else:
+            folders[name] = entry
+    return files, folders
+
+
+class Comparison:
+    '''
+    Iterative comparison of a source and a backup directory, driven by an explicit work queue.
+    The comparison can be paused at any time and resumed by calling run again.
+    With workers > 1, folders on both sides are listed in a thread pool ahead of the comparison.
+    With a ScanIndex, folders whose modification time has not changed are listed from the index.
+    Common files with different modification times are listed in results.different_dates with a flag telling whether their contents differ:
+    without verify_content it is always set, with verify_content it comes from comparing sizes and then hashes.
+    With folders (paths relative to the roots, present on both sides), only those folders are compared, without their common subfolders.
+    Paths excluded by the rules (a rules.RuleSet) are left out of the listings, so excluded folders are never entered.
+    With a store.Store, the backup side is listed from its manifest and contents are verified against the digests it records.
+    With a compressor.Compression, compressed backup files are listed with their original sizes and verified against their recorded digests.
+    '''
+
+    def __init__(self, directory_path, backup_path, workers=1, index=None, verify_content=False, hash_cache=None, folders=None, rules=None,
+                 store=None, compression=None):
+        self.directory_path = Path(directory_path)
+        self.backup_path = Path(backup_path)
+
+        # Paths for user decision
+        self.leftovers = [] # temporary files of interrupted runs found on either side (see drop_temporary)
+        self.results = ComparisonResults(self.directory_path, self.backup_path, rules.patterns if rules is not None else ())
+
+        # Pairs of common folders (with their relative path) still to compare, used as a stack so folders are visited depth first
+        self.recursive = folders is None
+        if folders is None:
+            self.pending = [(self.directory_path, self.backup_path, '')]
+        else:
+            self.pending = [(self.directory_path / relative, self.backup_path / relative, relative) for relative in reversed(folders)]
+        self.done = 0
+        self.current = self.directory_path
+        self.paused = False
+
+        # Parallel scanning: listings submitted ahead of time for the top of the stack
+        self.workers = workers
+        self.pool = None
+        self.listings = {}
+        self.index = index
+        self.verify_content = verify_content
+        self.hash_cache = hash_cache
+        self.rules = rules
+        self.store = store
+        self.compression = compression
+
+
+    @property
+    def finished(self):
+        return not self.pending
+
+
+    @property
+    def progress(self):
+        '''
+        Fraction of the folders discovered so far that have been compared
+        '''
+
+        return self.done / (self.done + len(self.pending))
+
+
+    def pause(self):
+        '''
+        Stop run after the folder being compared (safe to call from another thread)
+        '''
+
+        self.paused = True
+
+
+    def run(self, max_steps=None):
+        '''
+        Compare folders from the queue until finished, paused or max_steps folders have been compared.
+        Return True if the whole comparison is finished
+        '''
+
+        self.paused = False
+        steps = 0
+        while self.pending and not self.paused and (max_steps is None or steps < max_steps):
+            self.step()
+            steps += 1
+        if self.finished:
+            self.close()
+        return self.finished
+
+
+    def close(self):
+        '''
+        Shut down the scanning thread pool, if any
+        '''
+
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+            self.listings.clear()
+
+
+    def list_pair(self, path1, path2, relative):
+        '''
+        List both folders of a pair, from the thread pool when scanning in parallel
+        '''
+
+        if self.workers <= 1:
+            return self.scan(SOURCE, path1, relative), self.scan(BACKUP, path2, relative)
+
+        futures = self.listings.pop((path1, path2, relative), None) or self.submit(path1, path2, relative)
+        self.prefetch()
+        return futures[0].result(), futures[1].result()
+
+
+    def submit(self, path1, path2, relative):
+        '''
+        Start listing both folders of a pair in the thread pool
+        '''
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scan')
+        return self.pool.submit(self.scan, SOURCE, path1, relative), self.pool.submit(self.scan, BACKUP, path2, relative)
+
+
+    def scan(self, side, path, relative):
+        '''
+        List one folder, going through the index when there is one
+        '''
+
+        if side == BACKUP and self.store is not None:
+            return self.store.listing(relative, self.rules)
+        list_folder = self.compression.listing if side == BACKUP and self.compression is not None else scan_directory
+        if self.index is None:
+            return list_folder(path, self.rules, relative)
+
+        # Read the folder modification time before listing, so a change during the scan is seen next time
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return list_folder(path, self.rules, relative)
+        listing = self.index.lookup(side, relative, mtime_ns)
+        if listing is None:
+            listing = list_folder(path, self.rules, relative)
+            self.index.record(side, relative, mtime_ns, listing)
+        else:
+            profiling.count('index_hits')
+        return listing
+
+
+    def prefetch(self):
+        '''
+        Keep the next pairs on the stack (as many as workers) listing in the background
+        '''
+
+        for pair in self.pending[-self.workers:]:
+            if pair not in self.listings:
+                self.listings[pair] = self.submit(*pair)
+
+
+    def drop_temporary(self, path, listing):
+        '''
+        Leave out of a listing the temporary files a backup writes next to their destination, at any depth (partial copies and swaps),
+        recording them in self.leftovers
+        '''
+
+        temporary = [name for name in listing if name.startswith((PARTIAL_PREFIX, SWAP_PREFIX))]
+        if not temporary:
+            return listing
+        self.leftovers += [path / name for name in temporary]
+        return {name: entry for name, entry in listing.items() if name not in temporary}
+
+
+    def step(self):
+        '''
+        Compare the next pair of folders in the queue
+        '''
+
+        path1, path2, relative = self.pending.pop()
+        self.current = path1
+
+        # List both paths with a single scan each
+        with profiling.span('list'):
+            listing1, listing2 = self.list_pair(path1, path2, relative)
+        listing1 = self.drop_temporary(path1, listing1)
+        listing2 = self.drop_temporary(path2, listing2)
+        if not relative:
+            listing1 = {name: entry for name, entry in listing1.items() if not name.startswith(METADATA_PREFIX)}
+            listing2 = {name: entry for name, entry in listing2.items() if not name.startswith(METADATA_PREFIX)}
+        files1, folders1 = split_listing(listing1)
+        files2, folders2 = split_listing(listing2)
+
+        # Files in path1 but not in path2
+        results = self.results
+        for file_name, entry1 in files1.items():
+            if file_name not in files2:
+                results.unique_files_dir.append(relative, file_name, entry1.size)
+
+        # Files in path2 but not in path1
+        for file_name, entry2 in files2.items():
+            if file_name not in files1:
+                results.unique_files_backup.append(relative, file_name, entry2.size)
+
+        # Files in both paths with different date edited (modification times come from the scan)
+        for file_name, entry1 in files1.items():
+            if file_name in files2:
+                entry2 = files2[file_name]
+                differs = self.classify(path1, path2, entry1, entry2, relative)
+                if differs is not None:
+                    results.different_dates.append(relative, file_name, entry1.mtime_ns // 1_000_000_000, entry2.mtime_ns // 1_000_000_000, differs,
+                                                   entry1.size, entry2.size, mtime_ns1=entry1.mtime_ns, mtime_ns2=entry2.mtime_ns)
+
+        # Folders in path1 but not in path2
+        for folder_name in folders1:
+            if folder_name not in folders2:
+                results.unique_folders_dir.append(relative, folder_name)
+
+        # Folders in path2 but not in path1
+        for folder_name in folders2:
+            if folder_name not in folders1:
+                results.unique_folders_backup.append(relative, folder_name)
+
+        # Common folders (queued in reverse so they are popped in listing order)
+        if self.recursive:
+            common_folders = [folder_name for folder_name in folders1 if folder_name in folders2]
+            prefix = relative + '/' if relative else ''
+            self.pending.extend((path1 / folder_name, path2 / folder_name, prefix + folder_name) for folder_name in reversed(common_folders))
+        self.done += 1
+        if self.workers > 1:
+            self.prefetch()
+
+
+    def digest(self, path):
+        return self.hash_cache.digest(path) if self.hash_cache is not None else hash_file(path)
+
+
+    def classify(self, path1, path2, entry1, entry2, relative=''):
+        '''
+        Classify a file present in both folders (relative is the path of the folders): None if no decision is needed,
+        otherwise True if the contents differ and False if only the metadata does
+        '''
+
+        if not self.verify_content:
+            if entry1.mtime_ns // 1_000_000_000 == entry2.mtime_ns // 1_000_000_000:
+                return None
+            return True
+
+        # Content verification: files with identical modification times are only checked by size
+        if entry1.mtime_ns == entry2.mtime_ns:
+            return True if entry1.size != entry2.size else None
+        try:
+            with profiling.span('verify'):
+                if self.store is not None:
+                    stored = self.store.entry(f'{relative}/{entry2.name}'.lstrip('/'))
+                    return entry1.size != entry2.size or self.digest(path1 / entry1.name).hex() != stored[3]
+                compressed = self.compression.lookup(path2 / entry2.name) if self.compression is not None else None
+                if compressed is not None:
+                    return entry1.size != entry2.size or self.digest(path1 / entry1.name) != compressed[2]
+                return content_differs(path1 / entry1.name, entry1.size, path2 / entry2.name, entry2.size, self.hash_cache)
+        except OSError:
+            print(f'Cannot read {str(path1 / entry1.name)} to compare contents', file=sys.stderr)
+            return True
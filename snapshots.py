@@ -0,0 +1,212 @@
+import compressor
+import contextlib
+import copying
+from datetime import datetime
+import errno
+import json
+import os
+from pathlib import Path
+import profiling
+from scanner import METADATA_PREFIX
+import shutil
+from store import Store
+
+SNAPSHOTS_NAME = METADATA_PREFIX + '-snapshots' # folder of the backup root holding the generations, one folder each
+POLICY_NAME = 'retention.json' # retention policy in the snapshots folder, snapshots are taken after each backup while it exists
+NAME_FORMAT = '%Y-%m-%d_%H-%M-%S' # generation names, sorting in chronological order
+PARTIAL_SUFFIX = '.partial' # generations being created, renamed once complete
+
+# Generations kept by default: the most recent ones, then the last one of each of the most recent days, weeks and months.
+# min_interval is the minimum number of seconds between two snapshots taken after a backup (useful with watch, which backs up often)
+retention = {'last': 10, 'daily': 7, 'weekly': 4, 'monthly': 12, 'min_interval': 0}
+
+# Errors meaning a file cannot be hard linked (filesystem without hard links, or too many links to the file): it is copied instead
+link_errors = {errno.EMLINK, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV}
+
+
+
+def snapshots_path(backup_path):
+    return Path(backup_path) / SNAPSHOTS_NAME
+
+
+def enabled(backup_path):
+    return (snapshots_path(backup_path) / POLICY_NAME).is_file()
+
+
+def read_policy(backup_path):
+    '''
+    Retention policy of a backup location, with the defaults for what it does not set
+    '''
+
+    try:
+        with open(snapshots_path(backup_path) / POLICY_NAME, encoding='utf-8') as file:
+            return {**retention, **json.load(file)}
+    except FileNotFoundError:
+        return dict(retention)
+
+
+def enable(backup_path, **policy):
+    '''
+    Take a snapshot after each backup into backup_path from now on, changing the given settings of the retention policy.
+    Return the policy. Raise ValueError for a store, whose contents are not files that can be linked
+    '''
+
+    if Store.exists(backup_path):
+        raise ValueError(f'{str(backup_path)} holds a store, snapshots need a plain backup')
+    policy = {**read_policy(backup_path), **{name: value for name, value in policy.items() if value is not None}}
+    snapshots_path(backup_path).mkdir(exist_ok=True)
+    with open(snapshots_path(backup_path) / POLICY_NAME, 'w', encoding='utf-8') as file:
+        json.dump(policy, file, indent=1)
+    return policy
+
+
+def disable(backup_path):
+    '''
+    Stop taking snapshots after each backup, keeping the generations already taken
+    '''
+
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(snapshots_path(backup_path) / POLICY_NAME)
+
+
+def generations(backup_path):
+    '''
+    Names of the complete generations of a backup location, oldest first
+    '''
+
+    try:
+        names = os.listdir(snapshots_path(backup_path))
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if parse_name(name) is not None)
+
+
+def parse_name(name):
+    try:
+        return datetime.strptime(name, NAME_FORMAT)
+    except ValueError:
+        return None
+
+
+def link_tree(src, dst, previous=None):
+    '''
+    Recreate the tree of src in dst with a hard link to each file, so the generation shares the data of the live backup.
+    Files that are not the same inode as in the previous generation were written by a backup since then, and are counted as changed.
+    Names starting with the metadata prefix are left out at the root.
+    Return the statistics: files, changed files and their bytes, and files copied because they could not be linked
+    '''
+
+    stats = {'files': 0, 'changed': 0, 'bytes_changed': 0, 'copied': 0}
+    stack = [('', True)]
+    while stack:
+        relative, root = stack.pop()
+        folder = src / relative
+        (dst / relative).mkdir()
+        previous_inodes = {}
+        if previous is not None:
+            with contextlib.suppress(OSError), os.scandir(previous / relative) as entries:
+                previous_inodes = {entry.name: entry.inode() for entry in entries}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if root and entry.name.startswith(METADATA_PREFIX):
+                    continue
+                child = f'{relative}/{entry.name}' if relative else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((child, False))
+                    continue
+                stats['files'] += 1
+                if previous_inodes.get(entry.name) != entry.inode():
+                    stats['changed'] += 1
+                    stats['bytes_changed'] += entry.stat(follow_symlinks=False).st_size
+                try:
+                    os.link(entry.path, dst / child, follow_symlinks=False)
+                except OSError as error:
+                    if error.errno not in link_errors:
+                        raise
+                    copying.copy_file(entry.path, dst / child)
+                    stats['copied'] += 1
+        shutil.copystat(folder, dst / relative)
+    profiling.count('snapshot_links', stats['files'] - stats['copied'])
+    return stats
+
+
+def select(names, policy):
+    '''
+    Generations to keep under a retention policy: the policy['last'] most recent, and the most recent of each of the
+    policy['daily'] most recent days, policy['weekly'] weeks and policy['monthly'] months having generations
+    '''
+
+    keep = set(names[-policy['last']:]) if policy['last'] > 0 else set()
+    for period, key in [('daily', lambda date: date.date()), ('weekly', lambda date: date.isocalendar()[:2]),
+                        ('monthly', lambda date: (date.year, date.month))]:
+        periods = set()
+        for name in reversed(names):
+            period_key = key(parse_name(name))
+            if period_key not in periods and len(periods) < policy[period]:
+                periods.add(period_key)
+                keep.add(name)
+    return keep
+
+
+def prune(backup_path, policy=None):
+    '''
+    Remove the generations the retention policy (by default the one of the backup location) does not keep, returning their names.
+    Files only disappear once no other generation nor the live backup links to them
+    '''
+
+    policy = policy or read_policy(backup_path)
+    names = generations(backup_path)
+    keep = select(names, policy)
+    removed = [name for name in names if name not in keep]
+    for name in removed:
+        shutil.rmtree(snapshots_path(backup_path) / name)
+    return removed
+
+
+def snapshot(backup_path, policy=None):
+    '''
+    Take a new generation of the backup: a folder of the snapshots folder holding the backup tree, with every file hard linked
+    (unchanged files therefore share their data with the previous generations and changed files were already written by the backup),
+    then prune the generations beyond the retention policy. A generation is created under a temporary name and renamed once complete.
+    Return the statistics: generation name, files, changed files and their bytes since the previous generation, files copied,
+    and generations pruned (None if a generation was already taken within the same second)
+    '''
+
+    backup_path = Path(backup_path)
+    folder = snapshots_path(backup_path)
+    folder.mkdir(exist_ok=True)
+    for name in os.listdir(folder):
+        if name.endswith(PARTIAL_SUFFIX): # left by an interrupted snapshot
+            shutil.rmtree(folder / name)
+
+    names = generations(backup_path)
+    previous = folder / names[-1] if names else None
+    name = datetime.now().strftime(NAME_FORMAT)
+    if name in names: # a snapshot was already taken within the same second
+        return None
+    partial = folder / (name + PARTIAL_SUFFIX)
+    with profiling.span('snapshot'):
+        try:
+            stats = link_tree(backup_path, partial, previous)
+            if compressor.used(backup_path): # the generation is then read like the backup, decompressing its compressed files
+                compressor.Compression(partial).close()
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        os.rename(partial, folder / name)
+        pruned = prune(backup_path, policy)
+    return {'generation': name, **stats, 'pruned': pruned}
+
+
+def snapshot_due(backup_path):
+    '''
+    Check whether a backup into backup_path should be followed by a snapshot: snapshots are enabled
+    and the last generation is older than the min_interval of the retention policy
+    '''
+
+    if not enabled(backup_path):
+        return False
+    names = generations(backup_path)
+    if not names:
+        return True
+    return (datetime.now() - parse_name(names[-1])).total_seconds() >= read_policy(backup_path)['min_interval']
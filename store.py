@@ -0,0 +1,336 @@
+import copying
+from hashing import HashCache
+import os
+from pathlib import Path
+from plan import BACKUP, SOURCE
+import profiling
+from scanner import FILE, FOLDER, METADATA_PREFIX, Entry
+import sqlite3
+import threading
+
+STORE_NAME = METADATA_PREFIX + '-store' # folder of the backup root holding the objects and the manifest of a store
+TEMP_PREFIX = 'tmp-' # objects being written, renamed to their digest once complete
+
+
+
+def subtree_query(columns, relative):
+    '''
+    Query and parameters selecting the manifest entries of a path and of everything below it (everything for the root), in path order
+    '''
+
+    if not relative:
+        return f'SELECT {columns} FROM entries ORDER BY path', ()
+    # '0' is the character following '/', so the range holds exactly the paths below the folder
+    return f'SELECT {columns} FROM entries WHERE path = ? OR (path >= ? AND path < ?) ORDER BY path', (relative, relative + '/', relative + '0')
+
+
+class Store:
+    '''
+    Content-addressed backup layout: each distinct file content is stored once, as an object named by its digest (see hashing.hash_file),
+    and the backup tree is a manifest of paths pointing to the objects, with their sizes and dates modified.
+    Storing a file whose contents are already there only adds its manifest entry, and an object is deleted once no entry refers to it.
+    The manifest is shared by threads under self.lock, and each change is committed at once.
+    '''
+
+    def __init__(self, backup_path):
+        self.backup_path = Path(backup_path)
+        self.path = self.backup_path / STORE_NAME
+        self.objects = self.path / 'objects'
+        self.connection = sqlite3.connect(self.path / 'manifest.sqlite', check_same_thread=False)
+        self.lock = threading.Lock()
+        self.hash_cache = None # opened by the first file stored
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode = WAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, parent TEXT, name TEXT, kind INTEGER, size INTEGER,
+                                                                           mtime_ns INTEGER, digest TEXT) WITHOUT ROWID''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER, refs INTEGER) WITHOUT ROWID')
+
+
+    @staticmethod
+    def exists(backup_path):
+        return (Path(backup_path) / STORE_NAME).is_dir()
+
+
+    @classmethod
+    def open(cls, backup_path):
+        '''
+        Store of a backup location, or None if the backup is a plain copy of the source
+        '''
+
+        return cls(backup_path) if cls.exists(backup_path) else None
+
+
+    @classmethod
+    def create(cls, backup_path):
+        '''
+        Start a store in an empty backup location (an existing store is opened).
+        Raise ValueError if the location already holds files, which would not be part of the store
+        '''
+
+        backup_path = Path(backup_path)
+        if not cls.exists(backup_path):
+            if any(not name.startswith(METADATA_PREFIX) for name in os.listdir(backup_path)):
+                raise ValueError(f'{str(backup_path)} is not empty, a store can only be started in an empty backup location')
+            (backup_path / STORE_NAME / 'objects').mkdir(parents=True)
+        return cls(backup_path)
+
+
+    def close(self):
+        with self.lock:
+            if self.hash_cache is not None:
+                self.hash_cache.close()
+                self.hash_cache = None
+            self.connection.close()
+
+
+    def object_path(self, digest):
+        return self.objects / digest[:2] / digest[2:]
+
+
+    def entry(self, relative):
+        '''
+        (kind, size, mtime_ns, digest) of a path of the backup tree, or None if it is not in the store
+        '''
+
+        with self.lock:
+            return self.connection.execute('SELECT kind, size, mtime_ns, digest FROM entries WHERE path = ?', (relative,)).fetchone()
+
+
+    def is_folder(self, relative):
+        if not relative:
+            return True
+        entry = self.entry(relative)
+        return entry is not None and entry[0] == FOLDER
+
+
+    def listing(self, relative, rules=None):
+        '''
+        Entries of a folder of the backup tree, {name: Entry} like scanner.scan_directory, without what the rules exclude
+        '''
+
+        with self.lock:
+            rows = self.connection.execute('SELECT name, kind, size, mtime_ns FROM entries WHERE parent = ?', (relative,)).fetchall()
+        prefix = relative + '/' if relative else ''
+        listing = {row[0]: Entry(*row) for row in rows if not (rules and rules.excluded(prefix + row[0], row[1] == FOLDER))}
+        profiling.count('manifest_listings')
+        profiling.count('entries', len(listing))
+        return listing
+
+
+    def subtree(self, relative, rules=None):
+        '''
+        (path, kind, size, mtime_ns, digest) of a path of the backup tree and of everything below it, in path order,
+        without what the rules exclude below it
+        '''
+
+        with self.lock:
+            rows = self.connection.execute(*subtree_query('path, kind, size, mtime_ns, digest', relative)).fetchall()
+        if rules:
+            rows = [row for row in rows if row[0] == relative or not rules.excluded_path(row[0], row[1] == FOLDER)]
+        return rows
+
+
+    def folder_stats(self, relative, rules=None):
+        '''
+        Number and total size of the files of a folder of the backup tree, like plan.folder_stats
+        '''
+
+        files = [row for row in self.subtree(relative, rules) if row[1] == FILE]
+        return len(files), sum(row[2] for row in files)
+
+
+    def add_entry(self, relative, kind, size=0, mtime_ns=0, digest=None):
+        '''
+        Record a path, replacing what was there, and its parent folders (called with self.lock held)
+        '''
+
+        old = self.connection.execute('SELECT digest FROM entries WHERE path = ?', (relative,)).fetchone()
+        parent, _, name = relative.rpartition('/')
+        self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)', (relative, parent, name, kind, size, mtime_ns, digest))
+        if digest is not None:
+            self.connection.execute('UPDATE objects SET refs = refs + 1 WHERE digest = ?', (digest,))
+        if old is not None:
+            self.release(old[0])
+        while parent:
+            folder = parent
+            parent, _, name = folder.rpartition('/')
+            self.connection.execute('INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, 0, 0, NULL)', (folder, parent, name, FOLDER))
+
+
+    def release(self, digest):
+        '''
+        Drop a reference to an object, deleting it once nothing refers to it (called with self.lock held)
+        '''
+
+        if digest is None:
+            return
+        self.connection.execute('UPDATE objects SET refs = refs - 1 WHERE digest = ?', (digest,))
+        if self.connection.execute('SELECT refs FROM objects WHERE digest = ?', (digest,)).fetchone()[0] <= 0:
+            self.connection.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+
+    def add_folder(self, relative):
+        with self.lock, self.connection:
+            self.add_entry(relative, FOLDER)
+
+
+    def put(self, src, relative, progress=None):
+        '''
+        Store a file at a path of the backup tree, copying its contents only if the store does not hold them yet.
+        progress(bytes) is called as they are copied, or once if they were already stored. Return the backend used to copy them ('dedup' if none)
+        '''
+
+        stat = os.stat(src)
+        if self.hash_cache is None:
+            with self.lock:
+                if self.hash_cache is None:
+                    self.hash_cache = HashCache(self.backup_path)
+        digest = self.hash_cache.digest(src).hex() # the source file is read once, then its digest is cached until it changes
+        entry = (relative, FILE, stat.st_size, stat.st_mtime_ns, digest)
+
+        # Known contents: the entry is added in the same transaction, so the object cannot be released in between
+        with self.lock, self.connection:
+            if self.connection.execute('SELECT 1 FROM objects WHERE digest = ?', (digest,)).fetchone() is not None:
+                self.add_entry(*entry)
+                if progress is not None:
+                    progress(stat.st_size)
+                profiling.count('deduplicated_files')
+                return 'dedup'
+
+        # New contents, copied under a name of this thread and renamed to the object once recorded
+        path = self.object_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        temp = path.with_name(f'{TEMP_PREFIX}{threading.get_ident()}-{path.name}')
+        backend = copying.copy_file(src, temp, progress)
+        with self.lock, self.connection:
+            os.replace(temp, path)
+            self.connection.execute('INSERT OR IGNORE INTO objects VALUES (?, ?, 0)', (digest, stat.st_size))
+            self.add_entry(*entry)
+        profiling.count('stored_bytes', stat.st_size)
+        return backend
+
+
+    def remove(self, relative):
+        '''
+        Remove a path of the backup tree and everything below it
+        '''
+
+        with self.lock, self.connection:
+            rows = self.connection.execute(*subtree_query('path, digest', relative)).fetchall()
+            if not rows:
+                raise FileNotFoundError(2, 'Not in the store', relative)
+            for path, digest in rows:
+                self.connection.execute('DELETE FROM entries WHERE path = ?', (path,))
+                self.release(digest)
+
+
+    def rename(self, old, new):
+        '''
+        Move a path of the backup tree and everything below it to a new path, only changing the manifest
+        '''
+
+        with self.lock, self.connection:
+            rows = self.connection.execute(*subtree_query('path', old)).fetchall()
+            if not rows:
+                raise FileNotFoundError(2, 'Not in the store', old)
+            if self.connection.execute('SELECT 1 FROM entries WHERE path = ?', (new,)).fetchone() is not None:
+                raise FileExistsError(17, 'Already in the store', new)
+            for (path,) in rows:
+                relative = new + path[len(old):]
+                parent, _, name = relative.rpartition('/')
+                self.connection.execute('UPDATE entries SET path = ?, parent = ?, name = ? WHERE path = ?', (relative, parent, name, path))
+            parent = new.rpartition('/')[0]
+            if parent:
+                self.add_entry(parent, FOLDER) # a folder entry holds no object, so replacing it changes nothing
+
+
+    def restore(self, relative, dst, progress=None, rules=None):
+        '''
+        Write a path of the backup tree (a file, or a folder and everything below it) to dst, with the dates modified of the files,
+        leaving out what the rules exclude. progress(bytes) is called as files are written.
+        Return the (destination, backend, size) of each file written
+        '''
+
+        rows = self.subtree(relative, rules)
+        if relative and not rows:
+            raise FileNotFoundError(2, 'Not in the store', relative)
+        dst = Path(dst)
+        if not relative: # the root has no entry of its own
+            dst.mkdir(parents=True, exist_ok=True)
+        written = []
+        for path, kind, size, mtime_ns, digest in rows:
+            target = dst / path[len(relative):].lstrip('/')
+            if kind == FOLDER:
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            backend = copying.copy_file(self.object_path(digest), target, progress)
+            os.utime(target, ns=(mtime_ns, mtime_ns)) # objects shared by several files carry the date of the first one
+            written.append((target, backend, size))
+        return written
+
+
+    def applied(self, operation, roots):
+        '''
+        Check whether an operation on the backup side of a store, that may have been interrupted by a crash, is already done (see executor.applied)
+        '''
+
+        def exists(side, relative):
+            return self.entry(relative) is not None if side == BACKUP else os.path.lexists(roots[side] / relative)
+
+        if operation.op in ('delete', 'rmtree'):
+            return not exists(operation.src_side, operation.src)
+        if operation.op in ('move', 'rename'):
+            return not exists(operation.src_side, operation.src) and exists(operation.dst_side, operation.dst)
+        return False # copies are simply made again, without copying stored contents twice
+
+
+    def perform(self, operation, roots, files, tracker, rules=None):
+        '''
+        Apply an operation involving the backup side of a store, like executor.perform: files copied into the store are added as objects,
+        files copied from it are restored from their objects, and renames and deletions only change the manifest.
+        Files whose contents were already stored are appended to files with the 'dedup' backend and no bytes written
+        '''
+
+        op = operation.op
+        src = roots[operation.src_side] / operation.src
+
+        def put(file_src, relative):
+            backend = self.put(file_src, relative, tracker.add_bytes)
+            size = os.stat(file_src).st_size
+            files.append((roots[BACKUP] / relative, backend, size, 0 if backend == 'dedup' else size))
+            tracker.add_files()
+
+        if op in ('delete', 'rmtree'):
+            self.remove(operation.src)
+            tracker.add_files()
+        elif operation.src_side == operation.dst_side == BACKUP: # rename, or move within the backup
+            self.rename(operation.src, operation.dst)
+            tracker.add_bytes(operation.size or 0)
+            tracker.add_files()
+        elif operation.src_side == SOURCE and op == 'copytree':
+            for folder, folders, names in os.walk(src):
+                relative = Path(operation.dst, os.path.relpath(folder, src)).as_posix()
+                if rules:
+                    prefix = Path(operation.src, os.path.relpath(folder, src)).as_posix() + '/'
+                    folders[:] = [name for name in folders if not rules.excluded(prefix + name, True)]
+                    names = [name for name in names if not rules.excluded(prefix + name)]
+                self.add_folder(relative)
+                for name in names:
+                    put(os.path.join(folder, name), f'{relative}/{name}')
+        elif operation.src_side == SOURCE and op in ('copy', 'update', 'move'):
+            put(src, operation.dst)
+            if op == 'move':
+                src.unlink()
+        elif operation.src_side == BACKUP and op in ('copy', 'update', 'copytree', 'move'):
+            for path, backend, size in self.restore(operation.src, roots[operation.dst_side] / operation.dst, tracker.add_bytes, rules):
+                files.append((path, backend, size, size))
+                tracker.add_files()
+            if op == 'move':
+                self.remove(operation.src)
+        else:
+            raise ValueError(f'Unknown operation {op}')
@@ -0,0 +1,122 @@
+import itertools
+from plan import BACKUP, SOURCE, Operation, build_plan, dated_name, swap_name
+from results import COPY, COPY_TO_BACKUP, COPY_TO_SOURCE, KEEP, KEEP_BACKUP, KEEP_SOURCE, RENAME, ComparisonResults
+import unittest
+
+PATH = 'folder/report.txt'
+DATE1 = 1_700_000_000 # date modified in the source
+DATE2 = 1_600_000_000 # date modified in the backup
+SIZE1 = 10
+SIZE2 = 20
+NEW1 = dated_name(PATH, DATE1)
+NEW2 = dated_name(PATH, DATE2)
+TEMP = swap_name(PATH)
+
+# Operations of a file with different dates for each combination of its checkboxes
+# (keep in source, copy to backup, keep in backup, copy to source), as (op, src_side, src, dst_side, dst, size)
+DATES = {
+    (False, False, False, False): [('delete', SOURCE, PATH, None, None, 0), ('delete', BACKUP, PATH, None, None, 0)],
+    (False, False, False, True): [('copy', BACKUP, PATH, SOURCE, PATH, SIZE2), ('delete', BACKUP, PATH, None, None, 0)],
+    (False, False, True, False): [('delete', SOURCE, PATH, None, None, 0)],
+    (False, False, True, True): [('copy', BACKUP, PATH, SOURCE, PATH, SIZE2)],
+    (False, True, False, False): [('copy', SOURCE, PATH, BACKUP, PATH, SIZE1), ('delete', SOURCE, PATH, None, None, 0)],
+    (False, True, False, True): [('move', SOURCE, PATH, SOURCE, TEMP, 0), ('move', BACKUP, PATH, SOURCE, PATH, SIZE2),
+                                 ('move', SOURCE, TEMP, BACKUP, PATH, SIZE1)],
+    (False, True, True, False): [('rename', BACKUP, PATH, BACKUP, NEW2, 0), ('copy', SOURCE, PATH, BACKUP, NEW1, SIZE1),
+                                 ('delete', SOURCE, PATH, None, None, 0)],
+    (False, True, True, True): [('copy', SOURCE, PATH, BACKUP, NEW1, SIZE1), ('delete', SOURCE, PATH, None, None, 0),
+                                ('copy', BACKUP, PATH, SOURCE, PATH, SIZE2), ('rename', BACKUP, PATH, BACKUP, NEW2, 0)],
+    (True, False, False, False): [('delete', BACKUP, PATH, None, None, 0)],
+    (True, False, False, True): [('rename', SOURCE, PATH, SOURCE, NEW1, 0), ('copy', BACKUP, PATH, SOURCE, NEW2, SIZE2),
+                                 ('delete', BACKUP, PATH, None, None, 0)],
+    (True, False, True, False): [],
+    (True, False, True, True): [('rename', SOURCE, PATH, SOURCE, NEW1, 0), ('copy', BACKUP, PATH, SOURCE, NEW2, SIZE2)],
+    (True, True, False, False): [('copy', SOURCE, PATH, BACKUP, PATH, SIZE1)],
+    (True, True, False, True): [('rename', SOURCE, PATH, SOURCE, NEW1, 0), ('copy', BACKUP, PATH, SOURCE, NEW2, SIZE2),
+                                ('copy', SOURCE, NEW1, BACKUP, PATH, SIZE1)],
+    (True, True, True, False): [('rename', BACKUP, PATH, BACKUP, NEW2, 0), ('copy', SOURCE, PATH, BACKUP, NEW1, SIZE1)],
+    (True, True, True, True): [('rename', SOURCE, PATH, SOURCE, NEW1, 0), ('copy', BACKUP, PATH, SOURCE, NEW2, SIZE2),
+                               ('copy', SOURCE, NEW1, BACKUP, NEW1, SIZE1), ('rename', BACKUP, PATH, BACKUP, NEW2, 0)],
+}
+
+
+
+def decision(checked, bits):
+    return sum(bit for bit, on in zip(bits, checked) if on)
+
+
+def operations(results, delta_threshold=None):
+    return [operation[1:] for operation in build_plan(results, delta_threshold)]
+
+
+class BuildPlanTest(unittest.TestCase):
+    '''
+    Operations generated for every combination of checkboxes of each kind of difference
+    '''
+
+    def results(self):
+        return ComparisonResults('/source', '/backup')
+
+
+    def test_different_dates(self):
+        for checked in itertools.product([False, True], repeat=4):
+            with self.subTest(checked=checked):
+                results = self.results()
+                results.different_dates.append('folder', 'report.txt', DATE1, DATE2, True, SIZE1, SIZE2,
+                                               decision(checked, [KEEP_SOURCE, COPY_TO_BACKUP, KEEP_BACKUP, COPY_TO_SOURCE]))
+                self.assertEqual(operations(results), DATES[checked])
+
+
+    def test_different_dates_update(self):
+        # With delta transfer, files at least delta_threshold bytes replacing an older version are updated in place
+        results = self.results()
+        results.different_dates.append('folder', 'report.txt', DATE1, DATE2, True, SIZE1, SIZE2, KEEP_SOURCE | COPY_TO_BACKUP)
+        results.different_dates.append('folder', 'report.txt', DATE1, DATE2, True, SIZE1, SIZE2, KEEP_BACKUP | COPY_TO_SOURCE)
+        self.assertEqual(operations(results, delta_threshold=SIZE1),
+                         [('update', SOURCE, PATH, BACKUP, PATH, SIZE1), ('update', BACKUP, PATH, SOURCE, PATH, SIZE2)])
+        self.assertEqual(operations(results, delta_threshold=SIZE2 + 1),
+                         [('copy', SOURCE, PATH, BACKUP, PATH, SIZE1), ('copy', BACKUP, PATH, SOURCE, PATH, SIZE2)])
+
+
+    def test_unique(self):
+        for table, side, other, op, remove, size in [('unique_folders_dir', SOURCE, BACKUP, 'copytree', 'rmtree', None),
+                                                     ('unique_folders_backup', BACKUP, SOURCE, 'copytree', 'rmtree', None),
+                                                     ('unique_files_dir', SOURCE, BACKUP, 'copy', 'delete', SIZE1),
+                                                     ('unique_files_backup', BACKUP, SOURCE, 'copy', 'delete', SIZE1)]:
+            for keep, copy in itertools.product([False, True], repeat=2):
+                with self.subTest(table=table, keep=keep, copy=copy):
+                    results = self.results()
+                    getattr(results, table).append('folder', 'report.txt', SIZE1, decision([keep, copy], [KEEP, COPY]))
+                    expected = [(op, side, PATH, other, PATH, size)] if copy else []
+                    expected += [] if keep else [(remove, side, PATH, None, None, 0)]
+                    self.assertEqual(operations(results), expected)
+
+
+    def test_renames(self):
+        for is_folder, rename in itertools.product([False, True], repeat=2):
+            with self.subTest(is_folder=is_folder, rename=rename):
+                results = self.results()
+                results.renames.append('folder', 'report.txt', 'old', 'name.txt', SIZE1, is_folder, RENAME if rename else 0)
+                if rename:
+                    expected = [('rename', BACKUP, 'old/name.txt', BACKUP, PATH, 0)]
+                elif is_folder:
+                    expected = [('copytree', SOURCE, PATH, BACKUP, PATH, None)]
+                else:
+                    expected = [('copy', SOURCE, PATH, BACKUP, PATH, SIZE1)]
+                self.assertEqual(operations(results), expected)
+
+
+    def test_items(self):
+        # Each difference is one item, numbered in the order the plan applies them
+        results = self.results()
+        results.unique_files_dir.append('', 'new.txt', SIZE1)
+        results.renames.append('', 'moved.txt', '', 'old.txt', SIZE1)
+        results.different_dates.append('folder', 'report.txt', DATE1, DATE2, True, SIZE1, SIZE2, KEEP_SOURCE | COPY_TO_BACKUP)
+        plan = list(build_plan(results))
+        self.assertEqual([operation.item for operation in plan], [0, 1, 2])
+        self.assertTrue(all(isinstance(operation, Operation) for operation in plan))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,289 @@
+import ctypes
+import ctypes.util
+import engine
+import executor
+import os
+from pathlib import Path
+import rules
+import select
+from scanner import FOLDER, METADATA_PREFIX, scan_directory
+from store import Store
+import struct
+import sys
+import time
+
+debounce = 2.0 # seconds without new changes before they are synchronized
+max_delay = 30.0 # seconds after the first change at which changes are synchronized even if more keep coming
+poll_interval = 5.0 # seconds between two scans of the source tree when inotify is not available
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT = struct.Struct('iIII') # watch descriptor, mask, cookie, length of the name that follows
+
+
+
+def join(folder, name):
+    return f'{folder}/{name}' if folder else name
+
+
+def parent(relative):
+    return relative.rpartition('/')[0]
+
+
+class InotifyWatcher:
+    '''
+    Changes in a tree reported by Linux inotify, with one watch per folder.
+    changes(timeout) returns the relative paths of the folders whose contents changed, or None if events were lost
+    (the queue overflowed) and the whole tree must be compared again. Folders excluded by the rules are not watched.
+    '''
+
+    def __init__(self, root, rules=None):
+        self.root = Path(root)
+        self.rules = rules
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.folders = {} # watch descriptor: relative path of the folder
+        try:
+            self.add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+
+    def add_tree(self, relative):
+        '''
+        Watch a folder and its subfolders, returning their relative paths
+        '''
+
+        added = []
+        stack = [relative]
+        while stack:
+            folder = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(self.root / folder), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (2, 20): # ENOENT, ENOTDIR: removed or replaced since it was listed
+                    continue
+                raise OSError(error, f'Cannot watch {str(self.root / folder)}: {os.strerror(error)}') # e.g. ENOSPC, too many watches
+            self.folders[wd] = folder
+            added.append(folder)
+            stack.extend(join(folder, name) for name, entry in scan_directory(self.root / folder, self.rules, folder).items()
+                         if entry.kind == FOLDER and not name.startswith(METADATA_PREFIX))
+        return added
+
+
+    def remove_tree(self, relative):
+        '''
+        Stop watching a folder moved away and its subfolders
+        '''
+
+        prefix = relative + '/'
+        for wd, folder in list(self.folders.items()):
+            if folder == relative or folder.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.folders[wd]
+
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0'))
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.folders[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(parent(folder))
+                continue
+            if name.startswith(METADATA_PREFIX): # partial copies and swaps made by the backup itself
+                continue
+            relative = join(folder, name)
+            if self.rules and self.rules.excluded(relative, bool(mask & IN_ISDIR)):
+                continue
+            changed.add(folder)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self.add_tree(relative)) # files may have been added before the folder was watched
+                elif mask & IN_MOVED_FROM:
+                    self.remove_tree(relative)
+        return None if overflow else changed
+
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+
+class PollingWatcher:
+    '''
+    Changes in a tree found by listing it again every poll_interval seconds and comparing with the previous listings,
+    for systems without inotify. Only the source tree is listed, without what the rules exclude;
+    the backup is compared for the changed folders only.
+    '''
+
+    def __init__(self, root, interval=poll_interval, rules=None):
+        self.root = Path(root)
+        self.interval = interval
+        self.rules = rules
+        self.listings = self.scan()
+        self.next_poll = time.monotonic() + interval
+
+
+    def scan(self):
+        '''
+        Listing of every folder of the tree, {relative path: {name: Entry}}
+        '''
+
+        listings = {}
+        stack = ['']
+        while stack:
+            folder = stack.pop()
+            listing = scan_directory(self.root / folder, self.rules, folder)
+            listings[folder] = {name: entry for name, entry in listing.items() if not name.startswith(METADATA_PREFIX)}
+            stack.extend(join(folder, name) for name, entry in listings[folder].items() if entry.kind == FOLDER)
+        return listings
+
+
+    def changes(self, timeout):
+        wait = self.next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        listings = self.scan()
+        self.next_poll = time.monotonic() + self.interval
+        changed = {folder for folder, listing in listings.items() if self.listings.get(folder) != listing}
+        changed.update(parent(folder) for folder in self.listings if folder and folder not in listings)
+        self.listings = listings
+        return changed
+
+
+    def close(self):
+        pass
+
+
+def create_watcher(root, polling=False, rules=None):
+    '''
+    inotify watcher on Linux, falling back to polling when it is not available or the watch limit is reached
+    '''
+
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, rules)
+        except (OSError, AttributeError) as error:
+            print(f'Cannot watch {str(root)} with inotify ({error}), polling every {poll_interval:g} s instead', file=sys.stderr)
+    return PollingWatcher(root, rules=rules)
+
+
+def common_folders(directory_path, backup_path, changed, store=None):
+    '''
+    Folders to compare for a set of changed folders: each one, or its closest parent that exists on both sides
+    (a folder missing from the backup is then copied as a whole). With a store.Store, the backup side is looked up in its manifest
+    '''
+
+    def in_backup(relative):
+        return store.is_folder(relative) if store is not None else os.path.isdir(Path(backup_path) / relative)
+
+    folders = set()
+    for relative in changed:
+        while relative and not (os.path.isdir(Path(directory_path) / relative) and in_backup(relative)):
+            relative = parent(relative)
+        folders.add(relative)
+    return sorted(folders)
+
+
+def sync(directory_path, backup_path, folders=None, verify_content=False, workers=executor.copy_workers, log=None, delta_threshold=None, exclude=()):
+    '''
+    Compare the given folders (the whole trees if None) and apply the default decisions, returning the statistics of the run
+    '''
+
+    results = engine.analyze(directory_path, backup_path, verify_content=verify_content, folders=folders, exclude=exclude)
+    stats = engine.apply(results, workers=workers, log=log, delta_threshold=delta_threshold)
+    stats['differences'] = len(results)
+    stats['folders'] = None if folders is None else len(folders)
+    return stats
+
+
+def watch(directory_path, backup_path, on_sync=None, cancelled=engine.never_cancelled, verify_content=False, workers=executor.copy_workers,
+          log=None, delta_threshold=None, polling=False, debounce=debounce, exclude=()):
+    '''
+    Keep a backup in sync with its source: the whole trees are synchronized first, then changes in the source are collected
+    and only the changed folders are compared and synchronized, once no change came for debounce seconds (or max_delay after the first one).
+    The default decisions are applied, as by engine.apply. on_sync(stats) is called after each synchronization (see sync),
+    and cancelled() is checked at least once a second. Paths excluded by the rules (see rules.load) are neither watched nor synchronized.
+    '''
+
+    exclusions = rules.load(directory_path, backup_path, exclude)
+    watcher = create_watcher(directory_path, polling, exclusions)
+    store = Store.open(backup_path)
+    try:
+        stats = sync(directory_path, backup_path, None, verify_content, workers, log, delta_threshold, exclude)
+        if on_sync is not None:
+            on_sync(stats)
+
+        changed = set()
+        everything = False
+        first = last = None
+        while not cancelled():
+            changes = watcher.changes(min(debounce, 1.0))
+            now = time.monotonic()
+            if changes is None:
+                everything = True
+            if changes is None or changes:
+                changed.update(changes or ())
+                last = now
+                first = first or now
+            if first is None or (now - last < debounce and now - first < max_delay):
+                continue
+
+            changed = {folder for folder in changed if not exclusions.excluded_path(folder)}
+            folders = None if everything else common_folders(directory_path, backup_path, changed, store)
+            changed = set()
+            everything = False
+            first = last = None
+            if folders == []: # only excluded paths changed
+                continue
+            stats = sync(directory_path, backup_path, folders, verify_content, workers, log, delta_threshold, exclude)
+            if on_sync is not None:
+                on_sync(stats)
+    finally:
+        watcher.close()
+        if store is not None:
+            store.close()